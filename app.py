@@ -12,7 +12,7 @@ from quart import Quart
 from quart_cors import cors
 from config import DATABASE_CONFIG
 from routes.users import user_bp
-from routes.admin_routes import admin_routes
+from routes.admin_routes import admin_routes, EXPORT_JOB_TYPES
 from routes.permissions_routes import permissions_routes
 from routes.notifications_routes import notifications_bp
 from routes.subscriptions_routs import public_routes
@@ -23,10 +23,17 @@ from routes.payment_confirmation import payment_confirmation_bp
 from routes.auth_routes import auth_routes
 from services.background_task_service import BackgroundTaskService
 from services.sse_client import SseApiClient
+from services.renewal_queue import RenewalJobWorker
+from services.export_jobs import ExportJobWorker
+from services.discount_apply_jobs import DiscountApplyWorker
 from telegram_bot import start_bot, bot, telegram_bot_bp
 from utils.scheduler import start_scheduler
 from utils.db_utils import close_telegram_bot_session
 from utils.startup_tasks import mark_stale_tasks_as_failed
+from utils.settings_cache import settings_cache
+from utils.audience_segments import audience_segments
+from utils.json_provider import configure_json_provider
+from utils.compression import register_compression
 from pytoniq import LiteBalancer
 
 # تأكد من المتغيرات البيئية الأساسية
@@ -44,6 +51,8 @@ async def _on_connect(conn):
 
 # ✅ استخدم Quart العادي، لم نعد بحاجة لـ CustomQuart
 app = Quart(__name__)
+configure_json_provider(app)  # orjson إن كان مثبتًا (JSON_PROVIDER=std للرجوع إلى json)
+register_compression(app)  # brotli / gzip للاستجابات النصية الأكبر من COMPRESSION_MIN_SIZE
 
 app.sse_client = None
 app.db_pool = None
@@ -52,6 +61,9 @@ app.bot = None
 app.bot_running = False
 app.lite_balancer = None
 app.background_task_service = None
+app.renewal_worker = None
+app.export_worker = None
+app.discount_apply_worker = None
 
 # إعداد السجلات (Logging)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -158,6 +170,8 @@ async def startup():
         logging.info("API-SERVER: Creating database connection pool...")
         app.db_pool = await asyncpg.create_pool(**DATABASE_CONFIG, init=_on_connect, min_size=5, max_size=50)
         logging.info("API-SERVER: Database pool created.")
+        await settings_cache.start(app.db_pool)
+        await audience_segments.start(app.db_pool)
 
         logging.info("API-SERVER: Initializing aiohttp session...")
         app.aiohttp_session = aiohttp.ClientSession()
@@ -184,6 +198,12 @@ async def startup():
 
         logging.info("API-SERVER: Starting Telegram bot and scheduler...")
         await start_scheduler(app.bot, app.db_pool)
+        app.renewal_worker = RenewalJobWorker(app.db_pool, app.bot)
+        app.renewal_worker.start()
+        app.export_worker = ExportJobWorker(app.db_pool, EXPORT_JOB_TYPES)
+        app.export_worker.start()
+        app.discount_apply_worker = DiscountApplyWorker(app.db_pool)
+        app.discount_apply_worker.start()
         if not app.bot_running:
             app.bot_running = True
             asyncio.create_task(start_bot())
@@ -206,9 +226,19 @@ async def shutdown():
     يقوم بإغلاق كل الاتصالات المفتوحة.
     """
     logging.info("--- API SERVER: STARTING APPLICATION SHUTDOWN ---")
+    if app.sse_client:
+        await app.sse_client.flush()
+    if app.renewal_worker:
+        await app.renewal_worker.stop()
+    if app.export_worker:
+        await app.export_worker.stop()
+    if app.discount_apply_worker:
+        await app.discount_apply_worker.stop()
     if app.aiohttp_session and not app.aiohttp_session.closed:
         await app.aiohttp_session.close()
         logging.info("API-SERVER: aiohttp session closed")
+    await settings_cache.close()
+    await audience_segments.close()
     if app.db_pool:
         await app.db_pool.close()
         logging.info("API-SERVER: Database pool closed")
@@ -0,0 +1,155 @@
+# benchmarks/json_compression_benchmark.py
+"""
+قياس محلي لتسلسل JSON وضغط الاستجابات على حمولات بشكل /api/admin/subscriptions
+و /api/public/subscriptions/all (بيانات مولدة، بدون قاعدة بيانات أو شبكة).
+
+يقارن:
+  - مزود Quart الافتراضي (json) مع OrjsonProvider (utils/json_provider.py)
+  - حجم الجسم بدون ضغط ومع gzip / brotli (utils/compression.py) وزمن الضغط
+
+أمثلة:
+    python -m benchmarks.json_compression_benchmark
+    python -m benchmarks.json_compression_benchmark --rows 5000 --groups 12 --rounds 50
+"""
+
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from quart import Quart
+from quart.json.provider import DefaultJSONProvider
+
+from utils.compression import BROTLI_QUALITY, GZIP_LEVEL, brotli, compress_body
+from utils.json_provider import OrjsonProvider, orjson
+
+SOURCES = ["telegram_stars", "ton", "usdt_bep20", "admin_manual", "legacy"]
+
+
+def subscriptions_page(rows: int) -> dict:
+    """حمولة مشابهة لاستجابة GET /api/admin/subscriptions."""
+    now = datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+    data = []
+    for i in range(rows):
+        start = now - timedelta(days=i % 365, minutes=i)
+        data.append({
+            "id": 100000 + i,
+            "user_id": 5000 + i,
+            "telegram_id": 7000000000 + i * 37,
+            "full_name": f"محمد عبد الله {i}",
+            "username": f"user_{i}",
+            "subscription_type_id": i % 6 + 1,
+            "subscription_type_name": "قناة التوصيات الذهبية" if i % 2 else "دورة التداول المتقدمة",
+            "subscription_plan_id": i % 18 + 1,
+            "subscription_plan_name": "اشتراك شهري" if i % 3 else "اشتراك سنوي",
+            "source": SOURCES[i % len(SOURCES)],
+            "is_active": i % 4 != 0,
+            "status_label": "active" if i % 4 else "expired",
+            "start_date": start,
+            "expiry_date": start + timedelta(days=30),
+            "created_at": start,
+            "updated_at": start + timedelta(hours=2),
+            "days_remaining": 30 - i % 45,
+            "payment_token": f"tok_{i:012d}",
+            "amount": Decimal("29.99"),
+        })
+    return {
+        "data": data,
+        "total_count": rows * 40,
+        "page": 1,
+        "page_size": rows,
+        "stats": {"total_records": rows * 40, "active_count": rows * 30, "expired_count": rows * 10},
+    }
+
+
+def catalog(groups: int, types_per_group: int = 4, plans_per_type: int = 4) -> list:
+    """حمولة مشابهة لاستجابة GET /api/public/subscriptions/all."""
+    structure = []
+    for g in range(groups):
+        types = []
+        for t in range(types_per_group):
+            type_id = g * types_per_group + t + 1
+            types.append({
+                "id": type_id,
+                "name": f"قناة التحليل الفني رقم {type_id}",
+                "channel_id": -1001000000000 - type_id,
+                "description": "وصف تفصيلي للقناة يشرح المحتوى والمزايا وطريقة الاستفادة منها. " * 3,
+                "image_url": f"https://cdn.example.com/types/{type_id}.png",
+                "features": [f"ميزة رقم {n}: توصيات يومية مع متابعة مستمرة" for n in range(8)],
+                "usp": "أفضل قيمة مقابل السعر",
+                "is_recommended": t == 0,
+                "terms_and_conditions": [f"البند {n}: لا يمكن استرداد المبلغ بعد التفعيل" for n in range(5)],
+                "sort_order": t,
+                "subscription_plans": [{
+                    "id": type_id * 10 + p,
+                    "name": ["شهري", "ربع سنوي", "نصف سنوي", "سنوي"][p % 4],
+                    "duration_days": [30, 90, 180, 365][p % 4],
+                    "price": f"{(p + 1) * 19.99:.2f}",
+                    "original_price": f"{(p + 1) * 24.99:.2f}" if p % 2 else None,
+                } for p in range(plans_per_type)],
+            })
+        structure.append({
+            "id": g + 1,
+            "name": f"المجموعة {g + 1}",
+            "description": "مجموعة اشتراكات",
+            "image_url": None,
+            "color": "#3f51b5",
+            "icon": "category",
+            "sort_order": g,
+            "subscription_types": types,
+        })
+    return structure
+
+
+def timed(func, rounds: int):
+    timings = []
+    result = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, statistics.median(timings)
+
+
+def report_payload(label: str, payload, providers, rounds: int):
+    print(f"\n== {label}")
+    bodies = {}
+    for name, dumps in providers.items():
+        body, median = timed(lambda: dumps(payload), rounds)
+        bodies[name] = body
+        print(f"  serialize {name:<8} median={median * 1000:8.2f} ms  size={len(body):>10,} B")
+
+    body = bodies["orjson"] if "orjson" in bodies else bodies["json"]
+    encodings = [("gzip", f"gzip-{GZIP_LEVEL}")]
+    if brotli is not None:
+        encodings.append(("br", f"br-{BROTLI_QUALITY}"))
+    for encoding, title in encodings:
+        compressed, median = timed(lambda: compress_body(body, encoding), rounds)
+        print(f"  compress  {title:<8} median={median * 1000:8.2f} ms  size={len(compressed):>10,} B "
+              f"({len(compressed) / len(body):.1%} of uncompressed)")
+
+
+def main(args):
+    app = Quart(__name__)
+    std = DefaultJSONProvider(app)
+    providers = {"json": lambda obj: std.dumps(obj, separators=(",", ":")).encode("utf-8")}
+    if orjson is not None:
+        providers["orjson"] = OrjsonProvider(app).dumps_bytes
+    else:
+        print("orjson is not installed; only the default provider is measured.")
+    if brotli is None:
+        print("brotli is not installed; only gzip is measured.")
+
+    report_payload(f"/api/admin/subscriptions ({args.rows:,} rows)", subscriptions_page(args.rows),
+                   providers, args.rounds)
+    report_payload(f"/api/public/subscriptions/all ({args.groups} groups)", catalog(args.groups),
+                   providers, args.rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON provider and response compression benchmark")
+    parser.add_argument("--rows", type=int, default=100, help="Rows in the subscriptions page (default: 100)")
+    parser.add_argument("--groups", type=int, default=6, help="Catalog groups, 4 types x 4 plans each (default: 6)")
+    parser.add_argument("--rounds", type=int, default=30)
+    main(parser.parse_args())
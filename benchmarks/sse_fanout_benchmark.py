@@ -0,0 +1,145 @@
+# benchmarks/sse_fanout_benchmark.py
+"""
+قياس محلي لتوزيع أحداث SSE على عدد كبير من الاتصالات المحاكاة.
+
+كل "عقدة" هي SSEBroadcaster مستقل مع ناقل توزيع، وكل اتصال محاكى هو طابور
+يُفرّغ بواسطة مهمة asyncio (بدون شبكة). يقيس الزمن من النشر حتى استلام كل الاتصالات.
+
+أمثلة:
+    python -m benchmarks.sse_fanout_benchmark
+    python -m benchmarks.sse_fanout_benchmark --connections 50000 --nodes 4 --backend redis
+    python -m benchmarks.sse_fanout_benchmark --backend postgres --rounds 5
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from services.sse_broadcaster import SSEBroadcaster
+from services.sse_fanout import LocalFanoutBus, apply_batch, create_fanout_bus
+
+
+class SimulatedNode:
+    def __init__(self, bus):
+        self.broadcaster = SSEBroadcaster()
+        self.bus = bus
+        self.received = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+        self._consumers = []
+
+    async def start(self):
+        await self.bus.start(lambda batch: apply_batch(self.broadcaster, batch))
+
+    def connect(self, telegram_ids):
+        for tg_id in telegram_ids:
+            info = self.broadcaster.subscribe(str(tg_id))
+            self._consumers.append(asyncio.create_task(self._consume(info["queue"])))
+
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            await queue.get()
+            self.received += 1
+            if self.received >= self.expected:
+                self.done.set()
+
+    def arm(self, expected: int):
+        self.received = 0
+        self.expected = expected
+        self.done = asyncio.Event()
+        if expected == 0:
+            self.done.set()
+
+    async def close(self):
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        await self.bus.close()
+
+
+async def build_nodes(backend: str, count: int):
+    nodes = []
+    if backend == "local":
+        if count != 1:
+            raise SystemExit("The local backend cannot fan out between nodes; use --nodes 1.")
+        nodes.append(SimulatedNode(LocalFanoutBus()))
+    else:
+        for _ in range(count):
+            nodes.append(SimulatedNode(await create_fanout_bus(backend)))
+    for node in nodes:
+        await node.start()
+    return nodes
+
+
+async def measure(nodes, publisher, batch: dict, expected_per_node, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        for node, expected in zip(nodes, expected_per_node):
+            node.arm(expected)
+        started = time.perf_counter()
+        await publisher.publish(batch)
+        await asyncio.gather(*(node.done.wait() for node in nodes))
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(label: str, timings, deliveries: int):
+    best = min(timings)
+    print(f"{label:<38} median={statistics.median(timings) * 1000:8.1f} ms  "
+          f"best={best * 1000:8.1f} ms  ({deliveries / best:,.0f} deliveries/s)")
+
+
+async def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    nodes = await build_nodes(args.backend, args.nodes)
+
+    # توزيع الاتصالات على العقد بالتناوب (كما يفعل موازن الحمل)
+    ids_per_node = [[] for _ in nodes]
+    for tg_id in range(1, args.connections + 1):
+        ids_per_node[tg_id % len(nodes)].append(tg_id)
+    connect_started = time.perf_counter()
+    for node, ids in zip(nodes, ids_per_node):
+        node.connect(ids)
+    await asyncio.sleep(0)
+    print(f"Connected {args.connections:,} simulated clients on {len(nodes)} node(s) "
+          f"via '{args.backend}' in {time.perf_counter() - connect_started:.2f}s\n")
+
+    publisher = nodes[0].bus
+    per_node = [len(ids) for ids in ids_per_node]
+    payload = {"id": 1, "title": "benchmark", "message": "x" * args.payload_size}
+
+    timings = await measure(
+        nodes, publisher,
+        {"broadcasts": [{"message_type": "new_notification", "payload": payload, "all_connected": True}]},
+        per_node, args.rounds)
+    report("broadcast to all connected", timings, args.connections)
+
+    targeted = list(range(1, args.connections + 1, 2))
+    timings = await measure(
+        nodes, publisher,
+        {"broadcasts": [{"message_type": "new_notification", "payload": payload, "telegram_ids": targeted}]},
+        [sum(1 for tg_id in ids if tg_id % 2 == 1) for ids in ids_per_node], args.rounds)
+    report(f"publish_many to {len(targeted):,} users", timings, len(targeted))
+
+    events = [{"telegram_id": str(tg_id), "message_type": "unread_update", "payload": {"count": tg_id}}
+              for tg_id in range(1, args.events + 1)]
+    timings = await measure(
+        nodes, publisher, {"events": events},
+        [sum(1 for tg_id in ids if tg_id <= args.events) for ids in ids_per_node], args.rounds)
+    report(f"batch of {len(events):,} single-user events", timings, len(events))
+
+    for node in nodes:
+        await node.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SSE fan-out benchmark with simulated connections")
+    parser.add_argument("--connections", type=int, default=50_000)
+    parser.add_argument("--nodes", type=int, default=1)
+    parser.add_argument("--backend", choices=["local", "redis", "postgres"], default="local")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--events", type=int, default=5_000)
+    parser.add_argument("--payload-size", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -909,7 +909,7 @@ async def fetch_pending_payment_by_payment_token(conn, payment_token: str) -> Op
             SELECT id, telegram_id, subscription_plan_id, payment_token, 
                    username, full_name, user_wallet_address, amount, status
             FROM payments
-            WHERE TRIM(payment_token) = TRIM($1)
+            WHERE payment_token = TRIM($1)
             LIMIT 1;
         """
         row = await conn.fetchrow(sql, payment_token)
@@ -981,6 +981,410 @@ async def update_payment_status_to_manual_check(conn, payment_token: str, error_
         logging.error(f"❌ فشل تحديث حالة الدفع إلى 'failed' لـ {payment_token}: {e}")
 
 
+async def enqueue_renewal_job(
+        connection,
+        idempotency_key: str,
+        payment_token: str,
+        payload: dict,
+        source: str = "ton",
+        delay_seconds: int = 0,
+        max_attempts: int = 6,
+        last_error: Optional[str] = None
+) -> Optional[int]:
+    """
+    إضافة مهمة تجديد إلى الطابور الدائم. مفتاح idempotency_key (tx_hash / payment_token)
+    يضمن عدم تكرار المهمة لنفس الدفعة؛ تُرجع None إذا كانت المهمة موجودة وقيد التنفيذ،
+    بينما تُعاد تهيئة المهمة الفاشلة نهائيًا (مثلاً عند إعادة المحاولة اليدوية من لوحة التحكم).
+    المحاولة الأولى تُحتسب لأنها نُفذت فورًا قبل الإحالة للطابور.
+    """
+    return await connection.fetchval("""
+        INSERT INTO renewal_jobs (
+            idempotency_key, source, payment_token, payload, status,
+            attempts, max_attempts, next_attempt_at, last_error
+        ) VALUES (
+            $1, $2, $3, $4::jsonb, 'queued',
+            1, $5, NOW() + ($6 * INTERVAL '1 second'), $7
+        )
+        ON CONFLICT (idempotency_key) DO UPDATE
+        SET status = 'queued', attempts = 1, payload = EXCLUDED.payload,
+            next_attempt_at = EXCLUDED.next_attempt_at, last_error = EXCLUDED.last_error,
+            updated_at = NOW()
+        WHERE renewal_jobs.status = 'failed'
+        RETURNING id
+    """, idempotency_key, source, payment_token, json.dumps(payload, default=_renewal_payload_default),
+        max_attempts, delay_seconds, last_error)
+
+
+def _renewal_payload_default(value):
+    # Decimal يُحفظ بصيغة صريحة حتى يعود Decimal (وليس نصًا) في أي حقل، بما فيه tier_info المتداخل
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    return str(value)
+
+
+def _renewal_payload_hook(obj: dict):
+    if len(obj) == 1 and "__decimal__" in obj:
+        return Decimal(obj["__decimal__"])
+    return obj
+
+
+async def has_active_renewal_job(connection, payment_token: str) -> bool:
+    """هل توجد مهمة تجديد قيد الانتظار أو التنفيذ لهذه الدفعة (فيتولاها العامل وحده)."""
+    return await connection.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM renewal_jobs
+            WHERE payment_token = $1 AND status IN ('queued', 'running')
+        )
+    """, payment_token)
+
+
+async def claim_due_renewal_jobs(connection, limit: int = 10, stale_after_seconds: int = 600) -> list[dict]:
+    """
+    حجز المهام المستحقة (أو العالقة في running بعد انهيار العامل) باستخدام SKIP LOCKED
+    حتى يمكن تشغيل أكثر من عامل بأمان.
+    """
+    rows = await connection.fetch("""
+        UPDATE renewal_jobs
+        SET status = 'running', attempts = attempts + 1, updated_at = NOW()
+        WHERE id IN (
+            SELECT id FROM renewal_jobs
+            WHERE (status = 'queued' AND next_attempt_at <= NOW())
+               OR (status = 'running' AND updated_at < NOW() - ($2 * INTERVAL '1 second'))
+            ORDER BY next_attempt_at
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, limit, stale_after_seconds)
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        if isinstance(job.get("payload"), str):
+            job["payload"] = json.loads(job["payload"], object_hook=_renewal_payload_hook)
+        jobs.append(job)
+    return jobs
+
+
+async def update_renewal_job(
+        connection,
+        job_id: int,
+        status: str,
+        last_error: Optional[str] = None,
+        delay_seconds: Optional[int] = None
+):
+    """تحديث حالة مهمة التجديد، مع إعادة جدولتها اختياريًا بعد delay_seconds."""
+    await connection.execute("""
+        UPDATE renewal_jobs
+        SET status = $2,
+            last_error = COALESCE($3, last_error),
+            next_attempt_at = CASE WHEN $4::int IS NULL THEN next_attempt_at
+                                   ELSE NOW() + ($4::int * INTERVAL '1 second') END,
+            updated_at = NOW()
+        WHERE id = $1
+    """, job_id, status, last_error, delay_seconds)
+
+
+def _export_job_dict(row) -> Optional[dict]:
+    if row is None:
+        return None
+    job = dict(row)
+    if isinstance(job.get("params"), str):
+        job["params"] = json.loads(job["params"])
+    return job
+
+
+async def enqueue_export_job(
+        connection,
+        export_type: str,
+        export_format: str,
+        params: dict,
+        params_hash: str,
+        requested_by: Optional[str],
+        reuse_seconds: int = 300
+) -> tuple[dict, bool]:
+    """
+    إضافة مهمة تصدير، أو إرجاع مهمة مطابقة (نفس params_hash ونفس requested_by) قيد التنفيذ أو اكتملت
+    خلال reuse_seconds. ترجع (job, reused). القفل الاستشاري على params_hash يمنع إنشاء مهمتين متطابقتين في نفس اللحظة.
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock(hashtext($1))", params_hash)
+        existing = await connection.fetchrow("""
+            SELECT * FROM export_jobs
+            WHERE params_hash = $1
+              AND requested_by IS NOT DISTINCT FROM $3
+              AND (status IN ('queued', 'running')
+                   OR (status = 'completed' AND completed_at > NOW() - ($2 * INTERVAL '1 second')))
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, params_hash, reuse_seconds, requested_by)
+        if existing:
+            return _export_job_dict(existing), True
+
+        row = await connection.fetchrow("""
+            INSERT INTO export_jobs (export_type, export_format, params, params_hash, requested_by)
+            VALUES ($1, $2, $3::jsonb, $4, $5)
+            RETURNING *
+        """, export_type, export_format, json.dumps(params, default=str), params_hash, requested_by)
+        return _export_job_dict(row), False
+
+
+async def claim_next_export_job(connection, stale_after_seconds: int = 1800) -> Optional[dict]:
+    """حجز أقدم مهمة تصدير في الطابور (أو عالقة في running بعد انهيار العامل) باستخدام SKIP LOCKED."""
+    row = await connection.fetchrow("""
+        UPDATE export_jobs
+        SET status = 'running', started_at = NOW(), rows_written = 0, error = NULL, updated_at = NOW()
+        WHERE id = (
+            SELECT id FROM export_jobs
+            WHERE status = 'queued'
+               OR (status = 'running' AND updated_at < NOW() - ($1 * INTERVAL '1 second'))
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, stale_after_seconds)
+    return _export_job_dict(row)
+
+
+async def update_export_job_progress(connection, job_id: int, rows_written: int,
+                                     total_rows: Optional[int] = None):
+    await connection.execute("""
+        UPDATE export_jobs
+        SET rows_written = $2, total_rows = COALESCE($3, total_rows), updated_at = NOW()
+        WHERE id = $1
+    """, job_id, rows_written, total_rows)
+
+
+async def finish_export_job(
+        connection,
+        job_id: int,
+        status: str,
+        file_path: Optional[str] = None,
+        file_size: Optional[int] = None,
+        error: Optional[str] = None
+):
+    """إنهاء مهمة التصدير (completed مع مسار الملف وحجمه، أو failed مع سبب الخطأ)."""
+    await connection.execute("""
+        UPDATE export_jobs
+        SET status = $2, file_path = $3, file_size = $4, error = $5,
+            completed_at = NOW(), updated_at = NOW()
+        WHERE id = $1
+    """, job_id, status, file_path, file_size, error)
+
+
+async def get_export_job(connection, job_id: int, requested_by: Optional[str]) -> Optional[dict]:
+    """مهمة التصدير إذا كان requested_by هو من أنشأها فقط (الملف يحتوي بيانات مستخدمين)."""
+    return _export_job_dict(await connection.fetchrow(
+        "SELECT * FROM export_jobs WHERE id = $1 AND requested_by = $2", job_id, requested_by))
+
+
+async def purge_expired_export_jobs(connection, older_than_seconds: int) -> list[str]:
+    """حذف مهام التصدير المنتهية الأقدم من older_than_seconds وإرجاع مسارات ملفاتها لحذفها من القرص."""
+    rows = await connection.fetch("""
+        DELETE FROM export_jobs
+        WHERE status IN ('completed', 'failed')
+          AND COALESCE(completed_at, created_at) < NOW() - ($1 * INTERVAL '1 second')
+        RETURNING file_path
+    """, older_than_seconds)
+    return [row["file_path"] for row in rows if row["file_path"]]
+
+
+async def enqueue_discount_apply_job(connection, discount_id: int, requested_by: Optional[str]) -> tuple[dict, bool]:
+    """
+    إضافة مهمة تطبيق خصم على المشتركين الحاليين، أو إرجاع مهمة نفس الخصم إذا كانت في الطابور أو قيد التنفيذ.
+    ترجع (job, reused).
+    """
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock(hashtext('discount_apply:' || $1::text))", discount_id)
+        existing = await connection.fetchrow("""
+            SELECT * FROM discount_apply_jobs
+            WHERE discount_id = $1 AND status IN ('queued', 'running')
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, discount_id)
+        if existing:
+            return dict(existing), True
+
+        row = await connection.fetchrow("""
+            INSERT INTO discount_apply_jobs (discount_id, requested_by)
+            VALUES ($1, $2)
+            RETURNING *
+        """, discount_id, requested_by)
+        return dict(row), False
+
+
+async def claim_next_discount_apply_job(connection, stale_after_seconds: int = 900) -> Optional[dict]:
+    """
+    حجز أقدم مهمة في الطابور (أو عالقة بعد انهيار العامل) باستخدام SKIP LOCKED.
+    التقدم (last_user_id) لا يُصفّر، فالمهمة العالقة تكمل من آخر دفعة تم حفظها.
+    """
+    row = await connection.fetchrow("""
+        UPDATE discount_apply_jobs
+        SET status = 'running', started_at = COALESCE(started_at, NOW()), error = NULL, updated_at = NOW()
+        WHERE id = (
+            SELECT id FROM discount_apply_jobs
+            WHERE status = 'queued'
+               OR (status = 'running' AND updated_at < NOW() - ($1 * INTERVAL '1 second'))
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, stale_after_seconds)
+    return dict(row) if row else None
+
+
+_DISCOUNT_TARGET_USERS_SQL = """
+    SELECT DISTINCT ON (s.user_id)
+        s.user_id, u.telegram_id, s.is_active
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.id
+    WHERE u.telegram_id IS NOT NULL AND (
+        ($1::int IS NOT NULL AND s.subscription_plan_id = $1) OR
+        ($1::int IS NULL AND $2::int IS NOT NULL AND s.subscription_type_id = $2)
+    )
+"""
+
+
+async def count_discount_target_users(connection, plan_id: Optional[int], type_id: Optional[int]) -> int:
+    return await connection.fetchval(
+        f"SELECT COUNT(*) FROM ({_DISCOUNT_TARGET_USERS_SQL}) AS target_users", plan_id, type_id) or 0
+
+
+async def apply_discount_chunk(
+        connection,
+        job_id: int,
+        discount_id: int,
+        plan_id: Optional[int],
+        type_id: Optional[int],
+        plan_ids: list[int],
+        locked_prices: list,
+        lose_on_lapse: bool,
+        after_user_id: int,
+        chunk_size: int,
+        grace_hours: int
+) -> dict:
+    """
+    دفعة واحدة (حتى chunk_size مستخدم بعد after_user_id) في معاملة واحدة وجملة SQL واحدة:
+    - user_discounts: INSERT ... SELECT من (المستخدمين × unnest(الخطط، الأسعار المثبتة)) مع ON CONFLICT.
+    - scheduled_tasks: مهام deactivate_discount_grace_period للمستخدمين المنتهية اشتراكاتهم (lose_on_lapse).
+    - تقدم المهمة يُحفظ في نفس المعاملة، فإعادة المحاولة بعد انهيار لا تكرر أي دفعة.
+    """
+    async with connection.transaction():
+        row = await connection.fetchrow(f"""
+            WITH target_users AS (
+                SELECT * FROM ({_DISCOUNT_TARGET_USERS_SQL}
+                      AND s.user_id > $3
+                    ORDER BY s.user_id, s.expiry_date DESC) AS t
+                ORDER BY user_id
+                LIMIT $4
+            ),
+            plans AS (
+                SELECT * FROM unnest($5::int[], $6::numeric[]) AS p(plan_id, locked_price)
+            ),
+            upserted AS (
+                INSERT INTO user_discounts (user_id, discount_id, subscription_plan_id, locked_price, is_active)
+                SELECT tu.user_id, $7, p.plan_id, p.locked_price, true
+                FROM target_users tu
+                CROSS JOIN plans p
+                ON CONFLICT (user_id, subscription_plan_id, is_active) DO UPDATE SET
+                    discount_id = EXCLUDED.discount_id, locked_price = EXCLUDED.locked_price, granted_at = NOW()
+                RETURNING 1
+            ),
+            tasks AS (
+                INSERT INTO scheduled_tasks (task_type, telegram_id, execute_at, status, payload)
+                SELECT 'deactivate_discount_grace_period', tu.telegram_id,
+                       NOW() + ($9::int * INTERVAL '1 hour'), 'pending',
+                       jsonb_build_object('user_id', tu.user_id, 'discount_id', $7::int)
+                FROM target_users tu
+                WHERE $8::boolean AND tu.is_active IS NOT TRUE
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM target_users) AS users,
+                   (SELECT MAX(user_id) FROM target_users) AS last_user_id,
+                   (SELECT COUNT(*) FROM upserted) AS records,
+                   (SELECT COUNT(*) FROM tasks) AS tasks
+        """, plan_id, type_id, after_user_id, chunk_size, plan_ids, locked_prices,
+            discount_id, lose_on_lapse, grace_hours)
+
+        result = dict(row)
+        if result["users"]:
+            await connection.execute("""
+                UPDATE discount_apply_jobs
+                SET processed_users = processed_users + $2,
+                    records_upserted = records_upserted + $3,
+                    tasks_scheduled = tasks_scheduled + $4,
+                    last_user_id = $5,
+                    updated_at = NOW()
+                WHERE id = $1
+            """, job_id, result["users"], result["records"], result["tasks"], result["last_user_id"])
+        return result
+
+
+async def set_discount_apply_job_total(connection, job_id: int, total_users: int):
+    await connection.execute(
+        "UPDATE discount_apply_jobs SET total_users = $2, updated_at = NOW() WHERE id = $1", job_id, total_users)
+
+
+async def finish_discount_apply_job(connection, job_id: int, status: str, error: Optional[str] = None):
+    await connection.execute("""
+        UPDATE discount_apply_jobs
+        SET status = $2, error = $3, completed_at = NOW(), updated_at = NOW()
+        WHERE id = $1
+    """, job_id, status, error)
+
+
+async def get_discount_apply_job(connection, job_id: int) -> Optional[dict]:
+    row = await connection.fetchrow("SELECT * FROM discount_apply_jobs WHERE id = $1", job_id)
+    return dict(row) if row else None
+
+
+async def fetch_reconciliation_candidates(
+        conn,
+        limit: int = 500,
+        statuses: tuple[str, ...] = ("pending", "manual_check")
+) -> list[dict]:
+    """
+    جلب المعاملات الواردة غير المعالجة التي تطابق دفعة معلقة (أو بحاجة لمراجعة) عبر payment_token.
+    يعتمد على idx_incoming_processed و idx_payments_token لتجنب المسح الكامل.
+    المطابقة بنفس شرط fetch_pending_payment_by_payment_token (TRIM على الرمز الوارد)، وتُستثنى الدفعات
+    التي لها مهمة في طابور التجديد لأن العامل هو من يكمل تجديدها.
+    """
+    query = """
+        SELECT
+            it.txhash, it.sender_address, it.amount AS amount_received, it.received_at,
+            p.id AS payment_id, p.payment_token, p.telegram_id, p.amount AS expected_amount, p.status
+        FROM incoming_transactions it
+        JOIN payments p ON p.payment_token = TRIM(it.payment_token)
+        WHERE it.processed = FALSE
+          AND p.status = ANY($1::text[])
+          AND NOT EXISTS (
+              SELECT 1 FROM renewal_jobs rj
+              WHERE rj.payment_token = p.payment_token AND rj.status IN ('queued', 'running')
+          )
+        ORDER BY it.received_at ASC
+        LIMIT $2
+    """
+    rows = await conn.fetch(query, list(statuses), limit)
+    return [dict(row) for row in rows]
+
+
+async def count_unmatched_incoming_transactions(conn) -> int:
+    """
+    عدد المعاملات الواردة غير المعالجة التي لا تملك دفعة قابلة للمطابقة (لأغراض التقرير).
+    """
+    return await conn.fetchval("""
+        SELECT COUNT(*)
+        FROM incoming_transactions it
+        WHERE it.processed = FALSE
+          AND NOT EXISTS (
+              SELECT 1 FROM payments p
+              WHERE p.payment_token = TRIM(it.payment_token)
+                AND p.status IN ('pending', 'manual_check')
+          )
+    """) or 0
+
+
 async def get_all_channel_ids_for_type(connection, subscription_type_id: int) -> list[int]:
     """
     🔹 جلب كل معرفات القنوات (الرئيسية والفرعية) المرتبطة بنوع اشتراك معين.
@@ -993,6 +1397,64 @@ async def get_all_channel_ids_for_type(connection, subscription_type_id: int) ->
         logging.error(f"❌ Error fetching all channel IDs for subscription_type_id {subscription_type_id}: {e}")
         return []
 
+async def get_subscription_status_counts(connection, subscription_type_id: Optional[int] = None) -> dict:
+    """
+    إحصائيات حالات الاشتراكات (الكل أو لنوع واحد) من subscription_status_rollup بدل COUNT على كل الاشتراكات.
+    الجدول يحفظ العدد لكل (نوع، is_active، يوم الانتهاء UTC) ويتحدث عبر triggers، والحالة تُحدد هنا حسب NOW():
+    الأيام الكاملة تُصنف من الجدول، ويوما الحد (اليوم واليوم + 7) يُعدّان بدقة من subscriptions عبر فهرس expiry_date.
+    التصنيف مطابق لـ status_label في /subscriptions.
+    """
+    row = await connection.fetchrow("""
+        WITH bounds AS (
+            SELECT NOW() AS now_ts,
+                   (NOW() AT TIME ZONE 'UTC')::date AS today,
+                   ((NOW() + INTERVAL '7 days') AT TIME ZONE 'UTC')::date AS soon_day
+        ),
+        rolled AS (
+            SELECT r.subscriptions_count AS n,
+                   CASE
+                       WHEN r.expiry_day < b.today THEN 'expired'
+                       WHEN r.expiry_day = b.today THEN NULL
+                       WHEN NOT r.is_active THEN 'inactive'
+                       WHEN r.expiry_day < b.soon_day THEN 'expiring_soon'
+                       WHEN r.expiry_day > b.soon_day THEN 'active'
+                   END AS status_label
+            FROM subscription_status_rollup r, bounds b
+            WHERE $1::int IS NULL OR r.subscription_type_id = $1
+        ),
+        boundary AS (
+            SELECT 1 AS n,
+                   CASE
+                       WHEN s.expiry_date <= b.now_ts THEN 'expired'
+                       WHEN NOT s.is_active THEN 'inactive'
+                       WHEN s.expiry_date <= b.now_ts + INTERVAL '7 days' THEN 'expiring_soon'
+                       ELSE 'active'
+                   END AS status_label
+            FROM subscriptions s, bounds b
+            WHERE ($1::int IS NULL OR s.subscription_type_id = $1)
+              AND (
+                  (s.expiry_date >= b.today::timestamp AT TIME ZONE 'UTC'
+                   AND s.expiry_date < (b.today + 1)::timestamp AT TIME ZONE 'UTC')
+                  OR (s.is_active IS DISTINCT FROM FALSE
+                      AND s.expiry_date >= b.soon_day::timestamp AT TIME ZONE 'UTC'
+                      AND s.expiry_date < (b.soon_day + 1)::timestamp AT TIME ZONE 'UTC')
+              )
+        ),
+        counted AS (
+            SELECT n, status_label FROM rolled WHERE status_label IS NOT NULL
+            UNION ALL
+            SELECT n, status_label FROM boundary
+        )
+        SELECT COALESCE(SUM(n), 0)::bigint AS total_records,
+               COALESCE(SUM(n) FILTER (WHERE status_label = 'active'), 0)::bigint AS active_count,
+               COALESCE(SUM(n) FILTER (WHERE status_label = 'expired'), 0)::bigint AS expired_count,
+               COALESCE(SUM(n) FILTER (WHERE status_label = 'expiring_soon'), 0)::bigint AS expiring_soon_count,
+               COALESCE(SUM(n) FILTER (WHERE status_label = 'inactive'), 0)::bigint AS inactive_count
+        FROM counted
+    """, subscription_type_id)
+    return dict(row)
+
+
 async def get_reminder_settings(connection):
     """
     🔹 جلب إعدادات التذكيرات من قاعدة البيانات.
@@ -1006,15 +1468,87 @@ async def get_reminder_settings(connection):
         logging.error(f"❌ Error fetching reminder settings: {e}")
         return None
 
+# --- الإشعارات العامة (Copy-on-read) ---
+# الإشعار العام يُخزن كصف واحد في notifications (is_public = TRUE) ولا يُنسخ لكل مستخدم.
+# حالة القراءة لكل مستخدم = علامة مائية (كل إشعار عام id <= last_read_notification_id مقروء)
+# + استثناءات فردية في public_notification_reads. يرى المستخدم الإشعارات العامة المنشورة بعد تسجيله فقط
+# (المستخدم بدون created_at يُعامل كمسجل منذ البداية، فيرى كل الإشعارات العامة).
+# الإشعارات العامة القديمة التي نُسخت سابقًا إلى user_notifications تُستبعد هنا وتُعرض كصفوف خاصة.
+
+PUBLIC_NOTIFICATIONS_VIEWER_CTE = """
+    viewer AS (
+        SELECT u.telegram_id,
+               COALESCE(u.created_at, '-infinity'::timestamptz) AS joined_at,
+               COALESCE(w.last_read_notification_id, 0) AS watermark
+        FROM users u
+        LEFT JOIN public_notification_watermarks w ON w.telegram_id = u.telegram_id
+        WHERE u.telegram_id = $1
+    )
+"""
+
+PUBLIC_NOTIFICATIONS_FOR_VIEWER = """
+    SELECT n.id, n.type, n.title, n.message, n.extra_data, n.created_at,
+           (n.id <= viewer.watermark OR r.notification_id IS NOT NULL) AS read_status
+    FROM viewer
+    JOIN notifications n ON n.is_public = TRUE AND n.created_at >= viewer.joined_at
+     AND NOT EXISTS (SELECT 1 FROM user_notifications un WHERE un.notification_id = n.id AND un.telegram_id = viewer.telegram_id)
+    LEFT JOIN public_notification_reads r
+           ON r.notification_id = n.id AND r.telegram_id = viewer.telegram_id
+"""
+
+
+async def get_unread_notifications_counts(connection, telegram_ids: list) -> dict:
+    """
+    إرجاع عدد الإشعارات غير المقروءة لعدة مستخدمين في استعلام واحد {telegram_id: count}.
+    الخاصة تُقرأ من user_notification_counters التي تحدّثها triggers على user_notifications،
+    ويُضاف إليها عدد الإشعارات العامة الأحدث من العلامة المائية لكل مستخدم.
+    """
+    rows = await connection.fetch("""
+        SELECT ids.telegram_id,
+               COALESCE(GREATEST(c.unread_count, 0), 0) + COALESCE(pub.unread_count, 0) AS unread_count
+        FROM unnest($1::bigint[]) AS ids(telegram_id)
+        LEFT JOIN user_notification_counters c ON c.telegram_id = ids.telegram_id
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*) AS unread_count
+            FROM users u
+            LEFT JOIN public_notification_watermarks w ON w.telegram_id = u.telegram_id
+            JOIN notifications n
+              ON n.is_public = TRUE
+             AND n.id > COALESCE(w.last_read_notification_id, 0)
+             AND n.created_at >= COALESCE(u.created_at, '-infinity'::timestamptz)
+             AND NOT EXISTS (SELECT 1 FROM user_notifications un WHERE un.notification_id = n.id AND un.telegram_id = u.telegram_id)
+            WHERE u.telegram_id = ids.telegram_id
+              AND NOT EXISTS (
+                  SELECT 1 FROM public_notification_reads r
+                  WHERE r.telegram_id = u.telegram_id AND r.notification_id = n.id
+              )
+        ) pub ON TRUE
+    """, list(telegram_ids))
+    counts = {tg_id: 0 for tg_id in telegram_ids}
+    counts.update({row["telegram_id"]: row["unread_count"] for row in rows})
+    return counts
+
+
 async def get_unread_notifications_count(connection, telegram_id: int) -> int:
     """
-    إرجاع عدد الإشعارات غير المقروءة للمستخدم.
+    إرجاع عدد الإشعارات غير المقروءة للمستخدم: عدّاد الإشعارات الخاصة (O(1))
+    + الإشعارات العامة غير المقروءة الأحدث من العلامة المائية.
     """
     try:
-        query = """
-            SELECT COUNT(*) AS unread_count
-            FROM user_notifications
-            WHERE telegram_id = $1 AND read_status = FALSE;
+        query = f"""
+            WITH {PUBLIC_NOTIFICATIONS_VIEWER_CTE}
+            SELECT
+                COALESCE((SELECT GREATEST(unread_count, 0) FROM user_notification_counters
+                          WHERE telegram_id = $1), 0)
+                + (SELECT COUNT(*)
+                   FROM viewer
+                   JOIN notifications n
+                     ON n.is_public = TRUE AND n.id > viewer.watermark AND n.created_at >= viewer.joined_at
+                    AND NOT EXISTS (SELECT 1 FROM user_notifications un WHERE un.notification_id = n.id AND un.telegram_id = viewer.telegram_id)
+                   WHERE NOT EXISTS (
+                       SELECT 1 FROM public_notification_reads r
+                       WHERE r.telegram_id = viewer.telegram_id AND r.notification_id = n.id
+                   )) AS unread_count;
         """
         result = await connection.fetchrow(query, telegram_id)
         return result["unread_count"] if result else 0
@@ -1023,6 +1557,76 @@ async def get_unread_notifications_count(connection, telegram_id: int) -> int:
         return 0
 
 
+async def get_public_notification_for_user(connection, telegram_id: int, notification_id: int):
+    """
+    إرجاع إشعار عام واحد مع حالة القراءة المحسوبة للمستخدم، أو None إذا لم يكن مرئيًا له.
+    """
+    query = f"""
+        WITH {PUBLIC_NOTIFICATIONS_VIEWER_CTE}
+        {PUBLIC_NOTIFICATIONS_FOR_VIEWER}
+        WHERE n.id = $2
+    """
+    return await connection.fetchrow(query, telegram_id, notification_id)
+
+
+async def mark_public_notification_read(connection, telegram_id: int, notification_id: int) -> bool:
+    """
+    تسجيل قراءة إشعار عام واحد كاستثناء فوق العلامة المائية.
+    يُرجع True فقط إذا كان الإشعار مرئيًا للمستخدم وغير مقروء قبل ذلك.
+    """
+    inserted = await connection.fetchval(f"""
+        WITH {PUBLIC_NOTIFICATIONS_VIEWER_CTE}
+        INSERT INTO public_notification_reads (telegram_id, notification_id)
+        SELECT viewer.telegram_id, n.id
+        FROM viewer
+        JOIN notifications n
+          ON n.id = $2 AND n.is_public = TRUE
+         AND n.id > viewer.watermark AND n.created_at >= viewer.joined_at
+        ON CONFLICT (telegram_id, notification_id) DO NOTHING
+        RETURNING 1
+    """, telegram_id, notification_id)
+    return inserted is not None
+
+
+async def mark_public_notifications_read_by_type(connection, telegram_id: int, notification_type: str) -> int:
+    """
+    تسجيل قراءة كل الإشعارات العامة غير المقروءة من نوع معين (المحصورة بعد العلامة المائية فقط).
+    """
+    result = await connection.execute(f"""
+        WITH {PUBLIC_NOTIFICATIONS_VIEWER_CTE}
+        INSERT INTO public_notification_reads (telegram_id, notification_id)
+        SELECT viewer.telegram_id, n.id
+        FROM viewer
+        JOIN notifications n
+          ON n.is_public = TRUE AND n.type = $2
+         AND n.id > viewer.watermark AND n.created_at >= viewer.joined_at
+        ON CONFLICT (telegram_id, notification_id) DO NOTHING
+    """, telegram_id, notification_type)
+    return int(result.split()[-1]) if result else 0
+
+
+async def advance_public_notifications_watermark(connection, telegram_id: int):
+    """
+    تحديد كل الإشعارات العامة الحالية كمقروءة بتحريك العلامة المائية لآخر إشعار عام،
+    ثم حذف الاستثناءات الفردية التي أصبحت مغطاة بها.
+    """
+    watermark = await connection.fetchval("""
+        INSERT INTO public_notification_watermarks (telegram_id, last_read_notification_id, updated_at)
+        SELECT $1, COALESCE(MAX(id), 0), NOW() FROM notifications WHERE is_public = TRUE
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET last_read_notification_id = GREATEST(
+                public_notification_watermarks.last_read_notification_id,
+                EXCLUDED.last_read_notification_id),
+            updated_at = NOW()
+        RETURNING last_read_notification_id
+    """, telegram_id)
+    await connection.execute(
+        "DELETE FROM public_notification_reads WHERE telegram_id = $1 AND notification_id <= $2",
+        telegram_id, watermark
+    )
+    return watermark
+
+
 async def link_user_gmail(connection, telegram_id: int, gmail: str) -> bool:
     """
     يقوم بربط أو تحديث البريد الإلكتروني (gmail) لمستخدم موجود بالفعل.
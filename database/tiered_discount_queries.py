@@ -6,6 +6,9 @@ from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timezone
 from dateutil.relativedelta import relativedelta
 
+from utils.catalog_cache import CATALOG_KEY
+from utils.settings_cache import notify_settings_changed
+
 
 # ⭐ تعديل: الدالة أصبحت أكثر مرونة وتقبل البيانات الجديدة (نسخة مدمجة)
 async def create_tiered_discount(conn, discount_data: dict, tiers_data: List[dict]) -> dict:
@@ -145,6 +148,9 @@ async def update_discount_tiers(conn, discount_id: int, new_tiers_data: List[Dic
             tier.get('fake_count_value')
         )
 
+    # discount_tiers بلا trigger إبطال، فنُبطل لقطة الكتالوج العام صراحةً
+    await notify_settings_changed(conn, CATALOG_KEY)
+
 
 async def get_current_active_tier(conn, discount_id: int) -> Optional[Dict]:
     """
@@ -212,6 +218,8 @@ async def claim_tiered_discount_slot(conn, discount_id: int) -> Tuple[bool, Opti
             "UPDATE discount_tiers SET used_slots = $1 WHERE id = $2",
             new_used_slots, current_tier['id']
         )
+        # المقاعد المتبقية تظهر في /subscription-plans
+        await notify_settings_changed(conn, CATALOG_KEY)
 
         # إذا امتلأ هذا المستوى، قم بتعطيله وتفعيل المستوى التالي إن وجد
         if new_used_slots >= current_tier['max_slots']:
@@ -15,7 +15,7 @@ from dataclasses import asdict
 from functools import wraps
 import jwt
 from imagekitio import ImageKit
-from utils.permissions import permission_required, owner_required, log_action
+from utils.permissions import permission_required, owner_required, log_action, invalidate_permissions
 import asyncpg
 import asyncio
 import io
@@ -27,15 +27,39 @@ from utils.db_utils import remove_users_from_channel, generate_channel_invite_li
 from database.db_queries import (
     add_user,
     add_subscription,
-    add_scheduled_task,
     cancel_subscription_db,
     delete_scheduled_tasks_for_subscription,
-    get_failed_payment_for_retry
+    get_failed_payment_for_retry,
+    get_subscription_status_counts,
+    enqueue_export_job,
+    get_export_job,
+    enqueue_discount_apply_job,
+    get_discount_apply_job
 )
 from database.db_queries import update_subscription as update_subscription_db
 from database.tiered_discount_queries import create_tiered_discount, update_discount_tiers
 from utils.messaging_batch import FailedSendDetail
+from services.payment_reconciliation import PaymentReconciliationService, RECONCILIATION_BATCH_LIMIT
+from utils.settings_cache import settings_cache, notify_settings_changed
+from utils.audience_segments import audience_segments, preview_segment_users
 from utils.discount_utils import calculate_discounted_price
+from utils.pagination import KeysetPage, keyset_requested
+from utils.user_search import user_search_condition
+from utils.export_stream import (
+    EXPORT_MIMETYPES,
+    parse_export_format,
+    streaming_export_response,
+    streaming_ndjson_response
+)
+from services.export_jobs import EXPORT_JOB_REUSE_SECONDS, export_params_hash
+from services.discount_apply_jobs import fetch_applicable_plans
+from services.subscription_analytics import (
+    DEFAULT_GRACE_DAYS,
+    MAX_GRACE_DAYS,
+    get_churn_by_source,
+    get_cohort_retention,
+    get_renewal_rates
+)
 
 
 # وظيفة لإنشاء اتصال بقاعدة البيانات
@@ -49,6 +73,8 @@ load_dotenv()
 admin_routes = Blueprint("admin_routes", __name__, url_prefix="/api/admin")
 LOCAL_TZ = pytz.timezone(os.getenv("LOCAL_TZ", "Asia/Riyadh"))
 IS_DEVELOPMENT = os.getenv("FLASK_ENV", "production") == "development"
+# بحث /subscriptions وتصديرها باسم نوع الاشتراك: معرفات الأنواع المطابقة أولًا (جدول صغير)، ثم فهرس subscription_type_id
+_SUBSCRIPTION_TYPE_NAME_SEARCH = "subscription_type_id = ANY(ARRAY(SELECT id FROM subscription_types WHERE name ILIKE {param}))"
 
 
 # --- دالة مساعدة لحساب التواريخ (مستحسنة) ---
@@ -163,6 +189,7 @@ async def create_user_with_role():
                    VALUES ($1, $2, $3, $4, $5) RETURNING id""",
                 email, display_name, role_id, tg_id_val, receives_notifications
             )
+            await invalidate_permissions(connection)
 
             # --- التعديل: تحديث تفاصيل التسجيل ---
             await log_action(
@@ -209,6 +236,7 @@ async def update_panel_user(user_id: int):
                WHERE id = $5""",
             display_name, role_id, tg_id_val, receives_notifications, user_id
         )
+        await invalidate_permissions(connection)
         await log_action(current_user_data["email"], "UPDATE_USER", "user", str(user_id), data)
 
     return jsonify({"message": "User updated successfully"}), 200
@@ -297,6 +325,7 @@ async def remove_user_by_id(user_id_to_delete: int):
 
             # تنفيذ الحذف
             await connection.execute("DELETE FROM panel_users WHERE id = $1", user_id_to_delete)
+            await invalidate_permissions(connection)
 
             await log_action(
                 current_user_data["email"],
@@ -320,66 +349,71 @@ async def get_users_endpoint():
         offset = (page - 1) * page_size
         search_term = request.args.get("search", "").strip()
 
+        # وضع المؤشر الاختياري (after=) بدل OFFSET للتمرير العميق
+        # u.id فريد، فهو عمود الترتيب وحده بدون كسر تعادل
+        keyset = KeysetPage(request.args.get("after"), "id", "u.id", "integer") \
+            if keyset_requested(request.args) else None
+
         order_by_clause = "ORDER BY u.id DESC"
+        cursor_select_sql = f", {keyset.select_sql()}" if keyset else ""
 
-        base_query_select = """
+        base_query_select = f"""
             SELECT u.id, u.telegram_id, u.username, u.full_name, 
                    u.wallet_address, u.ton_wallet_address, u.wallet_app,
-                   (SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id) as subscription_count,
-                   (SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id AND s.is_active = true) as active_subscription_count
+                   COALESCE(uss.total_subscriptions, 0) as subscription_count,
+                   COALESCE(uss.active_subscriptions, 0) as active_subscription_count
+                   {cursor_select_sql}
             FROM users u
+            LEFT JOIN user_subscription_stats uss ON uss.telegram_id = u.telegram_id
         """
         count_base_query_select = "SELECT COUNT(u.id) as total FROM users u"
 
         where_clauses = ["1=1"]
         where_params = []
 
-        if search_term:
-            search_pattern = f"%{search_term}%"
-            search_conditions = [
-                f"u.telegram_id::TEXT ILIKE ${len(where_params) + 1}",
-                f"u.full_name ILIKE ${len(where_params) + 1}",
-                f"u.username ILIKE ${len(where_params) + 1}"
-            ]
-            current_param_idx = len(where_params)
-            search_conditions_sql = []
-
-            search_conditions_sql.append(f"u.telegram_id::TEXT ILIKE ${current_param_idx + 1}")
-            where_params.append(search_pattern)
-            current_param_idx += 1
-
-            search_conditions_sql.append(f"u.full_name ILIKE ${current_param_idx + 1}")
-            where_params.append(search_pattern)
-            current_param_idx += 1
-
-            search_conditions_sql.append(f"u.username ILIKE ${current_param_idx + 1}")
-            where_params.append(search_pattern)
-            # current_param_idx += 1 # لا حاجة للزيادة هنا
-
-            where_clauses.append(f"({' OR '.join(search_conditions_sql)})")
+        search_sql = user_search_condition(search_term, where_params)
+        if search_sql:
+            where_clauses.append(search_sql)
 
         where_sql = " AND ".join(where_clauses) if len(where_clauses) > 1 else where_clauses[0]
 
         query_final_params = list(where_params)
-        query = f"""
-            {base_query_select}
-            WHERE {where_sql}
-            {order_by_clause}
-            LIMIT ${len(query_final_params) + 1} OFFSET ${len(query_final_params) + 2}
-        """
-        query_final_params.extend([page_size, offset])
+        if keyset:
+            keyset_where = keyset.where_sql(query_final_params)
+            query = f"""
+                {base_query_select}
+                WHERE {where_sql}{f" AND {keyset_where}" if keyset_where else ""}
+                {keyset.order_by_sql()}
+                LIMIT ${len(query_final_params) + 1}
+            """
+            query_final_params.append(page_size)
+        else:
+            query = f"""
+                {base_query_select}
+                WHERE {where_sql}
+                {order_by_clause}
+                LIMIT ${len(query_final_params) + 1} OFFSET ${len(query_final_params) + 2}
+            """
+            query_final_params.extend([page_size, offset])
 
         count_query = f"{count_base_query_select} WHERE {where_sql}"
 
         items_data = []
         total_records = 0
+        next_cursor = None
 
         async with current_app.db_pool.acquire() as conn:
             rows = await conn.fetch(query, *query_final_params)
             items_data = [dict(row) for row in rows]
+            if keyset:
+                next_cursor = keyset.next_cursor(items_data, page_size)
 
-            count_row = await conn.fetchrow(count_query, *where_params)
-            total_records = count_row['total'] if count_row and count_row['total'] is not None else 0
+            # في وضع المؤشر يُحسب الإجمالي في الصفحة الأولى فقط
+            if keyset is None or keyset.is_first_page:
+                count_row = await conn.fetchrow(count_query, *where_params)
+                total_records = count_row['total'] if count_row and count_row['total'] is not None else 0
+            else:
+                total_records = None
 
         # الإحصائية هنا هي نفسها إجمالي عدد المستخدمين المطابقين للبحث
         users_stat_count = total_records
@@ -389,7 +423,8 @@ async def get_users_endpoint():
             "total": total_records,  # تم التغيير من total_count
             "page": page,
             "page_size": page_size,
-            "users_count": users_stat_count  # إحصائية بسيطة
+            "users_count": users_stat_count,  # إحصائية بسيطة
+            "next_cursor": next_cursor
         })
 
     except ValueError as ve:
@@ -1878,7 +1913,30 @@ async def get_discounts():
         return jsonify({"error": "Internal server error"}), 500
 
 
-# 4. تطبيق خصم على المشتركين الحاليين (النسخة المعدلة بالكامل)
+# 4. تطبيق خصم على المشتركين الحاليين (مهمة خلفية على دفعات)
+def _serialize_discount_apply_job(job: dict) -> dict:
+    total_users = job.get("total_users")
+    progress = None
+    if job["status"] == "completed":
+        progress = 100.0
+    elif total_users:
+        progress = round(min(job["processed_users"] / total_users, 1) * 100, 1)
+    return {
+        "job_id": job["id"],
+        "discount_id": job["discount_id"],
+        "status": job["status"],
+        "total_users": total_users,
+        "users_affected": job["processed_users"],
+        "discounts_created_or_updated": job["records_upserted"],
+        "deactivation_tasks_scheduled": job["tasks_scheduled"],
+        "progress": progress,
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "completed_at": job["completed_at"].isoformat() if job.get("completed_at") else None,
+        "status_url": f"/api/admin/discount-apply-jobs/{job['id']}",
+    }
+
+
 @admin_routes.route("/discounts/<int:discount_id>/apply-to-existing", methods=["POST"])
 @permission_required("discounts.apply")
 async def apply_discount_to_existing_users(discount_id: int):
@@ -1886,123 +1944,52 @@ async def apply_discount_to_existing_users(discount_id: int):
     تطبيق خصم على المستخدمين الذين لديهم اشتراكات حالية (نشطة أو منتهية).
     - يمنح الخصم لجميع الخطط المتاحة ضمن نطاق الخصم.
     - إذا كان اشتراك المستخدم منتهيًا والخصم من النوع 'lose_on_lapse',
-      سيتم جدولة مهمة لإلغاء الخصم بعد 48 ساعة (بدون إرسال تنبيه).
+      سيتم جدولة مهمة لإلغاء الخصم بعد 168 ساعة (بدون إرسال تنبيه).
+    التطبيق الفعلي يتم في الخلفية (DiscountApplyWorker) على دفعات، ويرجع المسار 202 مع معرف المهمة
+    لمتابعة التقدم عبر GET /discount-apply-jobs/<job_id>.
     """
     try:
-        # لم نعد نحتاج كائن البوت في هذه الدالة
-        # bot = current_app.bot
-
         async with current_app.db_pool.acquire() as connection:
-            async with connection.transaction():
-                # --- الخطوة 1: جلب تفاصيل الخصم (لا تغيير) ---
-                discount = await connection.fetchrow("SELECT * FROM discounts WHERE id = $1", discount_id)
-                if not discount:
-                    return jsonify({"error": "Discount not found"}), 404
-                if discount['target_audience'] != 'existing_subscribers':
-                    return jsonify(
-                        {"error": "This function is only for discounts targeting 'existing_subscribers'."}), 400
-
-                discount_type_id = discount.get('applicable_to_subscription_type_id')
-                discount_plan_id = discount.get('applicable_to_subscription_plan_id')
-                if not discount_type_id and not discount_plan_id:
-                    return jsonify({"error": "Discount must be applicable to a specific type or plan."}), 400
-
-                # --- الخطوة 2: جلب المستخدمين المستهدفين (لا تغيير) ---
-                target_users_query = """
-                    SELECT DISTINCT ON (s.user_id)
-                        s.user_id, u.telegram_id, s.is_active
-                    FROM subscriptions s
-                    JOIN users u ON s.user_id = u.id
-                    WHERE u.telegram_id IS NOT NULL AND (
-                        ($1::int IS NOT NULL AND s.subscription_plan_id = $1) OR
-                        ($1::int IS NULL AND $2::int IS NOT NULL AND s.subscription_type_id = $2)
-                    )
-                    ORDER BY s.user_id, s.expiry_date DESC;
-                """
-                target_user_records = await connection.fetch(target_users_query, discount_plan_id, discount_type_id)
-
-                if not target_user_records:
-                    return jsonify({"message": "No users (active or expired) found for the target scope.",
-                                    "applied_count": 0}), 200
+            discount = await connection.fetchrow("SELECT * FROM discounts WHERE id = $1", discount_id)
+            if not discount:
+                return jsonify({"error": "Discount not found"}), 404
+            if discount['target_audience'] != 'existing_subscribers':
+                return jsonify(
+                    {"error": "This function is only for discounts targeting 'existing_subscribers'."}), 400
+
+            discount_type_id = discount.get('applicable_to_subscription_type_id')
+            discount_plan_id = discount.get('applicable_to_subscription_plan_id')
+            if not discount_type_id and not discount_plan_id:
+                return jsonify({"error": "Discount must be applicable to a specific type or plan."}), 400
+
+            if not await fetch_applicable_plans(connection, discount_plan_id, discount_type_id):
+                return jsonify({"error": "No active plans found that match the discount's scope."}), 404
+
+            current_user_data = await get_current_user()
+            job, reused = await enqueue_discount_apply_job(connection, discount_id, current_user_data["email"])
+
+        if not reused and current_app.discount_apply_worker:
+            current_app.discount_apply_worker.wake()
+        logging.info(f"Discount {discount_id} apply-to-existing job {job['id']} "
+                     f"{'already in progress' if reused else 'queued'}.")
+        return jsonify({**_serialize_discount_apply_job(job), "reused": reused}), 202
 
-                # --- الخطوة 3: جلب الخطط المتاحة (لا تغيير) ---
-                applicable_plans_query = """
-                    SELECT id as plan_id, price as plan_price
-                    FROM subscription_plans
-                    WHERE is_active = true AND (
-                        ($1::int IS NOT NULL AND id = $1) OR
-                        ($1::int IS NULL AND $2::int IS NOT NULL AND subscription_type_id = $2)
-                    );
-                """
-                applicable_plans = await connection.fetch(applicable_plans_query, discount_plan_id, discount_type_id)
-                if not applicable_plans:
-                    return jsonify({"error": "No active plans found that match the discount's scope."}), 404
-
-                # --- الخطوة 4: تجهيز البيانات وإدارة المهام (لا تغيير) ---
-                records_to_insert = []
-                tasks_to_schedule = []
-
-                for user_record in target_user_records:
-                    user_id = user_record['user_id']
-                    for plan in applicable_plans:
-                        locked_price = calculate_discounted_price(
-                            plan['plan_price'], discount['discount_type'], discount['discount_value']
-                        )
-                        records_to_insert.append(
-                            (user_id, discount_id, plan['plan_id'], locked_price)
-                        )
-
-                    is_user_active = user_record['is_active']
-                    if not is_user_active and discount['lose_on_lapse']:
-                        tasks_to_schedule.append({
-                            'telegram_id': user_record['telegram_id'],
-                            'user_id': user_id,
-                        })
-
-                # --- الخطوة 5: تنفيذ الإضافة دفعة واحدة (لا تغيير) ---
-                insert_query = """
-                    INSERT INTO user_discounts (user_id, discount_id, subscription_plan_id, locked_price, is_active)
-                    VALUES ($1, $2, $3, $4, true)
-                    ON CONFLICT (user_id, subscription_plan_id, is_active) DO UPDATE SET
-                        discount_id = EXCLUDED.discount_id, locked_price = EXCLUDED.locked_price, granted_at = NOW();
-                """
-                if records_to_insert:
-                    await connection.executemany(insert_query, records_to_insert)
-
-                # --- ⭐ الخطوة 6: جدولة مهام الإلغاء فقط (بدون إرسال رسائل) ---
-                for task_info in tasks_to_schedule:
-                    # 1. تم حذف جزء إرسال الرسالة
-
-                    # 2. جدولة مهمة الإلغاء
-                    deactivation_time = datetime.now(timezone.utc) + timedelta(hours=168)
-                    await add_scheduled_task(
-                        connection=connection,
-                        task_type="deactivate_discount_grace_period",
-                        telegram_id=task_info['telegram_id'],
-                        execute_at=deactivation_time,
-                        payload={'user_id': task_info['user_id'], 'discount_id': discount_id},
-                        clean_up=False
-                    )
-
-                total_applied_count = len(records_to_insert)
-                users_affected = len(target_user_records)
-                tasks_scheduled_count = len(tasks_to_schedule)
-
-                logging.info(
-                    f"Applied discount {discount_id} to {users_affected} users. "
-                    f"Total records created/updated: {total_applied_count}. "
-                    f"Scheduled {tasks_scheduled_count} deactivation tasks for lapsed users (without sending notifications)."
-                )
+    except Exception as e:
+        logging.error(f"Error applying discount {discount_id} to existing users: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
 
-                return jsonify({
-                    "message": f"Successfully processed discount for {users_affected} users. A total of {total_applied_count} discount records were created/updated.",
-                    "users_affected": users_affected,
-                    "discounts_created_or_updated": total_applied_count,
-                    "deactivation_tasks_scheduled": tasks_scheduled_count
-                }), 200
 
+@admin_routes.route("/discount-apply-jobs/<int:job_id>", methods=["GET"])
+@permission_required("discounts.apply")
+async def get_discount_apply_job_status(job_id: int):
+    try:
+        async with current_app.db_pool.acquire() as conn:
+            job = await get_discount_apply_job(conn, job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(_serialize_discount_apply_job(job)), 200
     except Exception as e:
-        logging.error(f"Error applying discount {discount_id} to existing users: {e}", exc_info=True)
+        logging.error(f"Error fetching discount apply job {job_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
 
@@ -2161,9 +2148,11 @@ async def get_subscriptions_merged_endpoint():
             where_clauses.append(f"status_label = ${len(query_params)}")
 
         # Type filter
+        type_filter_id = None
         if type_filter_id_str and type_filter_id_str != "all":
             try:
-                query_params.append(int(type_filter_id_str))
+                type_filter_id = int(type_filter_id_str)
+                query_params.append(type_filter_id)
                 where_clauses.append(f"subscription_type_id = ${len(query_params)}")
             except ValueError:
                 pass
@@ -2200,16 +2189,12 @@ async def get_subscriptions_merged_endpoint():
                 return jsonify({"error": "Invalid end_date format. Please use YYYY-MM-DD."}), 400
 
         # Search term filter
-        if search_term:
-            query_params.append(f"%{search_term}%")
-            search_param_index = len(query_params)
-            where_clauses.append(f"""(
-                       full_name ILIKE ${search_param_index} OR 
-                       username ILIKE ${search_param_index} OR 
-                       telegram_id::TEXT ILIKE ${search_param_index} OR 
-                       payment_token ILIKE ${search_param_index} OR
-                       subscription_type_name ILIKE ${search_param_index}
-                   )""")
+        search_sql = user_search_condition(
+            search_term, query_params,
+            telegram_id_col="telegram_id", users_lookup=True, extra_cols=("payment_token",),
+            extra_predicates=(_SUBSCRIPTION_TYPE_NAME_SEARCH,))
+        if search_sql:
+            where_clauses.append(search_sql)
 
         where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
 
@@ -2225,12 +2210,47 @@ async def get_subscriptions_merged_endpoint():
         order_by_column = allowed_sort_columns.get(sort_by, "fs.created_at")
         order_by_clause = f"ORDER BY {order_by_column} {sort_order.upper()}"
 
+        # وضع المؤشر الاختياري (after=): شرط keyset على (created_at, id) من جدول subscriptions
+        # (فهرس idx_subscriptions_created_at_id) بدل OFFSET، وإحصائيات المجموعة المفلترة تُحسب في الصفحة الأولى فقط.
+        # الترتيب بأعمدة الجداول المنضمة أو القيم المحسوبة (days_remaining تتغير مع NOW()) يبقى على OFFSET.
+        keyset = None
+        if keyset_requested(request.args):
+            if order_by_column != "fs.created_at":
+                return jsonify({"error": "Cursor pagination is only supported with sort_by=created_at"}), 400
+            try:
+                keyset = KeysetPage(request.args.get("after"), order_by_column, "fs.created_at", "timestamptz",
+                                    "fs.id", "integer", sort_order, nullable=True)
+            except ValueError as ve:
+                return jsonify({"error": str(ve)}), 400
+
+        include_stats = keyset is None or keyset.is_first_page
+        # العرض الافتراضي (بدون فلاتر أو بفلتر النوع فقط) يقرأ الإحصائيات من subscription_status_rollup،
+        # والعد الدقيق عبر CTE يبقى للبحث والفلاتر الأخرى فقط
+        use_rollup_stats = include_stats and len(where_clauses) == (0 if type_filter_id is None else 1)
+        stats_select_sql = """
+                (SELECT COUNT(*) FROM filtered_subscriptions) AS total_records,
+                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'active') AS active_count,
+                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'expired') AS expired_count,
+                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'expiring_soon') AS expiring_soon_count,
+                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'inactive') AS inactive_count,
+        """ if include_stats and not use_rollup_stats else ""
+        page_where_sql = ""
+        if keyset:
+            stats_select_sql += f"{keyset.select_sql()},"
+            keyset_where = keyset.where_sql(query_params)
+            page_where_sql = f"WHERE {keyset_where}" if keyset_where else ""
+            order_by_clause = keyset.order_by_sql()
+            page_limit_sql = f"LIMIT ${len(query_params) + 1}"
+        else:
+            page_limit_sql = f"LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
+
+        # صفحات المؤشر بعد الأولى: الـ CTE تُدمج في الاستعلام حتى يصل شرط (created_at, id) إلى فهرس subscriptions
+        cte_mode = "NOT MATERIALIZED" if keyset and not include_stats else ""
+
         # --- 5. The Magic Merged Query ---
-        limit_param_index = len(query_params) + 1
-        offset_param_index = len(query_params) + 2
 
         main_query = f"""
-            WITH base_subscriptions AS (
+            WITH base_subscriptions AS {cte_mode} (
                 SELECT
                     s.*,
                     u.full_name, u.username,
@@ -2252,27 +2272,25 @@ async def get_subscriptions_merged_endpoint():
                 LEFT JOIN subscription_types st ON s.subscription_type_id = st.id
                 LEFT JOIN subscription_plans sp ON s.subscription_plan_id = sp.id
             ),
-            filtered_subscriptions AS (
+            filtered_subscriptions AS {cte_mode} (
                 SELECT * FROM base_subscriptions
                 WHERE {where_sql}
             )
             SELECT 
-                (SELECT COUNT(*) FROM filtered_subscriptions) AS total_records,
-                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'active') AS active_count,
-                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'expired') AS expired_count,
-                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'expiring_soon') AS expiring_soon_count,
-                (SELECT COUNT(*) FROM filtered_subscriptions WHERE status_label = 'inactive') AS inactive_count,
+                {stats_select_sql}
                 fs.*
             FROM filtered_subscriptions fs
+            {page_where_sql}
             {order_by_clause}
-            LIMIT ${limit_param_index} OFFSET ${offset_param_index}
+            {page_limit_sql}
         """
 
-        query_params.extend([page_size, offset])
+        query_params.extend([page_size] if keyset else [page_size, offset])
 
         # --- 6. Execute Query and Format Response ---
         async with current_app.db_pool.acquire() as conn:
             rows = await conn.fetch(main_query, *query_params)
+            rollup_stats = await get_subscription_status_counts(conn, type_filter_id) if use_rollup_stats else None
 
         items_data = []
         stats = {
@@ -2280,7 +2298,12 @@ async def get_subscriptions_merged_endpoint():
             "expiring_soon_count": 0, "inactive_count": 0
         }
 
-        if rows:
+        if rollup_stats is not None:
+            stats.update(rollup_stats)
+            items_data = [
+                {k: v for k, v in dict(row).items() if k not in stats} for row in rows
+            ]
+        elif rows:
             first_row = dict(rows[0])
             stats["total_records"] = first_row.get('total_records', 0)
             stats["active_count"] = first_row.get('active_count', 0)
@@ -2291,7 +2314,10 @@ async def get_subscriptions_merged_endpoint():
                 {k: v for k, v in dict(row).items() if k not in stats} for row in rows
             ]
 
-        total_records = stats.get('total_records', 0)
+        next_cursor = keyset.next_cursor(items_data, page_size) if keyset else None
+        if not include_stats:
+            stats = None
+        total_records = stats.get('total_records', 0) if stats else None
 
         return jsonify({
             "data": items_data,
@@ -2299,7 +2325,8 @@ async def get_subscriptions_merged_endpoint():
                 "page": page,
                 "page_size": page_size,
                 "total": total_records,
-                "total_pages": (total_records + page_size - 1) // page_size if page_size > 0 else 0,
+                "total_pages": (total_records + page_size - 1) // page_size if total_records is not None else None,
+                "next_cursor": next_cursor,
             },
             "statistics": stats
         })
@@ -2377,13 +2404,32 @@ async def get_subscription_history_endpoint():
 
         where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
 
-        # 💡 تحديد معاملات الترقيم ديناميكيًا
-        limit_param_index = len(query_params) + 1
-        offset_param_index = len(query_params) + 2
+        # وضع المؤشر الاختياري (after=) على renewal_date + id بدل OFFSET
+        try:
+            keyset = KeysetPage(request.args.get("after"), "renewal_date", "fh.renewal_date", "timestamptz",
+                                "fh.id", nullable=True) if keyset_requested(request.args) else None
+        except ValueError as ve:
+            return jsonify({"error": str(ve)}), 400
+        include_total = keyset is None or keyset.is_first_page
+        total_select_sql = "(SELECT COUNT(*) FROM filtered_history) as total_records," if include_total else ""
+        page_where_sql = ""
+        order_by_clause = "ORDER BY fh.renewal_date DESC"
+        if keyset:
+            total_select_sql += f" {keyset.select_sql()},"
+            keyset_where = keyset.where_sql(query_params)
+            page_where_sql = f"WHERE {keyset_where}" if keyset_where else ""
+            order_by_clause = keyset.order_by_sql()
+            page_limit_sql = f"LIMIT ${len(query_params) + 1}"
+        else:
+            # 💡 تحديد معاملات الترقيم ديناميكيًا
+            page_limit_sql = f"LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
+
+        # صفحات المؤشر بعد الأولى: الـ CTE تُدمج حتى يصل شرط (renewal_date, id) إلى فهرس subscription_history
+        cte_mode = "NOT MATERIALIZED" if keyset and not include_total else ""
 
         # 💡 تعديل الاستعلام ليكون نظيفًا وبدون .replace()
         query = f"""
-            WITH filtered_history AS (
+            WITH filtered_history AS {cte_mode} (
                 SELECT
                     sh.id, sh.action_type, sh.renewal_date, sh.expiry_date, 
                     sh.telegram_id, sh.source, sh.payment_token,
@@ -2395,20 +2441,22 @@ async def get_subscription_history_endpoint():
                 WHERE {where_sql}
             )
             SELECT
-                (SELECT COUNT(*) FROM filtered_history) as total_records,
+                {total_select_sql}
                 fh.*
             FROM filtered_history fh
-            ORDER BY fh.renewal_date DESC
-            LIMIT ${limit_param_index} OFFSET ${offset_param_index}
+            {page_where_sql}
+            {order_by_clause}
+            {page_limit_sql}
         """
         # إضافة معاملات الترقيم إلى نهاية القائمة
-        query_params.extend([page_size, offset])
+        query_params.extend([page_size] if keyset else [page_size, offset])
 
         async with current_app.db_pool.acquire() as conn:
             rows = await conn.fetch(query, *query_params)
 
-        total_records = rows[0]['total_records'] if rows else 0
+        total_records = (rows[0]['total_records'] if rows else 0) if include_total else None
         items_data = [{k: v for k, v in dict(row).items() if k != 'total_records'} for row in rows]
+        next_cursor = keyset.next_cursor(items_data, page_size) if keyset else None
 
         return jsonify({
             "data": items_data,
@@ -2416,7 +2464,8 @@ async def get_subscription_history_endpoint():
                 "page": page,
                 "page_size": page_size,
                 "total": total_records,
-                "total_pages": (total_records + page_size - 1) // page_size if page_size > 0 else 0,
+                "total_pages": (total_records + page_size - 1) // page_size if total_records is not None else None,
+                "next_cursor": next_cursor,
             }
         })
 
@@ -2453,23 +2502,34 @@ async def get_subscription_analytics():
         trend_period = request.args.get("trend_period", "monthly")  # daily/weekly/monthly
 
         # --- فلتر التاريخ العام (للإحصائيات المجمعة) ---
+        # يُطبق على أيام daily_subscription_events (UTC)، وعلى created_at لعدد المستخدمين الفريدين
         params = []
         where_clauses = []
+        users_where_clauses = []
         if start_date_str:
             try:
                 params.append(datetime.strptime(start_date_str, '%Y-%m-%d').date())
-                where_clauses.append(f"created_at >= ${len(params) + 1}")
+                where_clauses.append(f"day >= ${len(params)}")
+                users_where_clauses.append(f"created_at >= (${len(params)}::DATE AT TIME ZONE 'UTC')")
             except ValueError:
                 return jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD."}), 400
 
         if end_date_str:
             try:
                 params.append(datetime.strptime(end_date_str, '%Y-%m-%d').date())
-                where_clauses.append(f"created_at < (${len(params) + 1}::DATE + INTERVAL '1 day')")
+                where_clauses.append(f"day <= ${len(params)}")
+                users_where_clauses.append(f"created_at < ((${len(params)}::DATE + 1) AT TIME ZONE 'UTC')")
             except ValueError:
                 return jsonify({"error": "Invalid end_date format. Use YYYY-MM-DD."}), 400
 
         date_filter_sql = " AND ".join(where_clauses) if where_clauses else "TRUE"
+        # المستخدمون الفريدون لا يُجمعون يوميًا: بدون فلتر نقرأ user_subscription_stats،
+        # ومع فلتر التاريخ نعدّهم بدقة من subscriptions عبر فهرس created_at
+        if users_where_clauses:
+            unique_users_sql = f"""(SELECT COUNT(DISTINCT telegram_id) FROM subscriptions
+                                    WHERE {" AND ".join(users_where_clauses)})"""
+        else:
+            unique_users_sql = "(SELECT COUNT(*) FROM user_subscription_stats WHERE total_subscriptions > 0)"
 
         # --- إعدادات توجه النمو (Growth Trend) المحسّنة ---
         if trend_period == 'daily':
@@ -2486,56 +2546,57 @@ async def get_subscription_analytics():
             trend_trunc = "month"
 
         async with current_app.db_pool.acquire() as conn:
-            # استعلام واحد لجلب كل الإحصائيات المجمعة
+            # استعلام واحد لجلب كل الإحصائيات المجمعة من daily_subscription_events
             main_analytics_query = f"""
-                WITH FilteredSubscriptions AS (
-                    SELECT s.* 
-                    FROM subscriptions s
+                WITH FilteredEvents AS (
+                    SELECT *
+                    FROM daily_subscription_events
                     WHERE {date_filter_sql}
                 ),
                 Aggregations AS (
                     SELECT
-                        (SELECT COUNT(*) FROM FilteredSubscriptions) AS total_subscriptions,
-                        (SELECT COUNT(CASE WHEN is_active = true THEN 1 END) FROM FilteredSubscriptions) AS active_subscriptions,
-                        (SELECT COUNT(DISTINCT telegram_id) FROM FilteredSubscriptions) AS unique_users,
-                        (SELECT AVG(EXTRACT(DAY FROM expiry_date - start_date)) FROM FilteredSubscriptions) AS avg_subscription_duration_days
+                        COALESCE(SUM(new_subscriptions), 0) AS total_subscriptions,
+                        COALESCE(SUM(active_subscriptions), 0) AS active_subscriptions,
+                        {unique_users_sql} AS unique_users,
+                        SUM(duration_days_sum) / NULLIF(SUM(new_subscriptions), 0) AS avg_subscription_duration_days
+                    FROM FilteredEvents
                 )
                 SELECT
                     (SELECT to_jsonb(agg) FROM Aggregations agg) AS overall_stats,
                     (
                         SELECT jsonb_agg(dist)
                         FROM (
-                            SELECT st.name AS type_name, COUNT(*) AS count
-                            FROM FilteredSubscriptions fs
-                            JOIN subscription_types st ON fs.subscription_type_id = st.id
+                            SELECT st.name AS type_name, SUM(fe.new_subscriptions) AS count
+                            FROM FilteredEvents fe
+                            JOIN subscription_types st ON fe.subscription_type_id = st.id
                             GROUP BY st.name ORDER BY count DESC
                         ) dist
                     ) AS type_distribution,
                     (
                         SELECT jsonb_agg(dist)
                         FROM (
-                            SELECT COALESCE(fs.source, 'Unknown') AS source_name, COUNT(*) AS count
-                            FROM FilteredSubscriptions fs
-                            GROUP BY source_name ORDER BY count DESC
+                            SELECT fe.source AS source_name, SUM(fe.new_subscriptions) AS count
+                            FROM FilteredEvents fe
+                            GROUP BY fe.source ORDER BY count DESC
                         ) dist
                     ) AS source_distribution
             """
 
-            # --- استعلام توجه النمو لا يحتاج لتغيير، هو ديناميكي بالفعل ---
+            # --- توجه النمو من أيام daily_subscription_events (UTC) ---
             trends_query = f"""
                 WITH TimeSeries AS (
                     SELECT generate_series(
-                        date_trunc('{trend_trunc}', NOW() - INTERVAL '{trend_interval}'),
-                        date_trunc('{trend_trunc}', NOW()),
+                        date_trunc('{trend_trunc}', (NOW() AT TIME ZONE 'UTC') - INTERVAL '{trend_interval}'),
+                        date_trunc('{trend_trunc}', NOW() AT TIME ZONE 'UTC'),
                         '1 {trend_trunc}'::interval
                     )::DATE AS period
                 ),
                 SubscriptionCounts AS (
                     SELECT
-                        date_trunc('{trend_trunc}', created_at)::DATE as period,
-                        COUNT(*) as new_subscriptions
-                    FROM subscriptions
-                    WHERE created_at >= NOW() - INTERVAL '{trend_interval}'
+                        date_trunc('{trend_trunc}', day)::DATE as period,
+                        SUM(new_subscriptions)::BIGINT as new_subscriptions
+                    FROM daily_subscription_events
+                    WHERE day >= ((NOW() AT TIME ZONE 'UTC') - INTERVAL '{trend_interval}')::DATE
                     GROUP BY period
                 )
                 SELECT
@@ -2589,6 +2650,73 @@ async def get_subscription_analytics():
         return jsonify({"error": "Failed to fetch analytics"}), 500
 
 
+def _parse_analytics_range(default_days: int = 365):
+    """start_date / end_date (YYYY-MM-DD) مع refresh=true لتجاوز الكاش. الافتراضي: آخر default_days يوم."""
+    end_date_str = request.args.get("end_date")
+    start_date_str = request.args.get("start_date")
+    end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str \
+        else datetime.now(timezone.utc).date()
+    start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str \
+        else end_date - timedelta(days=default_days)
+    if start_date > end_date:
+        raise ValueError("start_date must be before end_date.")
+    return start_date, end_date, request.args.get("refresh", "false").lower() == "true"
+
+
+@admin_routes.route("/subscriptions/analytics/cohorts", methods=["GET"])
+@permission_required("user_subscriptions.read")
+async def get_subscription_cohorts():
+    """Monthly cohort retention: cohort = month of the user's first activation."""
+    try:
+        start_date, end_date, refresh = _parse_analytics_range()
+        months = min(max(int(request.args.get("months", 12)), 1), 36)
+    except ValueError:
+        return jsonify({"error": "Invalid parameters. Dates use YYYY-MM-DD and months is an integer."}), 400
+
+    try:
+        result = await get_cohort_retention(current_app.db_pool, start_date, end_date, months, refresh=refresh)
+        return jsonify({"start_date": start_date.isoformat(), "end_date": end_date.isoformat(), **result})
+    except Exception as e:
+        logging.error(f"Error in /subscriptions/analytics/cohorts: {e}", exc_info=True)
+        return jsonify({"error": "Failed to fetch cohort analytics"}), 500
+
+
+@admin_routes.route("/subscriptions/analytics/renewals", methods=["GET"])
+@permission_required("user_subscriptions.read")
+async def get_subscription_renewal_rates():
+    """Renewal rate per plan, based on completed payments in the date range."""
+    try:
+        start_date, end_date, refresh = _parse_analytics_range()
+        grace_days = min(max(int(request.args.get("grace_days", DEFAULT_GRACE_DAYS)), 0), MAX_GRACE_DAYS)
+    except ValueError:
+        return jsonify({"error": "Invalid parameters. Dates use YYYY-MM-DD and grace_days is an integer."}), 400
+
+    try:
+        result = await get_renewal_rates(current_app.db_pool, start_date, end_date, grace_days, refresh=refresh)
+        return jsonify({"start_date": start_date.isoformat(), "end_date": end_date.isoformat(), **result})
+    except Exception as e:
+        logging.error(f"Error in /subscriptions/analytics/renewals: {e}", exc_info=True)
+        return jsonify({"error": "Failed to fetch renewal analytics"}), 500
+
+
+@admin_routes.route("/subscriptions/analytics/churn", methods=["GET"])
+@permission_required("user_subscriptions.read")
+async def get_subscription_churn():
+    """Churn by source for subscription terms that ended in the date range."""
+    try:
+        start_date, end_date, refresh = _parse_analytics_range(default_days=90)
+        grace_days = min(max(int(request.args.get("grace_days", DEFAULT_GRACE_DAYS)), 0), MAX_GRACE_DAYS)
+    except ValueError:
+        return jsonify({"error": "Invalid parameters. Dates use YYYY-MM-DD and grace_days is an integer."}), 400
+
+    try:
+        result = await get_churn_by_source(current_app.db_pool, start_date, end_date, grace_days, refresh=refresh)
+        return jsonify({"start_date": start_date.isoformat(), "end_date": end_date.isoformat(), **result})
+    except Exception as e:
+        logging.error(f"Error in /subscriptions/analytics/churn: {e}", exc_info=True)
+        return jsonify({"error": "Failed to fetch churn analytics"}), 500
+
+
 # واجهة API جديدة للحصول على قائمة مصادر الاشتراكات المتاحة
 @admin_routes.route("/subscription_sources", methods=["GET"])
 @permission_required("pending_subscriptions.read")
@@ -2717,12 +2845,42 @@ async def get_payments_enhanced_endpoint():
         order_by_column = allowed_sort_columns.get(sort_by, "fp.created_at")
         order_by_clause = f"ORDER BY {order_by_column} {sort_order.upper()}"
 
+        # وضع المؤشر الاختياري (after=) على (created_at, id) من جدول payments (فهرس idx_payments_created_at_id)
+        # بدل OFFSET؛ الترتيب بالأعمدة الأخرى غير المفهرسة يبقى على OFFSET
+        keyset = None
+        if keyset_requested(request.args):
+            if order_by_column != "fp.created_at":
+                return jsonify({"error": "Cursor pagination is only supported with sort_by=created_at"}), 400
+            try:
+                keyset = KeysetPage(request.args.get("after"), order_by_column, "fp.created_at", "timestamp",
+                                    "fp.id", "integer", sort_order, nullable=True)
+            except ValueError as ve:
+                return jsonify({"error": str(ve)}), 400
+
+        include_stats = keyset is None or keyset.is_first_page
+        stats_select_sql = """
+                (SELECT COUNT(*) FROM filtered_payments) AS total_records,
+                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'completed') AS completed_count,
+                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'pending') AS pending_count,
+                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'failed') AS failed_count,
+        """ if include_stats else ""
+        page_where_sql = ""
+        if keyset:
+            stats_select_sql += f"{keyset.select_sql()},"
+            keyset_where = keyset.where_sql(query_params)
+            page_where_sql = f"WHERE {keyset_where}" if keyset_where else ""
+            order_by_clause = keyset.order_by_sql()
+            page_limit_sql = f"LIMIT ${len(query_params) + 1}"
+        else:
+            page_limit_sql = f"LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
+
+        # صفحات المؤشر بعد الأولى: الـ CTE تُدمج حتى يصل شرط (created_at, id) إلى فهرس payments
+        cte_mode = "NOT MATERIALIZED" if keyset and not include_stats else ""
+
         # --- 5. The Magic Merged Query ---
-        limit_param_index = len(query_params) + 1
-        offset_param_index = len(query_params) + 2
 
         main_query = f"""
-            WITH base_payments AS (
+            WITH base_payments AS {cte_mode} (
                 SELECT
                     p.*,
                     sp.name AS plan_name,
@@ -2732,23 +2890,20 @@ async def get_payments_enhanced_endpoint():
                 LEFT JOIN subscription_plans sp ON p.subscription_plan_id = sp.id
                 LEFT JOIN subscription_types st ON sp.subscription_type_id = st.id
             ),
-            filtered_payments AS (
+            filtered_payments AS {cte_mode} (
                 SELECT p.* FROM base_payments p -- Renamed to avoid ambiguity
                 WHERE {where_sql}
             )
             SELECT 
-                (SELECT COUNT(*) FROM filtered_payments) AS total_records,
-                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'completed') AS completed_count,
-                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'pending') AS pending_count,
-                (SELECT COUNT(*) FROM filtered_payments WHERE status = 'failed') AS failed_count,
-
+                {stats_select_sql}
                 fp.*
             FROM filtered_payments fp
+            {page_where_sql}
             {order_by_clause}
-            LIMIT ${limit_param_index} OFFSET ${offset_param_index}
+            {page_limit_sql}
         """
 
-        query_params.extend([page_size, offset])
+        query_params.extend([page_size] if keyset else [page_size, offset])
 
         # --- 6. Execute Query and Format Response ---
         async with current_app.db_pool.acquire() as conn:
@@ -2772,7 +2927,10 @@ async def get_payments_enhanced_endpoint():
                 {k: v for k, v in dict(row).items() if k not in stats} for row in rows
             ]
 
-        total_records = stats.get('total_records', 0)
+        next_cursor = keyset.next_cursor(items_data, page_size) if keyset else None
+        if not include_stats:
+            stats = None
+        total_records = stats.get('total_records', 0) if stats else None
 
         return jsonify({
             "data": items_data,
@@ -2780,7 +2938,8 @@ async def get_payments_enhanced_endpoint():
                 "page": page,
                 "pageSize": page_size,
                 "total": total_records,
-                "totalPages": (total_records + page_size - 1) // page_size if page_size > 0 else 0,
+                "totalPages": (total_records + page_size - 1) // page_size if total_records is not None else None,
+                "nextCursor": next_cursor,
             },
             "statistics": stats
         })
@@ -2884,6 +3043,42 @@ async def retry_failed_payment_renewal(payment_id: int):
             return jsonify({"error": "An internal error occurred while trying to start the retry process."}), 500
 
 
+@admin_routes.route("/payments/reconcile", methods=["POST"])
+@permission_required("payments.read_all")
+async def reconcile_payments_endpoint():
+    """
+    Matches unprocessed incoming transactions against pending/manual_check payments
+    and pushes every match through the regular renewal path in one pass.
+    Body (optional): {"limit": 500, "dry_run": false}
+    """
+    try:
+        data = await request.get_json(silent=True) or {}
+        limit = min(2000, max(1, int(data.get("limit", RECONCILIATION_BATCH_LIMIT))))
+        dry_run = bool(data.get("dry_run", False))
+
+        if not dry_run and not current_app.bot:
+            return jsonify({"error": "Bot service is not available on the server."}), 503
+
+        service = PaymentReconciliationService(current_app.db_pool)
+        report = await service.run(limit=limit, dry_run=dry_run)
+
+        current_user = await get_current_user()
+        await log_action(
+            current_user["email"] if current_user else "system",
+            "RECONCILE_PAYMENTS",
+            resource="payment",
+            details={"dry_run": dry_run, "matched": report["matched"], "outcomes": report["outcomes"]}
+        )
+
+        return jsonify(report), 200
+
+    except (ValueError, TypeError) as ve:
+        return jsonify({"error": "Invalid request parameters", "details": str(ve)}), 400
+    except Exception as e:
+        logging.error(f"Error during payments reconciliation: {e}", exc_info=True)
+        return jsonify({"error": "Reconciliation failed", "details": str(e)}), 500
+
+
 @admin_routes.route("/incoming-transactions", methods=["GET"])
 @permission_required("payments.read_incoming_transactions")
 async def get_incoming_transactions():
@@ -2897,10 +3092,16 @@ async def get_incoming_transactions():
         end_date_filter = request.args.get("end_date")
         search_term = request.args.get("search", "").strip()
 
-        base_query_select = """
+        # وضع المؤشر الاختياري (after=) على received_at + txhash بدل OFFSET
+        keyset = KeysetPage(request.args.get("after"), "received_at", "it.received_at", "timestamp",
+                            "it.txhash", "text", nullable=True) if keyset_requested(request.args) else None
+        cursor_select_sql = f", {keyset.select_sql()}" if keyset else ""
+
+        base_query_select = f"""
             SELECT 
                 it.txhash, it.sender_address, it.amount, it.payment_token, 
                 it.processed, it.received_at, it.memo, it.txhash_base64
+                {cursor_select_sql}
             FROM incoming_transactions it
         """
         count_base_query_select = """
@@ -2949,13 +3150,23 @@ async def get_incoming_transactions():
 
         # --- استعلام البيانات الرئيسي ---
         query_final_params = list(main_where_params)  # نسخة من المعاملات
-        query = f"""
-            {base_query_select}
-            WHERE {main_where_sql}
-            ORDER BY it.received_at DESC 
-            LIMIT ${param_idx_main} OFFSET ${param_idx_main + 1}
-        """
-        query_final_params.extend([page_size, offset])
+        if keyset:
+            keyset_where = keyset.where_sql(query_final_params)
+            query = f"""
+                {base_query_select}
+                WHERE {main_where_sql}{f" AND {keyset_where}" if keyset_where else ""}
+                {keyset.order_by_sql()}
+                LIMIT ${len(query_final_params) + 1}
+            """
+            query_final_params.append(page_size)
+        else:
+            query = f"""
+                {base_query_select}
+                WHERE {main_where_sql}
+                ORDER BY it.received_at DESC 
+                LIMIT ${param_idx_main} OFFSET ${param_idx_main + 1}
+            """
+            query_final_params.extend([page_size, offset])
 
         # --- استعلام العد الكلي (المفلتر) ---
         count_query = f"""
@@ -3010,18 +3221,25 @@ async def get_incoming_transactions():
         rows_data = []
         total_records = 0
         processed_transactions_count = 0
+        next_cursor = None
 
         async with current_app.db_pool.acquire() as connection:
             rows_result = await connection.fetch(query, *query_final_params)
             rows_data = [dict(row) for row in rows_result]
-
-            count_result_row = await connection.fetchrow(count_query, *main_where_params)
-            if count_result_row and "total" in count_result_row:
-                total_records = count_result_row["total"]
-
-            processed_count_result_row = await connection.fetchrow(processed_count_query_sql, *processed_count_params)
-            if processed_count_result_row and "processed_count" in processed_count_result_row:
-                processed_transactions_count = processed_count_result_row["processed_count"]
+            if keyset:
+                next_cursor = keyset.next_cursor(rows_data, page_size)
+
+            # في وضع المؤشر تُحسب الإجماليات في الصفحة الأولى فقط
+            if keyset is None or keyset.is_first_page:
+                count_result_row = await connection.fetchrow(count_query, *main_where_params)
+                if count_result_row and "total" in count_result_row:
+                    total_records = count_result_row["total"]
+
+                processed_count_result_row = await connection.fetchrow(processed_count_query_sql, *processed_count_params)
+                if processed_count_result_row and "processed_count" in processed_count_result_row:
+                    processed_transactions_count = processed_count_result_row["processed_count"]
+            else:
+                total_records = processed_transactions_count = None
 
         response = {
             "data": rows_data,
@@ -3029,6 +3247,7 @@ async def get_incoming_transactions():
             "page": page,
             "page_size": page_size,
             "processed_count": processed_transactions_count,
+            "next_cursor": next_cursor,
         }
         return jsonify(response)
 
@@ -3313,6 +3532,10 @@ async def cancel_subscription_admin():
 @admin_routes.route("/subscriptions/export", methods=["GET"])
 @permission_required("user_subscriptions.cancel")
 async def export_subscriptions():
+    """
+    ?format=ndjson (أو Accept: application/x-ndjson) يبث الصفوف سطرًا سطرًا من cursor
+    بدل تحميلها كلها في مصفوفة JSON واحدة.
+    """
     try:
         subscription_type_id = request.args.get("subscription_type_id")
         start_date = request.args.get("start_date")
@@ -3361,6 +3584,14 @@ async def export_subscriptions():
             elif active.lower() == "false":
                 query += " AND s.is_active = false"
 
+        wants_ndjson = (
+            request.args.get("format", "").lower() == "ndjson"
+            or "application/x-ndjson" in request.headers.get("Accept", "")
+        )
+        if wants_ndjson:
+            query += " ORDER BY s.id"
+            return streaming_ndjson_response(current_app.db_pool, query, params, current_app.json.dumps)
+
         async with current_app.db_pool.acquire() as connection:
             rows = await connection.fetch(query, *params)
         data = [dict(row) for row in rows]
@@ -3373,12 +3604,11 @@ async def export_subscriptions():
 @admin_routes.route("/wallet", methods=["GET"])
 @permission_required("system.manage_wallet")
 async def get_wallet_address():
-    async with current_app.db_pool.acquire() as connection:
-        wallet = await connection.fetchrow("SELECT wallet_address, api_key FROM wallet ORDER BY id DESC LIMIT 1")
+    wallet = await settings_cache.get_wallet()
     if wallet:
         return jsonify({
-            "wallet_address": wallet["wallet_address"],
-            "api_key": wallet["api_key"]
+            "wallet_address": wallet.wallet_address,
+            "api_key": wallet.api_key
         }), 200
     else:
         return jsonify({"wallet_address": "", "api_key": ""}), 200
@@ -3406,6 +3636,7 @@ async def update_wallet_address():
                 "INSERT INTO wallet (wallet_address, api_key) VALUES ($1, $2)",
                 wallet_address, api_key
             )
+        await notify_settings_changed(connection, "wallet")
     return jsonify({"message": "تم تحديث البيانات بنجاح"}), 200
 
 
@@ -3498,6 +3729,8 @@ async def update_reminder_settings():
                 action_type = "create"
                 log_msg = f"✅ تم إضافة إعدادات التذكير: {first_reminder}h, {second_reminder}h"
 
+            await notify_settings_changed(connection, "reminder_settings")
+
             logging.info(log_msg)
             return jsonify({
                 "message": "تم حفظ الإعدادات بنجاح",
@@ -3520,23 +3753,16 @@ async def update_reminder_settings():
 @permission_required("subscription_types.read")
 async def get_terms_conditions():
     try:
-        async with current_app.db_pool.acquire() as connection:
-            query = """
-                SELECT id, terms_array, updated_at
-                FROM terms_conditions
-                ORDER BY updated_at DESC
-                LIMIT 1;
-            """
-            result = await connection.fetchrow(query)
+        terms = await settings_cache.get_terms_conditions()
 
-            if result:
-                return jsonify({
-                    "id": result["id"],
-                    "terms_array": result["terms_array"],
-                    "updated_at": result["updated_at"].isoformat() if result["updated_at"] else None
-                }), 200
-            else:
-                return jsonify({"terms_array": []}), 200
+        if terms:
+            return jsonify({
+                "id": terms.id,
+                "terms_array": terms.terms_array,
+                "updated_at": terms.updated_at.isoformat() if terms.updated_at else None
+            }), 200
+        else:
+            return jsonify({"terms_array": []}), 200
 
     except Exception as e:
         logging.error("Error fetching terms and conditions: %s", e, exc_info=True)
@@ -3566,6 +3792,7 @@ async def update_terms_conditions():
                 RETURNING id, terms_array, updated_at;
             """
             result = await connection.fetchrow(query, terms_json)
+            await notify_settings_changed(connection, "terms_conditions")
 
         return jsonify({
             "id": result["id"],
@@ -3592,6 +3819,7 @@ async def delete_terms_conditions(terms_id):
             result = await connection.fetchrow(query, terms_id)
 
             if result:
+                await notify_settings_changed(connection, "terms_conditions")
                 return jsonify({"message": "Terms and conditions deleted successfully"}), 200
             else:
                 return jsonify({"error": "Terms and conditions not found"}), 404
@@ -3609,95 +3837,98 @@ AVAILABLE_EXPORT_FIELDS_MAP = {
     "wallet_address": {"db_col": "u.wallet_address", "header": "عنوان المحفظة (EVM)"},
     "ton_wallet_address": {"db_col": "u.ton_wallet_address", "header": "عنوان محفظة TON"},
     "wallet_app": {"db_col": "u.wallet_app", "header": "تطبيق المحفظة"},
+    # مجاميع الاشتراكات تُقرأ من user_subscription_stats (يحدّثها trigger على subscriptions)
     "subscription_count": {
-        "db_col": "(SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id)",
+        "db_col": "COALESCE(uss.total_subscriptions, 0)",
         "header": "إجمالي الاشتراكات"
     },
     "active_subscription_count": {
-        "db_col": "(SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id AND s.is_active = true)",
+        "db_col": "COALESCE(uss.active_subscriptions, 0)",
         "header": "الاشتراكات النشطة"
     },
+    "last_expiry_date": {"db_col": "uss.last_expiry_date", "header": "آخر تاريخ انتهاء"},
     "created_at": {"db_col": "u.created_at", "header": "تاريخ الإنشاء"},
     # يمكنك إضافة المزيد من الحقول هنا
     # "last_login": {"db_col": "u.last_login_at", "header": "آخر تسجيل دخول"},
 }
 
 
-@admin_routes.route("/users/export", methods=["POST"])
-@permission_required("bot_users.export")
-async def export_users_endpoint():
-    try:
-        data = await request.get_json()
-        if data is None:  # تحقق إذا كانت البيانات JSON فارغة أو غير صالحة
-            return jsonify({"error": "Invalid JSON payload"}), 400
-
-        requested_field_keys = data.get('fields', [])  # قائمة بمفاتيح الحقول المطلوبة من الواجهة الأمامية
-        user_type_filter = data.get('user_type',
-                                    'all')  # 'all', 'active_subscribers', 'any_subscribers' (كانت 'with_subscription')
-        search_term = data.get('search', "").strip()
-
-        # تحديد الحقول التي سيتم الاستعلام عنها من قاعدة البيانات
-        # والمفاتيح التي ستستخدم كـ alias في SQL (وهي نفسها مفاتيح requested_field_keys)
-        fields_to_query_map = {}  # { 'alias_key': 'db_col_expression', ... }
-
-        if not requested_field_keys:  # إذا لم يتم تحديد حقول، استخدم كل الحقول المتاحة
-            for key, details in AVAILABLE_EXPORT_FIELDS_MAP.items():
-                fields_to_query_map[key] = details["db_col"]
-        else:
-            for key in requested_field_keys:
-                if key in AVAILABLE_EXPORT_FIELDS_MAP:
-                    fields_to_query_map[key] = AVAILABLE_EXPORT_FIELDS_MAP[key]["db_col"]
-                else:
-                    logging.warning(f"Requested field '{key}' not available for export and will be ignored.")
+def build_users_export_query(data: dict):
+    """
+    بناء استعلام تصدير المستخدمين من جسم الطلب (الحقول والفلاتر).
+    ترجع (final_query, query_params, headers) حيث headers: {alias العمود: عنوانه في الملف}.
+    ترفع ValueError عند طلب غير صالح.
+    """
+    requested_field_keys = data.get('fields', [])  # قائمة بمفاتيح الحقول المطلوبة من الواجهة الأمامية
+    user_type_filter = data.get('user_type',
+                                'all')  # 'all', 'active_subscribers', 'any_subscribers' (كانت 'with_subscription')
+    search_term = data.get('search', "").strip()
+
+    # تحديد الحقول التي سيتم الاستعلام عنها من قاعدة البيانات
+    # والمفاتيح التي ستستخدم كـ alias في SQL (وهي نفسها مفاتيح requested_field_keys)
+    fields_to_query_map = {}  # { 'alias_key': 'db_col_expression', ... }
+
+    if not requested_field_keys:  # إذا لم يتم تحديد حقول، استخدم كل الحقول المتاحة
+        for key, details in AVAILABLE_EXPORT_FIELDS_MAP.items():
+            fields_to_query_map[key] = details["db_col"]
+    else:
+        for key in requested_field_keys:
+            if key in AVAILABLE_EXPORT_FIELDS_MAP:
+                fields_to_query_map[key] = AVAILABLE_EXPORT_FIELDS_MAP[key]["db_col"]
+            else:
+                logging.warning(f"Requested field '{key}' not available for export and will be ignored.")
 
-        if not fields_to_query_map:
-            return jsonify({"error": "No valid fields selected or available for export"}), 400
+    if not fields_to_query_map:
+        raise ValueError("No valid fields selected or available for export")
 
-        # بناء جملة SELECT الديناميكية
-        # استخدام الـ key كـ alias للعمود ليتم استخدامه لاحقاً في DataFrame
-        select_clauses = [f'{db_expr} AS "{alias_key}"' for alias_key, db_expr in fields_to_query_map.items()]
-        dynamic_select_sql = ", ".join(select_clauses)
+    # بناء جملة SELECT الديناميكية
+    # استخدام الـ key كـ alias للعمود ليتم استخدامه لاحقاً في DataFrame
+    select_clauses = [f'{db_expr} AS "{alias_key}"' for alias_key, db_expr in fields_to_query_map.items()]
+    dynamic_select_sql = ", ".join(select_clauses)
 
-        base_query_from = "FROM users u"
+    base_query_from = "FROM users u LEFT JOIN user_subscription_stats uss ON uss.telegram_id = u.telegram_id"
 
-        # بناء شروط WHERE
-        where_clauses = ["1=1"]
-        query_params = []  # تم تغيير الاسم من where_params ليكون أوضح
-        param_idx = 1  # لترقيم متغيرات SQL ($1, $2, ...)
+    # بناء شروط WHERE
+    where_clauses = ["1=1"]
+    query_params = []  # تم تغيير الاسم من where_params ليكون أوضح
 
-        # فلتر نوع المستخدم
-        if user_type_filter == "active_subscribers":  # استخدام نفس المفاتيح من الواجهة الأمامية
-            where_clauses.append(
-                "(SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id AND s.is_active = true) > 0")
-        elif user_type_filter == "any_subscribers":  # تغيير 'with_subscription' إلى 'any_subscribers' ليكون أوضح
-            where_clauses.append("(SELECT COUNT(*) FROM subscriptions s WHERE s.telegram_id = u.telegram_id) > 0")
+    # فلتر نوع المستخدم
+    if user_type_filter == "active_subscribers":  # استخدام نفس المفاتيح من الواجهة الأمامية
+        where_clauses.append("uss.active_subscriptions > 0")
+    elif user_type_filter == "any_subscribers":  # تغيير 'with_subscription' إلى 'any_subscribers' ليكون أوضح
+        where_clauses.append("uss.total_subscriptions > 0")
 
-        # فلتر البحث
-        if search_term:
-            search_pattern = f"%{search_term}%"
-            # يتم إضافة الشروط إلى where_clauses وإضافة القيم إلى query_params
-            # التأكد من أن ترقيم الـ placeholder ($) يتزايد بشكل صحيح
-            search_conditions_parts = []
+    # فلتر البحث
+    search_sql = user_search_condition(search_term, query_params)
+    if search_sql:
+        where_clauses.append(search_sql)
 
-            search_conditions_parts.append(f"u.telegram_id::TEXT ILIKE ${param_idx}")
-            query_params.append(search_pattern)
-            param_idx += 1
+    where_sql = " AND ".join(where_clauses)
+    order_by_clause = "ORDER BY u.id DESC"  # أو أي ترتيب آخر تفضله
 
-            search_conditions_parts.append(f"u.full_name ILIKE ${param_idx}")
-            query_params.append(search_pattern)
-            param_idx += 1
+    final_query = f"SELECT {dynamic_select_sql} {base_query_from} WHERE {where_sql} {order_by_clause}"
+    logging.debug(f"Export query: {final_query} with params: {query_params}")
+    headers = {alias_key: AVAILABLE_EXPORT_FIELDS_MAP[alias_key]["header"] for alias_key in fields_to_query_map}
+    return final_query, query_params, headers
 
-            search_conditions_parts.append(f"u.username ILIKE ${param_idx}")
-            query_params.append(search_pattern)
-            param_idx += 1  # زيادة العداد بعد آخر استخدام
 
-            where_clauses.append(f"({' OR '.join(search_conditions_parts)})")
+@admin_routes.route("/users/export", methods=["POST"])
+@permission_required("bot_users.export")
+async def export_users_endpoint():
+    try:
+        data = await request.get_json()
+        if data is None:  # تحقق إذا كانت البيانات JSON فارغة أو غير صالحة
+            return jsonify({"error": "Invalid JSON payload"}), 400
 
-        where_sql = " AND ".join(where_clauses)
-        order_by_clause = "ORDER BY u.id DESC"  # أو أي ترتيب آخر تفضله
+        try:
+            export_format, stream_export = parse_export_format(data)
+            final_query, query_params, headers = build_users_export_query(data)
+        except ValueError as ve:
+            return jsonify({"error": str(ve)}), 400
 
-        final_query = f"SELECT {dynamic_select_sql} {base_query_from} WHERE {where_sql} {order_by_clause}"
-        logging.debug(f"Export query: {final_query} with params: {query_params}")
+        if stream_export:
+            return streaming_export_response(current_app.db_pool, final_query, query_params, headers,
+                                             export_format, "users_export", sheet_name='Users Data')
 
         # جلب البيانات من قاعدة البيانات
         async with current_app.db_pool.acquire() as conn:
@@ -3800,140 +4031,153 @@ AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS = {
 }
 
 
-@admin_routes.route("/subscriptions/export", methods=["POST"])
-@permission_required("bot_users.export")
-async def export_subscriptions_endpoint():
+def build_subscriptions_export_query(data: dict):
     """
-    نقطة نهاية لتصدير بيانات الاشتراكات إلى ملف Excel مع تطبيق فلاتر متقدمة.
+    بناء استعلام تصدير الاشتراكات من جسم الطلب (الحقول والفلاتر).
+    ترجع (final_query, query_params, headers) حيث headers: {alias العمود: عنوانه في الملف}.
+    ترفع ValueError عند طلب غير صالح.
     """
-    try:
-        data = await request.get_json()
-        if not data:
-            return jsonify({"error": "Invalid JSON payload"}), 400
+    # --- 1. استخلاص الحقول والفلاتر من الطلب ---
+    requested_field_keys = data.get('fields', [])
+
+    # ⭐ تصحيح الخطأ الأول: تحويل القيم إلى str قبل استخدام .strip()
+    search_term = str(data.get('search', "")).strip()
+    status_filter = str(data.get("status", "")).strip().lower()
+    type_filter_id_str = str(data.get("subscription_type_id", "")).strip()
+    plan_filter_id_str = str(data.get("subscription_plan_id", "")).strip()
+    source_filter = str(data.get("source", "")).strip()
+    start_date_filter = str(data.get("start_date", "")).strip()
+    end_date_filter = str(data.get("end_date", "")).strip()
+
+    # --- 2. بناء جملة SELECT الديناميكية ---
+    fields_to_query_map = {}
+    if not requested_field_keys:
+        for key, details in AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS.items():
+            fields_to_query_map[key] = details["db_col"]
+    else:
+        for key in requested_field_keys:
+            if key in AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS:
+                fields_to_query_map[key] = AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS[key]["db_col"]
+            else:
+                logging.warning(f"Requested field '{key}' not available for export and will be ignored.")
 
-        # --- 1. استخلاص الحقول والفلاتر من الطلب ---
-        requested_field_keys = data.get('fields', [])
-
-        # ⭐ تصحيح الخطأ الأول: تحويل القيم إلى str قبل استخدام .strip()
-        search_term = str(data.get('search', "")).strip()
-        status_filter = str(data.get("status", "")).strip().lower()
-        type_filter_id_str = str(data.get("subscription_type_id", "")).strip()
-        plan_filter_id_str = str(data.get("subscription_plan_id", "")).strip()
-        source_filter = str(data.get("source", "")).strip()
-        start_date_filter = str(data.get("start_date", "")).strip()
-        end_date_filter = str(data.get("end_date", "")).strip()
-
-        # --- 2. بناء جملة SELECT الديناميكية ---
-        fields_to_query_map = {}
-        if not requested_field_keys:
-            for key, details in AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS.items():
-                fields_to_query_map[key] = details["db_col"]
-        else:
-            for key in requested_field_keys:
-                if key in AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS:
-                    fields_to_query_map[key] = AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS[key]["db_col"]
-                else:
-                    logging.warning(f"Requested field '{key}' not available for export and will be ignored.")
+    if not fields_to_query_map:
+        raise ValueError("No valid fields selected for export")
 
-        if not fields_to_query_map:
-            return jsonify({"error": "No valid fields selected for export"}), 400
+    select_clauses = [f'{db_expr} AS "{alias_key}"' for alias_key, db_expr in fields_to_query_map.items()]
+    dynamic_select_sql = ", ".join(select_clauses)
 
-        select_clauses = [f'{db_expr} AS "{alias_key}"' for alias_key, db_expr in fields_to_query_map.items()]
-        dynamic_select_sql = ", ".join(select_clauses)
+    # --- 3. بناء جملة WHERE الديناميكية ومعاملاتها ---
+    where_clauses = []
+    query_params = []
+    param_idx = 1
 
-        # --- 3. بناء جملة WHERE الديناميكية ومعاملاتها ---
-        where_clauses = []
-        query_params = []
-        param_idx = 1
+    if status_filter and status_filter != "all":
+        where_clauses.append(f"status_label = ${param_idx}")
+        query_params.append(status_filter)
+        param_idx += 1
 
-        if status_filter and status_filter != "all":
-            where_clauses.append(f"status_label = ${param_idx}")
-            query_params.append(status_filter)
-            param_idx += 1
+    if type_filter_id_str and type_filter_id_str.isdigit():
+        where_clauses.append(f"subscription_type_id = ${param_idx}")
+        query_params.append(int(type_filter_id_str))
+        param_idx += 1
 
-        if type_filter_id_str and type_filter_id_str.isdigit():
-            where_clauses.append(f"subscription_type_id = ${param_idx}")
-            query_params.append(int(type_filter_id_str))
-            param_idx += 1
+    if plan_filter_id_str and plan_filter_id_str.isdigit():
+        where_clauses.append(f"subscription_plan_id = ${param_idx}")
+        query_params.append(int(plan_filter_id_str))
+        param_idx += 1
+
+    if source_filter and source_filter != "all":
+        where_clauses.append(f"source ILIKE ${param_idx}")
+        query_params.append(source_filter)
+        param_idx += 1
 
-        if plan_filter_id_str and plan_filter_id_str.isdigit():
-            where_clauses.append(f"subscription_plan_id = ${param_idx}")
-            query_params.append(int(plan_filter_id_str))
+    if start_date_filter:
+        try:
+            start_date_obj = datetime.strptime(start_date_filter, '%Y-%m-%d').date()
+            where_clauses.append(f"created_at >= ${param_idx}")
+            query_params.append(start_date_obj)
             param_idx += 1
+        except ValueError:
+            raise ValueError("Invalid start_date format. Use YYYY-MM-DD.")
 
-        if source_filter and source_filter != "all":
-            where_clauses.append(f"source ILIKE ${param_idx}")
-            query_params.append(source_filter)
+    if end_date_filter:
+        try:
+            end_date_obj = datetime.strptime(end_date_filter, '%Y-%m-%d').date()
+            where_clauses.append(f"created_at < (${param_idx}::DATE + INTERVAL '1 day')")
+            query_params.append(end_date_obj)
             param_idx += 1
+        except ValueError:
+            raise ValueError("Invalid end_date format. Use YYYY-MM-DD.")
 
-        if start_date_filter:
-            try:
-                start_date_obj = datetime.strptime(start_date_filter, '%Y-%m-%d').date()
-                where_clauses.append(f"created_at >= ${param_idx}")
-                query_params.append(start_date_obj)
-                param_idx += 1
-            except ValueError:
-                return jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD."}), 400
+    search_sql = user_search_condition(
+        search_term, query_params,
+        telegram_id_col="telegram_id", users_lookup=True, extra_cols=("payment_token",),
+        extra_predicates=(_SUBSCRIPTION_TYPE_NAME_SEARCH,))
+    if search_sql:
+        where_clauses.append(search_sql)
+        param_idx = len(query_params) + 1
 
-        if end_date_filter:
-            try:
-                end_date_obj = datetime.strptime(end_date_filter, '%Y-%m-%d').date()
-                where_clauses.append(f"created_at < (${param_idx}::DATE + INTERVAL '1 day')")
-                query_params.append(end_date_obj)
-                param_idx += 1
-            except ValueError:
-                return jsonify({"error": "Invalid end_date format. Use YYYY-MM-DD."}), 400
+    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
 
-        if search_term:
-            search_pattern = f"%{search_term}%"
-            search_conditions = [
-                "full_name ILIKE $1",
-                "username ILIKE $1",
-                "telegram_id::TEXT ILIKE $1",
-                "payment_token ILIKE $1",
-                "subscription_type_name ILIKE $1",
-            ]
-            # تعديل بسيط هنا لضمان استخدام البارامتر الصحيح
-            param_placeholder = f'${param_idx}'
-            where_clauses.append(f"({' OR '.join(c.replace('$1', param_placeholder) for c in search_conditions)})")
-            query_params.append(search_pattern)
-            param_idx += 1
+    # --- 4. بناء الاستعلام النهائي الكامل ---
+    final_query = f"""
+        WITH base_subscriptions AS (
+            SELECT
+                s.*,
+                u.full_name, u.username,
+                st.name AS subscription_type_name,
+                sp.name AS subscription_plan_name,
+                CASE 
+                    WHEN s.is_active AND s.expiry_date > NOW() 
+                    THEN EXTRACT(DAY FROM s.expiry_date - NOW())::INTEGER
+                    ELSE 0
+                END AS days_remaining,
+                CASE
+                    WHEN s.expiry_date <= NOW() THEN 'expired'
+                    WHEN NOT s.is_active THEN 'inactive'
+                    WHEN s.expiry_date <= NOW() + INTERVAL '7 days' THEN 'expiring_soon'
+                    ELSE 'active'
+                END AS status_label
+            FROM subscriptions s
+            LEFT JOIN users u ON s.telegram_id = u.telegram_id
+            LEFT JOIN subscription_types st ON s.subscription_type_id = st.id
+            LEFT JOIN subscription_plans sp ON s.subscription_plan_id = sp.id
+        ),
+        filtered_subscriptions AS (
+            SELECT * FROM base_subscriptions
+            WHERE {where_sql}
+        )
+        SELECT {dynamic_select_sql}
+        FROM filtered_subscriptions fs
+        ORDER BY fs.id DESC
+    """
+    logging.debug(f"Export query: {final_query} with params: {query_params}")
+    headers = {alias_key: AVAILABLE_SUBSCRIPTION_EXPORT_FIELDS[alias_key]["header"]
+               for alias_key in fields_to_query_map}
+    return final_query, query_params, headers
 
-        where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
 
-        # --- 4. بناء الاستعلام النهائي الكامل ---
-        final_query = f"""
-            WITH base_subscriptions AS (
-                SELECT
-                    s.*,
-                    u.full_name, u.username,
-                    st.name AS subscription_type_name,
-                    sp.name AS subscription_plan_name,
-                    CASE 
-                        WHEN s.is_active AND s.expiry_date > NOW() 
-                        THEN EXTRACT(DAY FROM s.expiry_date - NOW())::INTEGER
-                        ELSE 0
-                    END AS days_remaining,
-                    CASE
-                        WHEN s.expiry_date <= NOW() THEN 'expired'
-                        WHEN NOT s.is_active THEN 'inactive'
-                        WHEN s.expiry_date <= NOW() + INTERVAL '7 days' THEN 'expiring_soon'
-                        ELSE 'active'
-                    END AS status_label
-                FROM subscriptions s
-                LEFT JOIN users u ON s.telegram_id = u.telegram_id
-                LEFT JOIN subscription_types st ON s.subscription_type_id = st.id
-                LEFT JOIN subscription_plans sp ON s.subscription_plan_id = sp.id
-            ),
-            filtered_subscriptions AS (
-                SELECT * FROM base_subscriptions
-                WHERE {where_sql}
-            )
-            SELECT {dynamic_select_sql}
-            FROM filtered_subscriptions fs
-            ORDER BY fs.id DESC
-        """
-        logging.debug(f"Export query: {final_query} with params: {query_params}")
+@admin_routes.route("/subscriptions/export", methods=["POST"])
+@permission_required("bot_users.export")
+async def export_subscriptions_endpoint():
+    """
+    نقطة نهاية لتصدير بيانات الاشتراكات إلى ملف Excel مع تطبيق فلاتر متقدمة.
+    """
+    try:
+        data = await request.get_json()
+        if not data:
+            return jsonify({"error": "Invalid JSON payload"}), 400
+
+        try:
+            export_format, stream_export = parse_export_format(data)
+            final_query, query_params, headers = build_subscriptions_export_query(data)
+        except ValueError as ve:
+            return jsonify({"error": str(ve)}), 400
+
+        if stream_export:
+            return streaming_export_response(current_app.db_pool, final_query, query_params, headers,
+                                             export_format, "subscriptions_export", sheet_name='Subscriptions Data')
 
         # --- 5. جلب البيانات من قاعدة البيانات ---
         async with current_app.db_pool.acquire() as conn:
@@ -4001,54 +4245,164 @@ async def export_subscriptions_endpoint():
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
 
 
+# ==============================================================================
+# 📦 Background Export Jobs
+# ==============================================================================
+# الطلب يرجع معرف المهمة فورًا، و ExportJobWorker (services/export_jobs.py) يكتب الملف على القرص.
+# نفس الطلب خلال EXPORT_JOB_REUSE_SECONDS يعيد نفس المهمة / الملف بدل تصدير جديد.
+
+EXPORT_JOB_TYPES = {
+    "users": (build_users_export_query, "users_export", "Users Data"),
+    "subscriptions": (build_subscriptions_export_query, "subscriptions_export", "Subscriptions Data"),
+}
+
+
+def _serialize_export_job(job: dict) -> dict:
+    total_rows = job.get("total_rows")
+    progress = None
+    if job["status"] == "completed":
+        progress = 100.0
+    elif total_rows:
+        progress = round(min(job["rows_written"] / total_rows, 1) * 100, 1)
+    return {
+        "job_id": job["id"],
+        "export_type": job["export_type"],
+        "format": job["export_format"],
+        "status": job["status"],
+        "rows_written": job["rows_written"],
+        "total_rows": total_rows,
+        "progress": progress,
+        "file_size": job.get("file_size"),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "completed_at": job["completed_at"].isoformat() if job.get("completed_at") else None,
+        "download_url": f"/api/admin/export-jobs/{job['id']}/download" if job["status"] == "completed" else None,
+    }
+
+
+async def _create_export_job(export_type: str):
+    data = await request.get_json()
+    if not data:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+
+    builder = EXPORT_JOB_TYPES[export_type][0]
+    try:
+        export_format, _ = parse_export_format(data)
+        builder(data)  # التحقق من الحقول والفلاتر قبل إضافة المهمة
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    params = {key: value for key, value in data.items() if key not in ("format", "stream")}
+    current_user_data = await get_current_user()
+    async with current_app.db_pool.acquire() as conn:
+        job, reused = await enqueue_export_job(
+            conn, export_type, export_format, params,
+            export_params_hash(export_type, export_format, params),
+            current_user_data["email"], reuse_seconds=EXPORT_JOB_REUSE_SECONDS)
+
+    if not reused and current_app.export_worker:
+        current_app.export_worker.wake()
+    return jsonify({**_serialize_export_job(job), "reused": reused}), 202
+
+
+@admin_routes.route("/users/export/jobs", methods=["POST"])
+@permission_required("bot_users.export")
+async def create_users_export_job():
+    """نفس جسم POST /users/export، لكن التصدير يتم في الخلفية."""
+    try:
+        return await _create_export_job("users")
+    except Exception as e:
+        logging.error(f"Error creating users export job: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@admin_routes.route("/subscriptions/export/jobs", methods=["POST"])
+@permission_required("bot_users.export")
+async def create_subscriptions_export_job():
+    """نفس جسم POST /subscriptions/export، لكن التصدير يتم في الخلفية."""
+    try:
+        return await _create_export_job("subscriptions")
+    except Exception as e:
+        logging.error(f"Error creating subscriptions export job: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@admin_routes.route("/export-jobs/<int:job_id>", methods=["GET"])
+@permission_required("bot_users.export")
+async def get_export_job_status(job_id):
+    # الصلاحية وحدها لا تكفي: المهمة وملفها لمن أنشأها فقط (404 لغيره حتى لا يُكشف وجودها)
+    current_user_data = await get_current_user()
+    async with current_app.db_pool.acquire() as conn:
+        job = await get_export_job(conn, job_id, current_user_data["email"])
+    if not job:
+        return jsonify({"error": "Export job not found"}), 404
+    return jsonify(_serialize_export_job(job)), 200
+
+
+@admin_routes.route("/export-jobs/<int:job_id>/download", methods=["GET"])
+@permission_required("bot_users.export")
+async def download_export_job(job_id):
+    current_user_data = await get_current_user()
+    async with current_app.db_pool.acquire() as conn:
+        job = await get_export_job(conn, job_id, current_user_data["email"])
+    if not job:
+        return jsonify({"error": "Export job not found"}), 404
+    if job["status"] != "completed":
+        return jsonify({"error": "Export is not ready yet", "status": job["status"]}), 409
+    if not job["file_path"] or not os.path.exists(job["file_path"]):
+        return jsonify({"error": "Export file is no longer available"}), 410
+
+    filename_prefix = EXPORT_JOB_TYPES[job["export_type"]][1]
+    timestamp = job["completed_at"].strftime("%Y%m%d_%H%M%S")
+    return await send_file(
+        job["file_path"],
+        mimetype=EXPORT_MIMETYPES[job["export_format"]],
+        as_attachment=True,
+        attachment_filename=f"{filename_prefix}_{timestamp}.{job['export_format']}",
+    )
+
+
 @admin_routes.route("/dashboard/stats", methods=["GET"])
 @permission_required("dashboard.view_stats")
 async def get_dashboard_stats():
     try:
         async with current_app.db_pool.acquire() as conn:
-            # الإحصائيات الأساسية
+            # الإحصائيات الأساسية من جداول التجميع اليومية (services/dashboard_rollups.py)
+            # بدل مسح payments و users و subscriptions في كل تحميل للصفحة
             stats_query = """
                 SELECT 
                     -- إجمالي الاشتراكات النشطة
-                    (SELECT COUNT(*) FROM subscriptions WHERE is_active = true) as active_subscriptions,
+                    (SELECT COALESCE(SUM(active_subscriptions), 0) FROM daily_subscription_events) as active_subscriptions,
 
                     -- إجمالي المدفوعات المكتملة
-                    (SELECT COUNT(*) FROM payments WHERE status = 'completed') as completed_payments,
+                    (SELECT COALESCE(SUM(payments_count), 0) FROM daily_revenue WHERE status = 'completed') as completed_payments,
 
                     -- إجمالي الإيرادات من المدفوعات المكتملة بعملة USDT فقط
-                    (SELECT COALESCE(SUM(amount_received), 0) FROM payments WHERE status = 'completed' AND currency = 'USDT') as total_revenue,
-
-                    -- إجمالي عدد المستخدمين من جدول users
-                    (SELECT COUNT(*) FROM users) as total_users,
+                    (SELECT COALESCE(SUM(amount_received), 0) FROM daily_revenue WHERE status = 'completed' AND currency = 'USDT') as total_revenue,
 
-                    -- عدد المستخدمين الجدد آخر 30 يومًا من جدول users
-                    (SELECT COUNT(*) FROM users 
-                     WHERE created_at >= CURRENT_TIMESTAMP - INTERVAL '30 days') as new_users_last_30_days,
+                    -- إجمالي عدد المستخدمين
+                    (SELECT COALESCE(SUM(new_users), 0) FROM daily_new_users) as total_users,
 
-                    -- الاشتراكات التي تنتهي صلاحيتها خلال 7 أيام القادمة
-                    (SELECT COUNT(*) FROM subscriptions 
-                     WHERE is_active = true 
-                     AND expiry_date BETWEEN CURRENT_TIMESTAMP AND CURRENT_TIMESTAMP + INTERVAL '7 days') as expiring_soon,
+                    -- عدد المستخدمين الجدد آخر 30 يومًا (أيام UTC، تشمل اليوم الحالي)
+                    (SELECT COALESCE(SUM(new_users), 0) FROM daily_new_users 
+                     WHERE day > $1::DATE - 30) as new_users_last_30_days,
 
                     -- إجمالي المدفوعات غير المكتملة (فاشلة، ملغاة، دفع ناقص)
-                    (SELECT COUNT(*) FROM payments 
-                     WHERE status IN ('failed', 'canceled', 'underpaid')) as total_failed_payments
+                    (SELECT COALESCE(SUM(payments_count), 0) FROM daily_revenue 
+                     WHERE status IN ('failed', 'canceled', 'underpaid')) as total_failed_payments,
+
+                    -- المستخدمون الجدد في الثلاثين يومًا التي سبقتها (لحساب نسبة النمو)
+                    (SELECT COALESCE(SUM(new_users), 0) FROM daily_new_users 
+                     WHERE day > $1::DATE - 60 AND day <= $1::DATE - 30) as previous_period_count
             """
 
-            stats_row = await conn.fetchrow(stats_query)
+            stats_row = await conn.fetchrow(stats_query, datetime.now(timezone.utc).date())
             stats = dict(stats_row) if stats_row else {}
+            previous_period_count = stats.pop('previous_period_count', 0)
 
-            # حساب نسبة النمو للمستخدمين الجدد (آخر 30 يومًا مقارنة بالـ 30 يومًا التي سبقتها)
-            # المستخدمون الجدد في الفترة من (اليوم - 60 يومًا) إلى (اليوم - 30 يومًا)
-            previous_30_days_new_users_query = """
-                SELECT COUNT(*) as previous_period_count
-                FROM users 
-                WHERE created_at >= CURRENT_TIMESTAMP - INTERVAL '60 days'
-                AND created_at < CURRENT_TIMESTAMP - INTERVAL '30 days'
-            """
-
-            previous_period_row = await conn.fetchrow(previous_30_days_new_users_query)
-            previous_period_count = previous_period_row['previous_period_count'] if previous_period_row else 0
+            # الاشتراكات التي تنتهي صلاحيتها خلال 7 أيام القادمة (من subscription_status_rollup)
+            status_counts = await get_subscription_status_counts(conn)
+            stats['expiring_soon'] = status_counts['expiring_soon_count']
 
             current_new_users = stats.get('new_users_last_30_days', 0)
             growth_percentage = 0
@@ -4077,37 +4431,35 @@ async def get_revenue_chart():
             if period == "7days":
                 query = """
                     SELECT 
-                        DATE(created_at) as date,
-                        COALESCE(SUM(amount_received), 0) as revenue
-                    FROM payments 
+                        day as date,
+                        amount_received as revenue
+                    FROM daily_revenue 
                     WHERE status = 'completed' 
                     AND currency = 'USDT'
-                    AND created_at >= CURRENT_DATE - INTERVAL '7 days'
-                    GROUP BY DATE(created_at)
+                    AND day >= CURRENT_DATE - 7
                     ORDER BY date
                 """
             elif period == "30days":
                 query = """
                     SELECT 
-                        DATE(created_at) as date,
-                        COALESCE(SUM(amount_received), 0) as revenue
-                    FROM payments 
+                        day as date,
+                        amount_received as revenue
+                    FROM daily_revenue 
                     WHERE status = 'completed' 
                     AND currency = 'USDT'
-                    AND created_at >= CURRENT_DATE - INTERVAL '30 days'
-                    GROUP BY DATE(created_at)
+                    AND day >= CURRENT_DATE - 30
                     ORDER BY date
                 """
             else:  # 6months
                 query = """
                     SELECT 
-                        DATE_TRUNC('month', created_at) as date,
+                        DATE_TRUNC('month', day) as date,
                         COALESCE(SUM(amount_received), 0) as revenue
-                    FROM payments 
+                    FROM daily_revenue 
                     WHERE status = 'completed' 
                     AND currency = 'USDT'
-                    AND created_at >= CURRENT_DATE - INTERVAL '6 months'
-                    GROUP BY DATE_TRUNC('month', created_at)
+                    AND day >= CURRENT_DATE - INTERVAL '6 months'
+                    GROUP BY DATE_TRUNC('month', day)
                     ORDER BY date
                 """
 
@@ -4132,14 +4484,14 @@ async def get_revenue_chart():
 async def get_subscriptions_chart():
     try:
         async with current_app.db_pool.acquire() as conn:
-            # إحصائيات الاشتراكات حسب النوع
+            # إحصائيات الاشتراكات حسب النوع (من daily_subscription_events)
             query = """
                 SELECT 
                     st.name as subscription_type,
-                    COUNT(s.id) as count,
-                    COUNT(CASE WHEN s.is_active = true THEN 1 END) as active_count
+                    COALESCE(SUM(e.new_subscriptions), 0) as count,
+                    COALESCE(SUM(e.active_subscriptions), 0) as active_count
                 FROM subscription_types st
-                LEFT JOIN subscriptions s ON st.id = s.subscription_type_id
+                LEFT JOIN daily_subscription_events e ON st.id = e.subscription_type_id
                 WHERE st.is_active = true
                 GROUP BY st.id, st.name
                 ORDER BY count DESC
@@ -4353,79 +4705,33 @@ async def get_latest_batch_for_type(type_id: int):
 @admin_routes.route("/messaging/target-groups", methods=["GET"])
 @permission_required("broadcast.read")
 async def get_target_groups():
-    """يجلب قائمة بمجموعات الاستهداف المتاحة مع إحصائياتها."""
+    """يجلب قائمة بمجموعات الاستهداف المتاحة مع إحصائياتها (من شرائح الجمهور في الذاكرة)."""
     try:
         async with current_app.db_pool.acquire() as conn:
-            # إحصائيات أساسية
-            stats = {}
-
-            # جميع المستخدمين
-            # ✅ --- تعديل: إزالة شرط is_active من جدول users ---
-            all_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            stats['all_users'] = all_users
-
-            # المستخدمون بدون اشتراكات
-            # ✅ --- تعديل: إزالة شرط u.is_active ---
-            no_subscription = await conn.fetchval("""
-                SELECT COUNT(DISTINCT u.telegram_id) 
-                FROM users u 
-                LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                WHERE s.telegram_id IS NULL
-            """)
-            stats['no_subscription'] = no_subscription
-
-            # المشتركون النشطون حاليا (هنا نستخدم s.is_active وهذا صحيح)
-            active_subscribers = await conn.fetchval("""
-                SELECT COUNT(DISTINCT u.telegram_id) 
-                FROM users u 
-                JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                WHERE s.is_active = true AND s.expiry_date > NOW()
-            """)
-            stats['active_subscribers'] = active_subscribers
-
-            # المشتركون المنتهيو الصلاحية (هنا لا نحتاج لفلترة المستخدمين، فقط الاشتراكات)
-            # ✅ --- تعديل: إزالة شرط u.is_active ---
-            expired_subscribers = await conn.fetchval("""
-    -- ببساطة نعدّ كل مستخدم فريد لديه اشتراك منتهٍ واحد على الأقل
-    SELECT COUNT(DISTINCT telegram_id)
-    FROM subscriptions
-    WHERE expiry_date <= NOW()
-""")
-            stats['expired_subscribers'] = expired_subscribers
-
-
-            # إحصائيات حسب نوع الاشتراك
-            # ✅ --- تعديل: إزالة شرط st.is_active إذا كان لا يوجد في جدول subscription_types ---
-            # إذا كان العمود موجودًا، فاترك هذا الاستعلام كما هو. سأفترض أنه موجود.
+            segments = await audience_segments.get(conn)
             subscription_types = await conn.fetch("""
-                SELECT 
-                    st.id, 
-                    st.name,
-                    COUNT(CASE WHEN s.is_active = true AND s.expiry_date > NOW() THEN 1 END) as active_count,
-                    COUNT(CASE WHEN s.expiry_date <= NOW() THEN 1 END) as expired_count
-                FROM subscription_types st
-                LEFT JOIN subscriptions s ON st.id = s.subscription_type_id
-                WHERE st.is_active = true
-                GROUP BY st.id, st.name
-                ORDER BY st.name
+                SELECT id, name FROM subscription_types
+                WHERE is_active = true
+                ORDER BY name
             """)
 
-            # ... (باقي الكود كما هو) ...
-            subscription_stats = []
-            for row in subscription_types:
-                subscription_stats.append({
-                    'id': row['id'],
-                    'name': row['name'],
-                    'active_count': row['active_count'],
-                    'expired_count': row['expired_count'],
-                    'total_count': row['active_count'] + row['expired_count']
-                })
-
-            return jsonify({
-                'general_stats': stats,
-                'subscription_types': subscription_stats
+        subscription_stats = []
+        for row in subscription_types:
+            active_count = len(segments.resolve('subscription_type_active', row['id']))
+            expired_count = len(segments.resolve('subscription_type_expired', row['id']))
+            subscription_stats.append({
+                'id': row['id'],
+                'name': row['name'],
+                'active_count': active_count,
+                'expired_count': expired_count,
+                'total_count': active_count + expired_count
             })
 
+        return jsonify({
+            'general_stats': segments.general_stats(),
+            'subscription_types': subscription_stats
+        })
+
     except Exception as e:
         logging.error(f"Error fetching target groups: {str(e)}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
@@ -4434,127 +4740,41 @@ async def get_target_groups():
 @admin_routes.route("/messaging/preview-users", methods=["POST"])
 @permission_required("broadcast.read")
 async def preview_target_users():
-    """يعرض عينة من المستخدمين الذين سيتم استهدافهم."""
+    """يعرض عينة من المستخدمين الذين سيتم استهدافهم (نفس الشريحة التي يرسل لها البث)."""
     try:
         data = await request.get_json()
         target_group = data.get("target_group")
         subscription_type_id = data.get("subscription_type_id")
-        limit = min(int(data.get("limit", 10)), 50)
+        limit = max(1, min(int(data.get("limit", 10)), 50))
+        search_term = str(data.get("search", "")).strip()
 
-        # ✨ تعريف المتغيرات مبدئياً لتجنب أي مشاكل
-        base_query = None
-        count_query = None
-        final_query = None
-        query_params = []
-        count_query_params = []
-
-        if target_group == 'all_users':
-            base_query = "SELECT u.id, u.telegram_id, u.full_name, u.username, NULL as subscription_name, NULL as expiry_date FROM users u"
-            count_query = "SELECT COUNT(u.id) FROM users u"
-            # تعيين final_query هنا مباشرة
-            final_query = f"{base_query} ORDER BY u.id DESC LIMIT ${len(query_params) + 1}"
-
-        elif target_group == 'no_subscription':
-            base_query = """
-                SELECT DISTINCT ON (u.telegram_id) u.id, u.telegram_id, u.full_name, u.username,
-                       NULL as subscription_name, NULL as expiry_date
-                FROM users u 
-                LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                WHERE s.id IS NULL
-            """
-            count_query = "SELECT COUNT(DISTINCT u.telegram_id) FROM users u LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id WHERE s.id IS NULL"
-            # الترتيب هنا ضروري لـ DISTINCT ON
-            final_query = f"{base_query} ORDER BY u.telegram_id, u.id DESC LIMIT ${len(query_params) + 1}"
-
-        elif target_group == 'active_subscribers':
-            base_query = """
-                SELECT DISTINCT ON (u.telegram_id) u.id, u.telegram_id, u.full_name, u.username,
-                       st.name as subscription_name, s.expiry_date
-                FROM users u 
-                JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                JOIN subscription_types st ON s.subscription_type_id = st.id
-                WHERE s.is_active = true AND s.expiry_date > NOW()
-            """
-            count_query = "SELECT COUNT(DISTINCT u.telegram_id) FROM users u JOIN subscriptions s ON u.telegram_id = s.telegram_id WHERE s.is_active = true AND s.expiry_date > NOW()"
-            # الترتيب هنا ضروري لـ DISTINCT ON
-            final_query = f"{base_query} ORDER BY u.telegram_id, u.id DESC LIMIT ${len(query_params) + 1}"
-
-        elif target_group == 'expired_subscribers':
-            base_query = """
-                SELECT DISTINCT ON (u.telegram_id) u.id, u.telegram_id, u.full_name, u.username,
-                       st.name as subscription_name, s.expiry_date
-                FROM users u
-                JOIN subscriptions s ON u.telegram_id = s.telegram_id
-                JOIN subscription_types st ON s.subscription_type_id = st.id
-                WHERE s.expiry_date <= NOW()
-            """
-            # count_query: ببساطة يعد كل مستخدم فريد لديه اشتراك منتهٍ.
-            count_query = """
-                SELECT COUNT(DISTINCT telegram_id)
-                FROM subscriptions
-                WHERE expiry_date <= NOW()
-            """
-            # الترتيب هنا يضمن أننا نأخذ أحدث اشتراك منتهٍ لكل مستخدم
-            final_query = f"{base_query} ORDER BY u.telegram_id, s.expiry_date DESC LIMIT ${len(query_params) + 1}"
-
-        elif target_group == 'subscription_type_active' and subscription_type_id:
-            base_query = """
-                SELECT u.id, u.telegram_id, u.full_name, u.username,
-                       st.name as subscription_name, s.expiry_date
-                FROM users u 
-                JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                JOIN subscription_types st ON s.subscription_type_id = st.id
-                WHERE s.subscription_type_id = $1 AND s.is_active = true AND s.expiry_date > NOW()
-            """
-            count_query = "SELECT COUNT(u.id) FROM users u JOIN subscriptions s ON u.telegram_id = s.telegram_id WHERE s.subscription_type_id = $1 AND s.is_active = true AND s.expiry_date > NOW()"
-            query_params.append(subscription_type_id)
-            count_query_params.append(subscription_type_id)
-            # تعيين final_query هنا مباشرة
-            final_query = f"{base_query} ORDER BY u.id DESC LIMIT ${len(query_params) + 1}"
-
-        elif target_group == 'subscription_type_expired' and subscription_type_id:
-            base_query = """
-                SELECT u.id, u.telegram_id, u.full_name, u.username,
-                       st.name as subscription_name, s.expiry_date
-                FROM users u 
-                JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                JOIN subscription_types st ON s.subscription_type_id = st.id
-                WHERE s.subscription_type_id = $1 AND s.expiry_date <= NOW()
-            """
-            count_query = "SELECT COUNT(u.id) FROM users u JOIN subscriptions s ON u.telegram_id = s.telegram_id WHERE s.subscription_type_id = $1 AND s.expiry_date <= NOW()"
-            query_params.append(subscription_type_id)
-            count_query_params.append(subscription_type_id)
-            # تعيين final_query هنا مباشرة
-            final_query = f"{base_query} ORDER BY u.id DESC LIMIT ${len(query_params) + 1}"
-
-        # إذا لم يتطابق أي شرط، فلن يكون final_query معرفًا
-        if not final_query:
-            return jsonify({"error": "Invalid target group or missing parameters"}), 400
-
-        # تمت إزالة كتلة `if` المنفصلة من هنا
+        async with current_app.db_pool.acquire() as conn:
+            segments = await audience_segments.get(conn)
+            try:
+                telegram_ids = segments.resolve(target_group, subscription_type_id)
+            except ValueError:
+                return jsonify({"error": "Invalid target group or missing parameters"}), 400
 
-        query_params.append(limit)
+            # الأحدث تسجيلًا أولًا
+            users, total_count = await preview_segment_users(conn, target_group, telegram_ids, subscription_type_id,
+                                                             search_term=search_term, limit=limit)
 
-        async with current_app.db_pool.acquire() as conn:
-            users = await conn.fetch(final_query, *query_params)
-            total_count = await conn.fetchval(count_query, *count_query_params)
-
-            users_data = [
-                {
-                    'telegram_id': user['telegram_id'],
-                    'full_name': user['full_name'],
-                    'username': user['username'],
-                    'subscription_name': user['subscription_name'],
-                    'expiry_date': user['expiry_date'].isoformat() if user.get('expiry_date') else None,
-                }
-                for user in users
-            ]
+        users_data = [
+            {
+                'telegram_id': user['telegram_id'],
+                'full_name': user['full_name'],
+                'username': user['username'],
+                'subscription_name': user['subscription_name'],
+                'expiry_date': user['expiry_date'].isoformat() if user.get('expiry_date') else None,
+            }
+            for user in users
+        ]
 
-            return jsonify({
-                'users': users_data,
-                'total_count': total_count,
-                'showing_count': len(users_data)
-            })
+        return jsonify({
+            'users': users_data,
+            'total_count': total_count,
+            'showing_count': len(users_data)
+        })
 
     except Exception as e:
         logging.error(f"Error in preview_target_users: {str(e)}", exc_info=True)
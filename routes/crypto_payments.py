@@ -1,13 +1,10 @@
 import os
 import logging
 import json
-import io
-import base64
 from uuid import uuid4
 
 from datetime import datetime, timedelta, timezone
 
-import qrcode
 import requests
 import httpx  # لإجراء الطلبات غير المتزامنة
 from quart import Blueprint, request, jsonify, current_app
@@ -19,6 +16,7 @@ from join_handler_test import get_child_wallet
 from utils.retry import fetch_bscscan_data
 # استيراد دالة التحقق من التأكيدات باستخدام web3.py
 from services.confirmation_checker import is_transaction_confirmed
+from utils.qr_utils import get_qr_data_uri
 
 crypto_payment_bp = Blueprint("crypto_payments", __name__)
 
@@ -97,20 +95,14 @@ async def create_payment():
             except Exception as conn_err:
                 logging.error(f"❌ خطأ أثناء تسجيل البيانات في telegram_payments: {conn_err}")
 
-        # توليد رمز QR للعنوان
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(child_wallet["address"])
-        qr.make(fit=True)
-        img = qr.make_image(fill="black", back_color="white")
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        qr_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+        # توليد رمز QR للعنوان داخل منفذ خيوط حتى لا تُحجب حلقة الأحداث (العنوان فريد لكل دفعة، فلا تخزين)
+        qr_data_uri = await get_qr_data_uri(child_wallet["address"], cache=False)
 
         response_data = {
             "deposit_address": child_wallet["address"],
             "network": "BEP-20",
             "amount": amount,
-            "qr_code": f"data:image/png;base64,{qr_b64}",
+            "qr_code": qr_data_uri,
             "payment_token": payment_token
         }
         logging.info("✅ تم إنشاء سجل الدفع بنجاح.")
@@ -121,6 +113,7 @@ async def create_payment():
         return jsonify({"error": "Internal server error"}), 500
 
 
+
 @crypto_payment_bp.route("/api/verify-payment", methods=["POST"])
 async def verify_payment():
     logging.info("🔔 تم استدعاء نقطة API /api/verify-payment")
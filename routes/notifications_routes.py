@@ -2,7 +2,15 @@ import asyncio
 import json
 import logging
 from quart import Blueprint, request, jsonify, current_app, Response
-from database.db_queries import get_unread_notifications_count
+from database.db_queries import (
+    get_unread_notifications_count,
+    get_public_notification_for_user,
+    mark_public_notification_read,
+    mark_public_notifications_read_by_type,
+    advance_public_notifications_watermark,
+    PUBLIC_NOTIFICATIONS_VIEWER_CTE,
+    PUBLIC_NOTIFICATIONS_FOR_VIEWER,
+)
 
 
 # ==============================================================================
@@ -41,15 +49,24 @@ async def get_notifications():
             return jsonify({"error": "telegram_id is required"}), 400
 
         async with current_app.db_pool.acquire() as connection:
-            query = """
-                SELECT n.id, n.type, n.title, n.message, n.extra_data, n.created_at, un.read_status
-                FROM notifications n JOIN user_notifications un ON n.id = un.notification_id
-                WHERE un.telegram_id = $1
+            # الإشعارات الخاصة من user_notifications + الإشعارات العامة (صف واحد لكل إعلان)
+            # مع حالة قراءة محسوبة من العلامة المائية والاستثناءات، ثم دمجها وترتيبها معًا
+            query = f"""
+                WITH {PUBLIC_NOTIFICATIONS_VIEWER_CTE},
+                merged AS (
+                    SELECT n.id, n.type, n.title, n.message, n.extra_data, n.created_at,
+                           COALESCE(un.read_status, FALSE) AS read_status
+                    FROM notifications n JOIN user_notifications un ON n.id = un.notification_id
+                    WHERE un.telegram_id = $1
+                    UNION ALL
+                    {PUBLIC_NOTIFICATIONS_FOR_VIEWER}
+                )
+                SELECT * FROM merged
             """
             params = [int(telegram_id)]
             if filter_type == "unread":
-                query += " AND un.read_status = FALSE"
-            query += " ORDER BY n.created_at DESC OFFSET $2 LIMIT $3;"
+                query += " WHERE read_status = FALSE"
+            query += " ORDER BY created_at DESC OFFSET $2 LIMIT $3;"
             params.extend([int(offset), int(limit)])
             results = await connection.fetch(query, *params)
 
@@ -83,6 +100,11 @@ async def get_notification_details(notification_id):
                 WHERE n.id = $1 AND un.telegram_id = $2
             """
             notification_record = await connection.fetchrow(query, notification_id, int(telegram_id))
+            is_public = False
+            if not notification_record:
+                notification_record = await get_public_notification_for_user(
+                    connection, int(telegram_id), notification_id)
+                is_public = True
             if not notification_record:
                 return jsonify({"error": "Notification not found"}), 404
 
@@ -98,8 +120,11 @@ async def get_notification_details(notification_id):
                 notification_data["subscription_history"] = dict(history_record) if history_record else None
             
             if not notification_data["read_status"]:
-                update_query = "UPDATE user_notifications SET read_status = TRUE WHERE notification_id = $1 AND telegram_id = $2 RETURNING 1"
-                updated = await connection.fetchval(update_query, notification_id, int(telegram_id))
+                if is_public:
+                    updated = await mark_public_notification_read(connection, int(telegram_id), notification_id)
+                else:
+                    update_query = "UPDATE user_notifications SET read_status = TRUE WHERE notification_id = $1 AND telegram_id = $2 RETURNING 1"
+                    updated = await connection.fetchval(update_query, notification_id, int(telegram_id))
                 
                 if updated:
                     notification_data["read_status"] = True
@@ -142,7 +167,9 @@ async def mark_single_notification_as_read(notification_id):
                 RETURNING 1
             """
             updated = await connection.fetchval(update_query, notification_id, int(telegram_id))
-            
+            if not updated:
+                updated = await mark_public_notification_read(connection, int(telegram_id), notification_id) or None
+
             if updated:
                 unread_count = await get_unread_notifications_count(connection, int(telegram_id))
                 # ✨ بث تحديث العدد عبر SSE
@@ -166,6 +193,7 @@ async def mark_all_as_read():
         async with current_app.db_pool.acquire() as connection:
             update_query = "UPDATE user_notifications SET read_status = TRUE WHERE telegram_id = $1 AND read_status = FALSE"
             await connection.execute(update_query, int(telegram_id))
+            await advance_public_notifications_watermark(connection, int(telegram_id))
 
             # ✨ بث تحديث العدد عبر SSE (العدد الآن صفر)
             await current_app.sse_client.publish(telegram_id, 'unread_update', {"count": 0})
@@ -189,7 +217,8 @@ async def mark_notifications_as_read_by_type(notification_type):
                 WHERE un.notification_id = n.id AND un.telegram_id = $1 AND n.type = $2;
             """
             await connection.execute(update_query, int(telegram_id), notification_type)
-            
+            await mark_public_notifications_read_by_type(connection, int(telegram_id), notification_type)
+
             unread_count = await get_unread_notifications_count(connection, int(telegram_id))
             
             # ✨ بث تحديث العدد عبر SSE
@@ -25,6 +25,7 @@ from utils.discount_utils import calculate_discounted_price
 # نفترض أنك قد أنشأت وحدة خاصة بالإشعارات تحتوي على الدالة create_notification
 from utils.notifications import create_notification
 from utils.system_notifications import send_system_notification
+from utils.settings_cache import settings_cache
 
 # تحميل المتغيرات البيئية
 
@@ -50,9 +51,14 @@ getcontext().prec = 30
 # ==============================================================================
 # 🌟 الدالة الرئيسية الجديدة لمعالجة المدفوعات 🌟
 # ==============================================================================
-async def process_single_transaction(transaction_data: dict[str, any]):
+async def process_single_transaction(
+        transaction_data: dict[str, any],
+        allowed_statuses: tuple[str, ...] = ("pending",)
+) -> str:
     """
     تعالج معاملة واحدة، تتحقق من صحة الدفعة، ثم تسلمها لنظام تجديد الاشتراك.
+    allowed_statuses: حالات الدفع التي يُسمح بمعالجتها (تستخدمها عملية المطابقة الجماعية لتشمل 'manual_check').
+    تُرجع نتيجة المعالجة كنص قصير (renewed, renewal_queued, renewal_failed, underpaid, ...) لاستخدامها في التقارير.
     """
     tx_hash = transaction_data.get("tx_hash")
     jetton_amount = transaction_data.get("jetton_amount", Decimal('0'))
@@ -63,7 +69,7 @@ async def process_single_transaction(transaction_data: dict[str, any]):
 
     if not all([tx_hash, jetton_amount > 0, normalized_sender, payment_token]):
         logging.info(f"ℹ️ [Core Processor] Transaction {tx_hash} is missing required data. Skipping.")
-        return
+        return "invalid_data"
 
     async with current_app.db_pool.acquire() as conn:
         try:
@@ -78,7 +84,7 @@ async def process_single_transaction(transaction_data: dict[str, any]):
                 f"ℹ️ [Core Processor] Transaction {tx_hash} already recorded. Checking if it needs payment processing.")
         except Exception as e:
             logging.error(f"❌ [Core Processor] Failed to record transaction {tx_hash}: {e}", exc_info=True)
-            return
+            return "record_failed"
 
         try:
             # الخطوة 2: البحث عن طلب دفع معلق يطابق الـ payment_token
@@ -87,11 +93,11 @@ async def process_single_transaction(transaction_data: dict[str, any]):
             if not pending_payment:
                 logging.warning(
                     f"⚠️ [Core Processor] No matching payment record found for payment_token '{payment_token}'.")
-                return
-            if pending_payment.get('status') != 'pending':
+                return "no_payment"
+            if pending_payment.get('status') not in allowed_statuses:
                 logging.info(
                     f"ℹ️ [Core Processor] Payment for '{payment_token}' already processed (Status: {pending_payment['status']}).")
-                return
+                return "already_processed"
 
             logging.info(
                 f"✅ [Core Processor] Found matching pending payment: ID={pending_payment['id']}. Verifying amount.")
@@ -161,7 +167,7 @@ async def process_single_transaction(transaction_data: dict[str, any]):
                     logging.error("❌ [Core Processor] Bot object not found. Cannot proceed with subscription renewal.")
                     await update_payment_status_to_manual_check(conn, pending_payment['payment_token'],
                                                                 "Bot object not found during processing")
-                    return
+                    return "bot_unavailable"
 
                 # --- ⭐ بداية الكود المعدل ---
 
@@ -175,17 +181,21 @@ async def process_single_transaction(transaction_data: dict[str, any]):
                 }
 
                 # استدعاء دالة التجديد مع البيانات الكاملة
-                await process_subscription_renewal(
+                renewal_success, _ = await process_subscription_renewal(
                     connection=conn,
                     bot=bot,
                     payment_data=payment_full_data
                 )
+                if renewal_success is None:
+                    return "renewal_queued"  # سيعيد عامل طابور التجديد المحاولة لاحقًا
+                return "renewed" if renewal_success else "renewal_failed"
 
                 # --- نهاية الكود المعدل ---
 
             else:
                 logging.warning(
                     f"⚠️ [Payment Invalid] Payment for {tx_hash} is invalid (insufficient amount). Status has been set to 'failed'.")
+                return "underpaid"
 
         except Exception as e:
             logging.error(
@@ -215,6 +225,7 @@ async def process_single_transaction(transaction_data: dict[str, any]):
             except Exception as inner_e:
                 logging.error(
                     f"❌ [Core Processor] Failed to even update status to manual_check for token '{payment_token}': {inner_e}")
+            return "error"
 
 # --- 🛡️ المسار الاحتياطي: الفحص الدوري عبر LiteBalancer ---
 
@@ -507,28 +518,16 @@ async def confirm_payment():
             }
         )
         return jsonify({"error": "An unexpected internal server error occurred"}), 500
-# تغيير قيمة timestamp إلى float لتفادي تحذيرات النوع
-_wallet_cache = {
-    "address": None,
-    "timestamp": 0.0
-}
-WALLET_CACHE_TTL = 60  # زمن التخزين المؤقت بالثواني (مثلاً 60 ثانية)
-
-
 async def get_bot_wallet_address() -> Optional[str]:
-    global _wallet_cache
-    now = asyncio.get_event_loop().time()
+    """
+    عنوان محفظة البوت من كاش الإعدادات المشترك (يُبطل فورًا عبر pg_notify عند تحديثه من لوحة التحكم).
+    """
     if not hasattr(current_app, 'db_pool') or current_app.db_pool is None:
         logging.error("❌ db_pool غير مهيأ!")
         return None
 
-    # التحقق من صلاحية الكاش أو انتهاء مدة التخزين المؤقت
-    if _wallet_cache["address"] is None or now - _wallet_cache["timestamp"] > WALLET_CACHE_TTL:
-        async with current_app.db_pool.acquire() as connection:
-            wallet = await connection.fetchrow("SELECT wallet_address FROM wallet ORDER BY id DESC LIMIT 1")
-            if not wallet:
-                logging.error("❌ لا يوجد عنوان محفظة مسجل في قاعدة البيانات!")
-                return None
-            _wallet_cache["address"] = wallet["wallet_address"]
-            _wallet_cache["timestamp"] = now
-    return _wallet_cache["address"]
+    wallet = await settings_cache.get_wallet()
+    if not wallet:
+        logging.error("❌ لا يوجد عنوان محفظة مسجل في قاعدة البيانات!")
+        return None
+    return wallet.wallet_address
@@ -1,8 +1,11 @@
-from quart import Blueprint, jsonify, request, current_app
+from quart import Blueprint, jsonify, request, current_app, Response
 import logging
 import asyncpg
 from datetime import datetime
 
+from utils.settings_cache import settings_cache
+from utils.qr_utils import get_qr_png
+
 payment_status_bp = Blueprint('payment_status', __name__)
 
 @payment_status_bp.route('/api/payment/status', methods=['GET'])
@@ -40,3 +43,33 @@ async def check_payment_status():
     except Exception as e:
         logging.error(f"Payment status check error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
+
+
+@payment_status_bp.route('/api/payment-qr/<payment_token>.png', methods=['GET'])
+async def get_payment_qr_png(payment_token: str):
+    """
+    رمز QR لعنوان محفظة البوت (الذي تُرسل إليه دفعة payment_token) كصورة PNG بدلاً من base64 داخل JSON.
+    العنوان مشترك بين كل الدفعات، فالصورة تُولد مرة واحدة وتُخدم من الكاش.
+    """
+    try:
+        async with current_app.db_pool.acquire() as conn:
+            payment_exists = await conn.fetchval(
+                'SELECT 1 FROM payments WHERE payment_token = $1',
+                payment_token
+            )
+        if not payment_exists:
+            return jsonify({'error': 'Payment record not found'}), 404
+
+        wallet = await settings_cache.get_wallet()
+        if not wallet or not wallet.wallet_address:
+            return jsonify({'error': 'Wallet address is not configured'}), 503
+
+        png_bytes = await get_qr_png(wallet.wallet_address)
+        response = Response(png_bytes, mimetype='image/png')
+        # العنوان قد يتغير من لوحة التحكم، لذا تخزين قصير بدلاً من immutable
+        response.headers['Cache-Control'] = 'public, max-age=300'
+        return response
+
+    except Exception as e:
+        logging.error(f"Error in /api/payment-qr: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
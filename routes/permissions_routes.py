@@ -1,6 +1,8 @@
 from quart import Blueprint, request, jsonify, current_app
-from utils.permissions import permission_required, owner_required, log_action, get_user_permissions
+from utils.permissions import permission_required, owner_required, log_action, get_user_permissions, \
+    invalidate_permissions
 from auth import get_current_user
+from utils.pagination import KeysetPage, keyset_requested
 import logging
 import json
 
@@ -111,6 +113,7 @@ async def update_role_permissions(role_id):
                 await connection.executemany("""
                     INSERT INTO role_permissions (role_id, permission_id) VALUES ($1, $2)
                 """, [(role_id, pid) for pid in permission_ids])
+            await invalidate_permissions(connection)
 
             # جلب اسم الدور للتسجيل
             role_name = await connection.fetchval("""
@@ -167,6 +170,7 @@ async def create_role():
                 await connection.executemany("""
                     INSERT INTO role_permissions (role_id, permission_id) VALUES ($1, $2)
                 """, [(role_id, pid) for pid in permission_ids])
+            await invalidate_permissions(connection)
 
             # تسجيل العملية
             await log_action(
@@ -277,6 +281,7 @@ async def update_user_role(target_user_id: int):  # استقبال target_user_i
                    WHERE id = $2""",
                 new_role_id, target_user_id
             )
+            await invalidate_permissions(connection)
 
             # 6. تسجيل العملية
             await log_action(
@@ -315,8 +320,31 @@ async def get_audit_logs():
     limit = int(request.args.get("limit", 25))
     offset = (page - 1) * limit
 
+    # وضع المؤشر الاختياري (after=) على created_at + id بدل OFFSET
+    try:
+        keyset = KeysetPage(request.args.get("after"), "created_at", "al.created_at", "timestamp", "al.id",
+                            nullable=True) \
+            if keyset_requested(request.args) else None
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    query_params = []
+    if keyset:
+        keyset_where = keyset.where_sql(query_params)
+        page_sql = f"""
+            {f"WHERE {keyset_where}" if keyset_where else ""}
+            {keyset.order_by_sql()}
+            LIMIT ${len(query_params) + 1}
+        """
+        cursor_select_sql = f", {keyset.select_sql()}"
+        query_params.append(limit)
+    else:
+        page_sql = "ORDER BY al.created_at DESC LIMIT $1 OFFSET $2"
+        cursor_select_sql = ""
+        query_params.extend([limit, offset])
+
     async with current_app.db_pool.acquire() as connection:
-        logs_from_db = await connection.fetch("""
+        logs_from_db = await connection.fetch(f"""
             SELECT 
                 al.id, 
                 al.user_email, 
@@ -328,13 +356,17 @@ async def get_audit_logs():
                 al.ip_address, 
                 al.user_agent, 
                 al.created_at 
+                {cursor_select_sql}
             FROM audit_logs al
             LEFT JOIN panel_users pu ON al.user_email = pu.email -- الربط باستخدام البريد الإلكتروني
-            ORDER BY al.created_at DESC 
-            LIMIT $1 OFFSET $2
-        """, limit, offset)
+            {page_sql}
+        """, *query_params)
 
-        total_count = await connection.fetchval("SELECT COUNT(*) FROM audit_logs")
+        next_cursor = keyset.next_cursor([dict(row) for row in logs_from_db], limit) if keyset else None
+        if keyset is None or keyset.is_first_page:
+            total_count = await connection.fetchval("SELECT COUNT(*) FROM audit_logs")
+        else:
+            total_count = None
 
         result_logs = []
         for db_log_row in logs_from_db:
@@ -357,6 +389,7 @@ async def get_audit_logs():
                 "page": page,
                 "limit": limit,
                 "total": total_count,
-                "pages": (total_count + limit - 1) // limit if limit > 0 else 0
+                "pages": None if total_count is None else ((total_count + limit - 1) // limit if limit > 0 else 0),
+                "next_cursor": next_cursor
             }
         }), 200
\ No newline at end of file
@@ -4,7 +4,6 @@ import logging
 import pytz
 import os
 import json
-import asyncio  # <-- إضافة جديدة لآلية إعادة المحاولة
 from quart import Blueprint, request, jsonify, current_app
 from datetime import datetime, timedelta, timezone
 from database.db_queries import (
@@ -14,7 +13,8 @@ from database.db_queries import (
     update_subscription,
     add_scheduled_task,
     update_payment_with_txhash,  # <-- إضافة مهمة لتحديث حالة الدفع
-    get_reminder_settings
+    enqueue_renewal_job,
+    has_active_renewal_job
 )
 from database.tiered_discount_queries import claim_discount_slot_universal, save_user_discount
 
@@ -25,6 +25,7 @@ from asyncpg import Connection
 from aiogram import Bot
 from utils.notifications import create_notification
 from utils.system_notifications import send_system_notification
+from utils.settings_cache import settings_cache
 
 
 
@@ -32,9 +33,10 @@ from utils.system_notifications import send_system_notification
 LOCAL_TZ = pytz.timezone("Asia/Riyadh")
 IS_DEVELOPMENT = True
 
-# --- ثوابت جديدة للتحكم في إعادة المحاولة ---
-SUBSCRIPTION_RENEWAL_RETRIES = 3  # عدد محاولات التجديد
-SUBSCRIPTION_RENEWAL_RETRY_DELAY = 10  # الثواني بين كل محاولة
+# --- ثوابت التحكم في إعادة المحاولة عبر طابور التجديد (renewal_jobs) ---
+SUBSCRIPTION_RENEWAL_MAX_ATTEMPTS = 6  # إجمالي المحاولات (الأولى فورية والباقي عبر الطابور)
+SUBSCRIPTION_RENEWAL_BACKOFF_BASE = 30  # الثواني قبل أول إعادة محاولة
+SUBSCRIPTION_RENEWAL_BACKOFF_MAX = 1800  # الحد الأقصى للتأخير بين المحاولات
 
 
 # --- الدوال المساعدة (تبقى كما هي) ---
@@ -68,49 +70,113 @@ async def process_subscription_renewal(
         connection: Connection,
         bot: Bot,
         payment_data: dict,
-) -> tuple[bool, str]:
+) -> tuple[Optional[bool], str]:
     """
-    الدالة الأساسية التي تدير عملية تجديد الاشتراك مع آلية إعادة المحاولة.
-    وهي مسؤولة عن تحديث حالة الدفع النهائية (completed أو failed).
+    الدالة الأساسية التي تدير عملية تجديد الاشتراك.
+    تُنفذ محاولة واحدة فقط؛ عند الفشل تُحال الدفعة إلى طابور التجديد الدائم (renewal_jobs)
+    ليعيد العامل المحاولة لاحقًا بتأخير أُسّي، بدلاً من النوم داخل الطلب مع حجز اتصال من الـ pool.
+    وهي مسؤولة عن تحديث حالة الدفع النهائية (completed أو failed) عندما تُحسم النتيجة.
+    ترجع (True, ...) عند النجاح، (False, ...) عند الفشل النهائي، و (None, ...) عند الإحالة للطابور
+    أو إذا كانت الدفعة قيد التجديد في مسار آخر (المستمع، المطابقة، أو عامل الطابور).
     """
+    payment_token = payment_data.get("payment_token")
+
+    # قفل لكل payment_token حتى نهاية المعاملة: مسار واحد فقط يجدد الدفعة في أي لحظة
+    async with connection.transaction():
+        if not await try_lock_renewal(connection, payment_token):
+            logging.info(f"ℹ️ [Renewal Skipped] token={payment_token} is being renewed by another path.")
+            return None, "التجديد قيد التنفيذ في مسار آخر."
+        if await has_active_renewal_job(connection, payment_token):
+            logging.info(f"ℹ️ [Renewal Skipped] token={payment_token} is owned by the renewal queue.")
+            return None, "الدفعة في طابور التجديد."
+        payment_status = await connection.fetchval(
+            "SELECT status FROM payments WHERE payment_token = $1", payment_token)
+        if payment_status == "completed":
+            logging.info(f"ℹ️ [Renewal Skipped] token={payment_token} was already completed.")
+            return True, "Payment already completed."
+        return await _process_subscription_renewal_locked(connection, bot, payment_data)
+
+
+async def _process_subscription_renewal_locked(
+        connection: Connection,
+        bot: Bot,
+        payment_data: dict,
+) -> tuple[Optional[bool], str]:
     telegram_id = payment_data.get("telegram_id")
     payment_token = payment_data.get("payment_token")
-    tx_hash = payment_data.get("tx_hash")
 
-    success = False
-    message = "فشل تفعيل الاشتراك بعد عدة محاولات."
+    logging.info(f"🔄 [Renewal Attempt 1/{SUBSCRIPTION_RENEWAL_MAX_ATTEMPTS}] for user={telegram_id}, token={payment_token}")
+    success, message = await _attempt_subscription_renewal(connection, bot, payment_data)
 
-    # --- آلية إعادة المحاولة ---
-    for attempt in range(1, SUBSCRIPTION_RENEWAL_RETRIES + 1):
-        try:
-            logging.info(
-                f"🔄 [Renewal Attempt {attempt}/{SUBSCRIPTION_RENEWAL_RETRIES}] for user={telegram_id}, token={payment_token}")
-
-            async with connection.transaction():
-                renewal_success, renewal_message = await _execute_renewal_logic(
-                    connection=connection,
-                    bot=bot,
-                    payment_data=payment_data
-                )
+    if success:
+        logging.info(f"✅ [Renewal Success] Subscription activated for user={telegram_id} on attempt 1.")
+        return await _finalize_renewal_payment(connection, bot, payment_data, True, message)
 
-            if renewal_success:
-                success = True
-                message = renewal_message
-                logging.info(f"✅ [Renewal Success] Subscription activated for user={telegram_id} on attempt {attempt}.")
-                break
-            else:
-                message = renewal_message
-                logging.warning(f"⚠️ [Renewal Attempt {attempt} Failed] for user={telegram_id}. Reason: {message}")
+    # الأخطاء الحتمية (بيانات ناقصة، خطة أو نوع غير صالح) لا تُعاد محاولتها
+    permanent_error = await renewal_permanent_error(connection, payment_data)
+    if permanent_error:
+        logging.error(f"🚫 [Renewal Failed] token={payment_token} cannot be renewed: {permanent_error}")
+        return await _finalize_renewal_payment(connection, bot, payment_data, False, permanent_error)
 
+    # --- إحالة الدفعة إلى طابور إعادة المحاولة ---
+    idempotency_key = renewal_idempotency_key(payment_data)
+    if idempotency_key:
+        try:
+            job_id = await enqueue_renewal_job(
+                connection,
+                idempotency_key=idempotency_key,
+                payment_token=payment_token,
+                payload=payment_data,
+                source=payment_data.get("payment_method") or "ton",
+                delay_seconds=renewal_backoff_seconds(1),
+                max_attempts=SUBSCRIPTION_RENEWAL_MAX_ATTEMPTS,
+                last_error=message
+            )
+            if job_id is not None:
+                logging.info(
+                    f"⏳ [Renewal Queued] user={telegram_id}, token={payment_token} queued as job {job_id}. Reason: {message}")
+            else:
+                logging.info(f"ℹ️ [Renewal Queued] A retry job already exists for key={idempotency_key}.")
+            return None, f"تمت جدولة إعادة محاولة التجديد: {message}"
         except Exception as e:
-            logging.error(f"❌ [Renewal Attempt {attempt} Critical Error] for user={telegram_id}: {e}", exc_info=True)
-            message = f"خطأ فادح في نظام التجديد: {e}"
+            logging.error(f"❌ [Renewal Queue] Failed to enqueue retry for token={payment_token}: {e}", exc_info=True)
+
+    return await _finalize_renewal_payment(connection, bot, payment_data, False, message)
+
+
+async def _attempt_subscription_renewal(
+        connection: Connection,
+        bot: Bot,
+        payment_data: dict,
+) -> tuple[bool, str]:
+    """محاولة تجديد واحدة داخل معاملة مستقلة، بدون أي انتظار."""
+    telegram_id = payment_data.get("telegram_id")
+    try:
+        async with connection.transaction():
+            return await _execute_renewal_logic(
+                connection=connection,
+                bot=bot,
+                payment_data=payment_data
+            )
+    except Exception as e:
+        logging.error(f"❌ [Renewal Attempt Critical Error] for user={telegram_id}: {e}", exc_info=True)
+        return False, f"خطأ فادح في نظام التجديد: {e}"
 
-        if not success and attempt < SUBSCRIPTION_RENEWAL_RETRIES:
-            logging.info(f"⏳ Retrying in {SUBSCRIPTION_RENEWAL_RETRY_DELAY} seconds...")
-            await asyncio.sleep(SUBSCRIPTION_RENEWAL_RETRY_DELAY)
 
-    # --- الخطوة النهائية: تحديث حالة الدفع بناءً على النتيجة ---
+async def _finalize_renewal_payment(
+        connection: Connection,
+        bot: Bot,
+        payment_data: dict,
+        success: bool,
+        message: str
+) -> tuple[bool, str]:
+    """
+    الخطوة النهائية: تحديث حالة الدفع بناءً على النتيجة (completed أو failed) وإرسال التنبيهات.
+    """
+    telegram_id = payment_data.get("telegram_id")
+    payment_token = payment_data.get("payment_token")
+    tx_hash = payment_data.get("tx_hash")
+
     try:
         final_status = "completed" if success else "failed"
         final_error_message = None if success else f"Renewal Failed After Retries: {message}"
@@ -168,6 +234,53 @@ async def process_subscription_renewal(
     return success, message
 
 
+async def try_lock_renewal(connection: Connection, payment_token: str, wait: bool = False) -> bool:
+    """قفل استشاري لكل payment_token حتى نهاية المعاملة الحالية (wait=False: بدون انتظار)."""
+    if wait:
+        await connection.execute("SELECT pg_advisory_xact_lock(hashtext('renewal:' || $1))", payment_token)
+        return True
+    return await connection.fetchval("SELECT pg_try_advisory_xact_lock(hashtext('renewal:' || $1))", payment_token)
+
+
+async def renewal_permanent_error(connection: Connection, payment_data: dict) -> Optional[str]:
+    """سبب فشل لا تُصلحه إعادة المحاولة (بيانات ناقصة، خطة أو نوع اشتراك غير صالح)، أو None."""
+    telegram_id = payment_data.get("telegram_id")
+    subscription_plan_id = payment_data.get("subscription_plan_id")
+    if not telegram_id or not subscription_plan_id:
+        return "Payment data is missing telegram_id or subscription_plan_id."
+    try:
+        subscription_plan_id = int(subscription_plan_id)
+        int(telegram_id)
+    except (TypeError, ValueError):
+        return "Payment data has an invalid telegram_id or subscription_plan_id."
+
+    plan = await connection.fetchrow("""
+        SELECT sp.id, st.channel_id
+        FROM subscription_plans sp
+        LEFT JOIN subscription_types st ON st.id = sp.subscription_type_id
+        WHERE sp.id = $1
+    """, subscription_plan_id)
+    if not plan:
+        return f"Subscription plan {subscription_plan_id} does not exist."
+    if not plan["channel_id"]:
+        return f"Subscription type of plan {subscription_plan_id} has no main channel."
+    return None
+
+
+def renewal_idempotency_key(payment_data: dict) -> Optional[str]:
+    """مفتاح منع التكرار لمهمة التجديد: tx_hash إن وُجد وإلا payment_token."""
+    tx_hash = payment_data.get("tx_hash")
+    if tx_hash:
+        return f"tx:{tx_hash}"
+    payment_token = payment_data.get("payment_token")
+    return f"token:{payment_token}" if payment_token else None
+
+
+def renewal_backoff_seconds(attempt: int) -> int:
+    """تأخير أُسّي بين المحاولات: 30s, 60s, 120s, ... بحد أقصى SUBSCRIPTION_RENEWAL_BACKOFF_MAX."""
+    return min(SUBSCRIPTION_RENEWAL_BACKOFF_BASE * (2 ** max(0, attempt - 1)), SUBSCRIPTION_RENEWAL_BACKOFF_MAX)
+
+
 async def _activate_or_renew_subscription_core(
         connection: Connection,
         bot: Bot,
@@ -422,13 +535,13 @@ async def _reschedule_all_tasks_for_subscription(
     )
 
     # 2.2: جدولة التذكيرات (هنا التعديل)
-    reminder_settings = await get_reminder_settings(connection)
+    reminder_settings = await settings_cache.get_reminder_settings(connection)
     if reminder_settings:
         now_utc = datetime.now(timezone.utc)
 
         # ⭐⭐⭐ التعديل هنا: استخدام hours بدلاً من days ⭐⭐⭐
         # التذكير الأول
-        first_reminder_hours = reminder_settings['first_reminder']
+        first_reminder_hours = reminder_settings.first_reminder
         first_reminder_date = expiry_date - timedelta(hours=first_reminder_hours)
         if first_reminder_date > now_utc:
             await add_scheduled_task(
@@ -437,7 +550,7 @@ async def _reschedule_all_tasks_for_subscription(
 
         # ⭐⭐⭐ التعديل هنا: استخدام hours بدلاً من days ⭐⭐⭐
         # التذكير الثاني
-        second_reminder_hours = reminder_settings['second_reminder']
+        second_reminder_hours = reminder_settings.second_reminder
         second_reminder_date = expiry_date - timedelta(hours=second_reminder_hours)
         if second_reminder_date > now_utc:
             await add_scheduled_task(
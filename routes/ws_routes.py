@@ -6,7 +6,7 @@ import json
 import logging
 import time
 import traceback
-from database.db_queries import get_unread_notifications_count
+from database.db_queries import get_unread_notifications_count, advance_public_notifications_watermark
 
 ws_bp = Blueprint('ws_bp', __name__)
 
@@ -79,6 +79,7 @@ async def mark_all_notifications_read(telegram_id):
         """
         updated_rows = await connection.fetch(update_query, int(telegram_id))
         updated_count = len(updated_rows)
+        await advance_public_notifications_watermark(connection, int(telegram_id))
         
         # Get updated unread count
         unread_count = await get_unread_notifications_count(connection, int(telegram_id))
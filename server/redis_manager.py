@@ -7,6 +7,15 @@ import time
 from typing import Optional
 from redis.exceptions import ConnectionError, TimeoutError, RedisError
 
+# نشر مع تسلسل في رحلة واحدة: INCR ثم إدراج _seq في بداية JSON ثم PUBLISH (ARGV[1] يبدأ بـ '{' وغير فارغ)
+PUBLISH_WITH_SEQ_LUA = """
+local seq = redis.call('INCR', KEYS[1])
+local message = '{"_seq": ' .. seq .. ', ' .. string.sub(ARGV[1], 2)
+redis.call('PUBLISH', KEYS[2], message)
+return seq
+"""
+
+
 class RedisManager:
     _instance: Optional['RedisManager'] = None
 
@@ -15,6 +24,7 @@ class RedisManager:
             raise RuntimeError("Use get_instance() instead!")
         self.redis: Optional[redis.Redis] = None
         self.pubsub: Optional[redis.client.PubSub] = None
+        self._publish_with_seq = None
 
     @classmethod
     def get_instance(cls) -> 'RedisManager':
@@ -34,6 +44,7 @@ class RedisManager:
             )
             await self.redis.ping()
             self.pubsub = self.redis.pubsub()
+            self._publish_with_seq = self.redis.register_script(PUBLISH_WITH_SEQ_LUA)
             logging.info("✅ تم الاتصال بـ Redis بنجاح!")
 
         except ConnectionError as e:
@@ -63,17 +74,19 @@ class RedisManager:
 
     async def publish_event(self, channel: str, data: dict):
         try:
-            # توليد تسلسل آلي إذا لم يكن موجودًا
-            if '_seq' not in data:
-                seq_key = f"event_seq:{channel}"
-                data['_seq'] = await self.redis.incr(seq_key)
-
             event_data = {
                 **data,
                 "_ts": time.time()
             }
 
-            await self.redis.publish(channel, json.dumps(event_data))
+            if '_seq' in data:
+                await self.redis.publish(channel, json.dumps(event_data))
+            else:
+                # توليد تسلسل آلي والنشر في رحلة واحدة عبر سكربت Lua (بدل INCR منفصل)
+                data['_seq'] = await self._publish_with_seq(
+                    keys=[f"event_seq:{channel}", channel], args=[json.dumps(event_data)])
+                event_data = {"_seq": data['_seq'], **event_data}
+
             logging.info(f"✅ تم نشر الحدث على {channel}: {json.dumps(event_data, ensure_ascii=False)}")  # <-- log مفصل
 
         except Exception as e:
@@ -9,34 +9,126 @@ from server.redis_manager import redis_manager
 sse_bp = Blueprint('sse', __name__)
 
 
+PAYMENT_CHANNEL_PATTERN = "payment_*"
+PAYMENT_QUEUE_SIZE = 20
+PAYMENT_STREAM_HEARTBEAT = 30  # ثوانٍ
+PAYMENT_LISTENER_BACKOFF_MIN = 1  # ثوانٍ
+PAYMENT_LISTENER_BACKOFF_MAX = 30  # ثوانٍ
+
+
+class PaymentEventHub:
+    """
+    اشتراك Redis واحد بالنمط payment_* لكل عملية، يوزع الرسائل على طوابير محلية لكل payment_token.
+    بدلاً من اتصال pubsub وحلقة استطلاع لكل متصفح ينتظر الدفع.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._pubsub = None
+        self._task = None
+        self._start_lock = asyncio.Lock()
+
+    async def _ensure_started(self):
+        if self._task and not self._task.done():
+            return
+        async with self._start_lock:
+            if self._task and not self._task.done():
+                return
+            # الاشتراك الأول يتم قبل إرجاع الطابور حتى لا تضيع رسالة تصل مباشرة بعده
+            await self._connect()
+            self._task = asyncio.create_task(self._listen())
+
+    async def _connect(self):
+        await redis_manager.connect()
+        self._pubsub = redis_manager.redis.pubsub()
+        await self._pubsub.psubscribe(PAYMENT_CHANNEL_PATTERN)
+        logging.info(f"✅ تم الاشتراك المشترك في النمط {PAYMENT_CHANNEL_PATTERN}")
+
+    async def _disconnect(self):
+        if self._pubsub is None:
+            return
+        try:
+            await self._pubsub.punsubscribe(PAYMENT_CHANNEL_PATTERN)
+            await self._pubsub.close()
+        except Exception:
+            pass
+        self._pubsub = None
+
+    async def _listen(self):
+        # المستمع لا يتوقف عند انقطاع Redis: يعيد الاشتراك بتأخير متزايد والطوابير المحلية تبقى مفتوحة
+        delay = PAYMENT_LISTENER_BACKOFF_MIN
+        try:
+            while True:
+                try:
+                    if self._pubsub is None:
+                        await self._connect()
+                    async for message in self._pubsub.listen():
+                        delay = PAYMENT_LISTENER_BACKOFF_MIN
+                        if message.get("type") != "pmessage":
+                            continue
+                        payment_token = message["channel"][len("payment_"):]
+                        queues = self._subscribers.get(payment_token)
+                        if not queues:
+                            continue
+                        logging.debug(f"📨 رسالة مستلمة: {message}")
+                        for queue in list(queues):
+                            try:
+                                queue.put_nowait(message["data"])
+                            except asyncio.QueueFull:
+                                logging.warning(f"⚠️ طابور SSE ممتلئ للدفعة {payment_token}، تم تجاهل الرسالة")
+                    logging.warning("⚠️ انتهى اتصال قنوات الدفع، إعادة الاشتراك...")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"❌ انقطع مستمع قنوات الدفع، إعادة المحاولة بعد {delay} ثانية: {str(e)}")
+                await self._disconnect()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, PAYMENT_LISTENER_BACKOFF_MAX)
+        finally:
+            await self._disconnect()
+
+    async def subscribe(self, payment_token: str) -> asyncio.Queue:
+        await self._ensure_started()
+        queue = asyncio.Queue(maxsize=PAYMENT_QUEUE_SIZE)
+        self._subscribers.setdefault(payment_token, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, payment_token: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(payment_token)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[payment_token]
+
+
+payment_event_hub = PaymentEventHub()
+
+
 async def event_generator(payment_token):
-    pubsub = None
+    queue = None
     try:
-        pubsub = redis_manager.redis.pubsub()
-        await pubsub.subscribe(f'payment_{payment_token}')
+        queue = await payment_event_hub.subscribe(payment_token)
         logging.info(f"✅ تم الاشتراك في قناة payment_{payment_token}")
 
         while True:
-            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=30)
-            if message:
-                logging.debug(f"📨 رسالة مستلمة: {message}")
-                try:
-                    data = json.loads(message['data'])
-                    # إذا لم يكن هناك مفتاح _seq، نقوم بإرساله كما هو
-                    yield f"data: {json.dumps(data)}\n\n"
-                except Exception as e:
-                    logging.error(f"Error processing message: {str(e)}")
-            await asyncio.sleep(0.1)
+            try:
+                raw = await asyncio.wait_for(queue.get(), timeout=PAYMENT_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # تعليق SSE يُبقي الاتصال حيًا عبر الوكلاء دون أن يراه العميل كحدث
+                yield ": heartbeat\n\n"
+                continue
+            try:
+                data = json.loads(raw)
+                yield f"data: {json.dumps(data)}\n\n"
+            except Exception as e:
+                logging.error(f"Error processing message: {str(e)}")
     except Exception as e:
         logging.error(f"SSE error: {str(e)}", exc_info=True)
     finally:
-        if pubsub:
-            try:
-                await asyncio.sleep(1)
-                await pubsub.unsubscribe(f'payment_{payment_token}')
-                logging.info(f"تم إلغاء الاشتراك من القناة: payment_{payment_token}")
-            except Exception as e:
-                logging.error(f"Error during unsubscribe: {str(e)}")
+        if queue is not None:
+            payment_event_hub.unsubscribe(payment_token, queue)
+            logging.info(f"تم إلغاء الاشتراك من القناة: payment_{payment_token}")
 
 
 @sse_bp.route('/sse')
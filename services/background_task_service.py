@@ -9,6 +9,7 @@ from typing import Dict, List, Optional, Any
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.enums import ChatMemberStatus
 from utils.messaging_batch import BatchStatus, BatchType, MessagingBatchResult, FailedSendDetail
+from utils.audience_segments import audience_segments, fetch_segment_users
 from services.background_tasks.task_processor import TaskProcessor
 
 
@@ -354,71 +355,9 @@ class BackgroundTaskService:
             connection, target_group: str, subscription_type_id: Optional[int] = None
     ) -> List[Dict]:
         """دالة لجلب المستخدمين حسب الاستهداف مع كافة البيانات اللازمة للمتغيرات."""
-        params = []
-
-        if target_group == 'all_users':
-            query = """
-                        SELECT u.telegram_id, u.full_name, u.username, 
-                               NULL as subscription_name, NULL as expiry_date
-                        FROM users u
-                    """
-        elif target_group == 'no_subscription':
-            query = """
-                        SELECT DISTINCT u.telegram_id, u.full_name, u.username,
-                               NULL as subscription_name, NULL as expiry_date
-                        FROM users u 
-                        LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                        WHERE s.id IS NULL
-                    """
-        elif target_group == 'active_subscribers':
-            query = """
-                        SELECT DISTINCT ON (u.telegram_id) u.telegram_id, u.full_name, u.username,
-                               st.name as subscription_name, s.expiry_date
-                        FROM users u 
-                        JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                        JOIN subscription_types st ON s.subscription_type_id = st.id
-                        WHERE s.is_active = true AND s.expiry_date > NOW()
-                        ORDER BY u.telegram_id, s.expiry_date DESC
-                    """
-        elif target_group == 'expired_subscribers':
-            # هذا الاستعلام يحدد المستخدمين الذين انتهى آخر اشتراك لهم وليس لديهم أي اشتراك نشط حالي
-            query = """
-        -- اختر مستخدماً واحداً (مميزاً)
-        SELECT DISTINCT ON (u.telegram_id)
-               u.telegram_id, u.full_name, u.username,
-               st.name as subscription_name, s.expiry_date
-        FROM users u
-        -- انضم إلى الاشتراكات لجلب التفاصيل
-        JOIN subscriptions s ON u.telegram_id = s.telegram_id
-        JOIN subscription_types st ON s.subscription_type_id = st.id
-        -- الشرط الوحيد: أن يكون الاشتراك منتهياً
-        WHERE s.expiry_date <= NOW()
-        -- الترتيب مهم: لكل مستخدم، اختر اشتراكه المنتهي الأحدث
-        ORDER BY u.telegram_id, s.expiry_date DESC
-    """
-        elif target_group == 'subscription_type_active' and subscription_type_id:
-            query = """
-                        SELECT u.telegram_id, u.full_name, u.username,
-                               st.name as subscription_name, s.expiry_date
-                        FROM users u 
-                        JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                        JOIN subscription_types st ON s.subscription_type_id = st.id
-                        WHERE s.subscription_type_id = $1 
-                              AND s.is_active = true AND s.expiry_date > NOW()
-                    """
-            params.append(subscription_type_id)
-        elif target_group == 'subscription_type_expired' and subscription_type_id:
-            query = """
-                        SELECT u.telegram_id, u.full_name, u.username,
-                               st.name as subscription_name, s.expiry_date
-                        FROM users u 
-                        JOIN subscriptions s ON u.telegram_id = s.telegram_id 
-                        JOIN subscription_types st ON s.subscription_type_id = st.id
-                        WHERE s.subscription_type_id = $1 
-                              AND s.expiry_date <= NOW()
-                    """
-            params.append(subscription_type_id)
-        else:
-            raise ValueError(f"Invalid target group or missing parameters: {target_group}")
-
-        return await connection.fetch(query, *params)
\ No newline at end of file
+        # أعضاء الشريحة من الفهرس في الذاكرة (utils/audience_segments.py)، ثم بياناتهم باستعلام واحد
+        segments = await audience_segments.get(connection)
+        telegram_ids = segments.resolve(target_group, subscription_type_id)
+        if not len(telegram_ids):
+            return []
+        return await fetch_segment_users(connection, target_group, telegram_ids.tolist(), subscription_type_id)
\ No newline at end of file
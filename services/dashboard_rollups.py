@@ -0,0 +1,59 @@
+# services/dashboard_rollups.py
+"""
+جداول التجميع اليومية التي تعتمد عليها لوحة التحكم:
+  - daily_revenue:             عدد المدفوعات ومجموع المبالغ المستلمة لكل (يوم، حالة، عملة)
+  - daily_new_users:           المستخدمون المسجلون لكل يوم (UTC)
+  - daily_subscription_events: الاشتراكات الجديدة لكل (يوم UTC، نوع، خطة، مصدر) مع عدد النشطة ومجموع المدد
+
+تحدّثها triggers على مستوى الجملة في payments و users و subscriptions، لذلك لا تحتاج
+نقاط النهاية إلا لقراءة صفوف مجمعة بدل مسح الجداول الخام.
+الملء الأولي / الإصلاح بعد النشر:
+    python -m services.dashboard_rollups
+"""
+
+import argparse
+import asyncio
+import logging
+
+REBUILD_STATEMENTS = {
+    "dashboard": "SELECT rebuild_dashboard_rollups()",
+    "subscription_status": "SELECT rebuild_subscription_status_rollup()",
+}
+
+
+async def backfill_dashboard_rollups(connection, targets=None) -> dict:
+    """إعادة حساب جداول التجميع من الجداول الخام. ترجع عدد الصفوف في كل جدول بعد الملء."""
+    targets = targets or list(REBUILD_STATEMENTS)
+    async with connection.transaction():
+        for target in targets:
+            logging.info(f"📊 Rebuilding '{target}' rollups...")
+            await connection.execute(REBUILD_STATEMENTS[target])
+
+    row = await connection.fetchrow("""
+        SELECT (SELECT COUNT(*) FROM daily_revenue) AS daily_revenue,
+               (SELECT COUNT(*) FROM daily_new_users) AS daily_new_users,
+               (SELECT COUNT(*) FROM daily_subscription_events) AS daily_subscription_events,
+               (SELECT COUNT(*) FROM subscription_status_rollup) AS subscription_status_rollup
+    """)
+    return dict(row)
+
+
+async def _main(args):
+    import asyncpg
+    from config import DATABASE_CONFIG
+
+    conn = await asyncpg.connect(**DATABASE_CONFIG)
+    try:
+        counts = await backfill_dashboard_rollups(conn, args.only)
+    finally:
+        await conn.close()
+    for table_name, rows in counts.items():
+        logging.info(f"✅ {table_name}: {rows} rows")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Backfill the dashboard rollup tables from raw data")
+    parser.add_argument("--only", nargs="+", choices=list(REBUILD_STATEMENTS),
+                        help="Rebuild only the given rollup groups (default: all)")
+    asyncio.run(_main(parser.parse_args()))
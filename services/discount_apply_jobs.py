@@ -0,0 +1,143 @@
+# services/discount_apply_jobs.py
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from asyncpg.pool import Pool
+
+from database.db_queries import (
+    apply_discount_chunk,
+    claim_next_discount_apply_job,
+    count_discount_target_users,
+    finish_discount_apply_job,
+    set_discount_apply_job_total
+)
+from utils.discount_utils import calculate_discounted_price
+
+DISCOUNT_APPLY_CHUNK_SIZE = int(os.getenv("DISCOUNT_APPLY_CHUNK_SIZE", 2000))
+DISCOUNT_GRACE_PERIOD_HOURS = 168  # مهلة إلغاء الخصم للمستخدمين المنتهية اشتراكاتهم (lose_on_lapse)
+DISCOUNT_APPLY_POLL_INTERVAL = 10
+DISCOUNT_APPLY_STALE_SECONDS = 900
+
+
+async def fetch_applicable_plans(connection, plan_id: Optional[int], type_id: Optional[int]):
+    """الخطط النشطة ضمن نطاق الخصم (خطة محددة أو كل خطط النوع)."""
+    return await connection.fetch("""
+        SELECT id as plan_id, price as plan_price
+        FROM subscription_plans
+        WHERE is_active = true AND (
+            ($1::int IS NOT NULL AND id = $1) OR
+            ($1::int IS NULL AND $2::int IS NOT NULL AND subscription_type_id = $2)
+        )
+        ORDER BY id
+    """, plan_id, type_id)
+
+
+class DiscountApplyWorker:
+    """
+    عامل خلفي يعالج طابور discount_apply_jobs (تطبيق خصم على المشتركين الحاليين).
+    كل دفعة من المستخدمين تُطبق بجملة INSERT ... SELECT واحدة (المستخدمون × unnest(الخطط)) وتُحفظ
+    في معاملة مستقلة مع تقدم المهمة، فلا تبقى معاملة أو اتصال محجوز طوال العملية، والمهمة المتوقفة
+    تكمل من آخر مستخدم تمت معالجته.
+    """
+
+    def __init__(self, db_pool: Pool, chunk_size: int = DISCOUNT_APPLY_CHUNK_SIZE):
+        self.db_pool = db_pool
+        self.chunk_size = chunk_size
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_forever())
+            logging.info(f"✅ [Discount Apply] Worker started (chunk_size={self.chunk_size}).")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logging.info("🛑 [Discount Apply] Worker stopped.")
+
+    def wake(self):
+        """إيقاظ العامل فور إضافة مهمة جديدة بدل انتظار دورة الفحص التالية."""
+        self._wakeup.set()
+
+    async def _run_forever(self):
+        while True:
+            try:
+                if await self.process_next_job():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ [Discount Apply] Unhandled error in worker loop: {e}", exc_info=True)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=DISCOUNT_APPLY_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_next_job(self) -> bool:
+        async with self.db_pool.acquire() as conn:
+            job = await claim_next_discount_apply_job(conn, stale_after_seconds=DISCOUNT_APPLY_STALE_SECONDS)
+        if not job:
+            return False
+        await self._process_job(job)
+        return True
+
+    async def _process_job(self, job: dict):
+        job_id = job["id"]
+        discount_id = job["discount_id"]
+        after_user_id = job["last_user_id"] or 0
+        logging.info(f"🏷️ [Discount Apply] Job {job_id} started for discount {discount_id} "
+                     f"(resuming after user {after_user_id}).")
+
+        try:
+            async with self.db_pool.acquire() as conn:
+                discount = await conn.fetchrow("SELECT * FROM discounts WHERE id = $1", discount_id)
+                if not discount:
+                    await finish_discount_apply_job(conn, job_id, "failed", error="Discount not found")
+                    return
+
+                type_id = discount["applicable_to_subscription_type_id"]
+                plan_id = discount["applicable_to_subscription_plan_id"]
+                plans = await fetch_applicable_plans(conn, plan_id, type_id)
+                if not plans:
+                    await finish_discount_apply_job(
+                        conn, job_id, "failed", error="No active plans found that match the discount's scope.")
+                    return
+
+                if job["total_users"] is None:
+                    await set_discount_apply_job_total(
+                        conn, job_id, await count_discount_target_users(conn, plan_id, type_id))
+
+            # السعر المثبت يُحسب مرة واحدة لكل خطة بدل كل (مستخدم × خطة)
+            plan_ids = [plan["plan_id"] for plan in plans]
+            locked_prices = [
+                calculate_discounted_price(plan["plan_price"], discount["discount_type"], discount["discount_value"])
+                for plan in plans
+            ]
+
+            while True:
+                async with self.db_pool.acquire() as conn:
+                    chunk = await apply_discount_chunk(
+                        conn, job_id, discount_id, plan_id, type_id, plan_ids, locked_prices,
+                        bool(discount["lose_on_lapse"]), after_user_id, self.chunk_size,
+                        DISCOUNT_GRACE_PERIOD_HOURS)
+                if not chunk["users"]:
+                    break
+                after_user_id = chunk["last_user_id"]
+                logging.debug(f"[Discount Apply] Job {job_id}: {chunk['users']} users, "
+                              f"{chunk['records']} records, {chunk['tasks']} tasks (last user {after_user_id}).")
+
+            async with self.db_pool.acquire() as conn:
+                await finish_discount_apply_job(conn, job_id, "completed")
+            logging.info(f"✅ [Discount Apply] Job {job_id} completed for discount {discount_id}.")
+        except Exception as e:
+            logging.error(f"❌ [Discount Apply] Job {job_id} failed: {e}", exc_info=True)
+            async with self.db_pool.acquire() as conn:
+                await finish_discount_apply_job(conn, job_id, "failed", error=str(e))
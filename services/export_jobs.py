@@ -0,0 +1,145 @@
+# services/export_jobs.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from asyncpg.pool import Pool
+
+from database.db_queries import (
+    claim_next_export_job,
+    finish_export_job,
+    purge_expired_export_jobs,
+    update_export_job_progress
+)
+from utils.export_stream import iter_record_chunks, write_csv_file, write_xlsx_file
+
+EXPORT_JOBS_DIR = os.getenv("EXPORT_JOBS_DIR", os.path.join(tempfile.gettempdir(), "exadoo_exports"))
+EXPORT_JOB_REUSE_SECONDS = int(os.getenv("EXPORT_JOB_REUSE_SECONDS", 300))  # إعادة استخدام الملف لنفس الطلب
+EXPORT_ARTIFACT_TTL_SECONDS = int(os.getenv("EXPORT_ARTIFACT_TTL_SECONDS", 24 * 3600))
+EXPORT_JOB_POLL_INTERVAL = 5
+EXPORT_JOB_STALE_SECONDS = 1800
+EXPORT_CLEANUP_INTERVAL = 600
+
+
+def export_params_hash(export_type: str, export_format: str, params: dict) -> str:
+    """بصمة الطلب: نفس النوع والصيغة والفلاتر (بغض النظر عن ترتيب المفاتيح) => نفس الملف."""
+    canonical = json.dumps({"type": export_type, "format": export_format, "params": params},
+                           sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ExportJobWorker:
+    """
+    عامل خلفي يعالج طابور export_jobs: يبني الاستعلام من معاملات الطلب المحفوظة،
+    يكتب الملف على القرص على دفعات عبر cursor (بدون pandas)، ويحدّث التقدم (rows_written / total_rows)
+    بعد كل دفعة. الطلب HTTP يرجع معرف المهمة فورًا فلا يبقى اتصال محجوزًا طوال التصدير.
+    """
+
+    def __init__(self, db_pool: Pool, job_types: dict):
+        """job_types: {export_type: (builder(params) -> (query, params, headers), filename_prefix, sheet_name)}"""
+        self.db_pool = db_pool
+        self.job_types = job_types
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._last_cleanup: Optional[float] = None
+
+    def start(self):
+        os.makedirs(EXPORT_JOBS_DIR, exist_ok=True)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_forever())
+            logging.info(f"✅ [Export Jobs] Worker started (dir={EXPORT_JOBS_DIR}).")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logging.info("🛑 [Export Jobs] Worker stopped.")
+
+    def wake(self):
+        """إيقاظ العامل فور إضافة مهمة جديدة بدل انتظار دورة الفحص التالية."""
+        self._wakeup.set()
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self._cleanup_expired()
+                if await self.process_next_job():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ [Export Jobs] Unhandled error in worker loop: {e}", exc_info=True)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=EXPORT_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_next_job(self) -> bool:
+        async with self.db_pool.acquire() as conn:
+            job = await claim_next_export_job(conn, stale_after_seconds=EXPORT_JOB_STALE_SECONDS)
+        if not job:
+            return False
+        await self._process_job(job)
+        return True
+
+    async def _process_job(self, job: dict):
+        job_id = job["id"]
+        export_format = job["export_format"]
+        builder, filename_prefix, sheet_name = self.job_types[job["export_type"]]
+        file_path = os.path.join(EXPORT_JOBS_DIR, f"{filename_prefix}_{job_id}.{export_format}")
+        partial_path = f"{file_path}.part"
+        logging.info(f"📦 [Export Jobs] Job {job_id} started ({job['export_type']}, {export_format}).")
+
+        try:
+            query, query_params, headers = builder(job["params"])
+            async with self.db_pool.acquire() as conn:
+                total_rows = await conn.fetchval(f"SELECT COUNT(*) FROM ({query}) AS export_rows", *query_params)
+                await update_export_job_progress(conn, job_id, 0, total_rows)
+
+            async def on_chunk(rows_written: int):
+                async with self.db_pool.acquire() as progress_conn:
+                    await update_export_job_progress(progress_conn, job_id, rows_written)
+
+            chunks = iter_record_chunks(self.db_pool, query, query_params)
+            if export_format == "csv":
+                rows_written = await write_csv_file(partial_path, chunks, headers, on_chunk)
+            else:
+                rows_written = await write_xlsx_file(partial_path, chunks, headers, sheet_name, on_chunk)
+
+            os.replace(partial_path, file_path)
+            async with self.db_pool.acquire() as conn:
+                await update_export_job_progress(conn, job_id, rows_written)
+                await finish_export_job(conn, job_id, "completed",
+                                        file_path=file_path, file_size=os.path.getsize(file_path))
+            logging.info(f"✅ [Export Jobs] Job {job_id} completed: {rows_written} rows -> {file_path}")
+        except Exception as e:
+            logging.error(f"❌ [Export Jobs] Job {job_id} failed: {e}", exc_info=True)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            async with self.db_pool.acquire() as conn:
+                await finish_export_job(conn, job_id, "failed", error=str(e))
+
+    async def _cleanup_expired(self):
+        now = asyncio.get_running_loop().time()
+        if self._last_cleanup is not None and now - self._last_cleanup < EXPORT_CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        async with self.db_pool.acquire() as conn:
+            paths = await purge_expired_export_jobs(conn, EXPORT_ARTIFACT_TTL_SECONDS)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"⚠️ [Export Jobs] Could not remove expired export {path}: {e}")
+        if paths:
+            logging.info(f"🧹 [Export Jobs] Removed {len(paths)} expired export file(s).")
@@ -0,0 +1,82 @@
+# services/payment_reconciliation.py
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from asyncpg.pool import Pool
+
+from database.db_queries import fetch_reconciliation_candidates, count_unmatched_incoming_transactions
+from routes.payment_confirmation import process_single_transaction
+
+RECONCILIATION_BATCH_LIMIT = 500
+RECONCILIATION_CONCURRENCY = 5
+RECONCILABLE_STATUSES = ("pending", "manual_check")
+
+
+class PaymentReconciliationService:
+    """
+    يطابق المعاملات الواردة غير المعالجة مع الدفعات المعلقة ويمررها دفعة واحدة
+    إلى نفس مسار التجديد المستخدم في المعالجة الفورية (process_single_transaction).
+    """
+
+    def __init__(self, db_pool: Pool, concurrency: int = RECONCILIATION_CONCURRENCY):
+        self.db_pool = db_pool
+        self.concurrency = max(1, concurrency)
+
+    async def find_candidates(self, limit: int = RECONCILIATION_BATCH_LIMIT) -> list[dict]:
+        async with self.db_pool.acquire() as conn:
+            return await fetch_reconciliation_candidates(conn, limit=limit, statuses=RECONCILABLE_STATUSES)
+
+    async def run(self, limit: int = RECONCILIATION_BATCH_LIMIT, dry_run: bool = False) -> dict:
+        """
+        تنفيذ دورة مطابقة واحدة وإرجاع تقرير بالنتائج.
+        في وضع dry_run تُعاد المطابقات فقط دون أي معالجة.
+        """
+        started_at = datetime.now(timezone.utc)
+        candidates = await self.find_candidates(limit)
+        async with self.db_pool.acquire() as conn:
+            unmatched_count = await count_unmatched_incoming_transactions(conn)
+
+        logging.info(
+            f"🔄 [Reconciliation] Found {len(candidates)} matching transactions "
+            f"({unmatched_count} unprocessed without a reconcilable payment). dry_run={dry_run}")
+
+        items = []
+        if dry_run:
+            items = [{**c, "outcome": "matched"} for c in candidates]
+        else:
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def _reconcile(candidate: dict) -> dict:
+                async with semaphore:
+                    transaction_data = {
+                        "tx_hash": candidate["txhash"],
+                        "jetton_amount": Decimal(str(candidate["amount_received"] or 0)),
+                        "sender": candidate["sender_address"],
+                        "payment_token": candidate["payment_token"],
+                    }
+                    try:
+                        outcome = await process_single_transaction(
+                            transaction_data, allowed_statuses=RECONCILABLE_STATUSES)
+                    except Exception as e:
+                        logging.error(
+                            f"❌ [Reconciliation] Unexpected error for tx {candidate['txhash']}: {e}", exc_info=True)
+                        outcome = "error"
+                    return {**candidate, "outcome": outcome or "error"}
+
+            items = await asyncio.gather(*(_reconcile(c) for c in candidates))
+
+        outcomes = Counter(item["outcome"] for item in items)
+        report = {
+            "started_at": started_at.isoformat(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "dry_run": dry_run,
+            "matched": len(candidates),
+            "unmatched_unprocessed": unmatched_count,
+            "outcomes": dict(outcomes),
+            "items": list(items),
+        }
+        logging.info(f"✅ [Reconciliation] Finished. matched={len(candidates)}, outcomes={dict(outcomes)}")
+        return report
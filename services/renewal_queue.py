@@ -0,0 +1,168 @@
+# services/renewal_queue.py
+import asyncio
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+from aiogram import Bot
+from asyncpg.pool import Pool
+
+from database.db_queries import (
+    claim_due_renewal_jobs,
+    update_renewal_job,
+    record_payment,
+    update_payment_status_to_manual_check
+)
+from routes.subscriptions import (
+    _attempt_subscription_renewal,
+    _finalize_renewal_payment,
+    renewal_backoff_seconds,
+    renewal_permanent_error,
+    try_lock_renewal,
+)
+
+RENEWAL_QUEUE_POLL_INTERVAL = 10  # ثوانٍ بين كل دورة فحص للطابور
+RENEWAL_QUEUE_BATCH_SIZE = 10
+
+
+class RenewalJobWorker:
+    """
+    عامل خلفي يعالج طابور التجديد الدائم (renewal_jobs).
+    كل مهمة تُنفذ كمحاولة واحدة بدون نوم داخلي، ثم يُعاد جدولتها بتأخير أُسّي عند الفشل،
+    فلا يبقى اتصال من الـ pool محجوزًا أثناء الانتظار.
+    """
+
+    def __init__(self, db_pool: Pool, bot: Bot):
+        self.db_pool = db_pool
+        self.bot = bot
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_forever())
+            logging.info("✅ [Renewal Queue] Worker started.")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logging.info("🛑 [Renewal Queue] Worker stopped.")
+
+    async def _run_forever(self):
+        while True:
+            try:
+                processed = await self.process_due_jobs()
+                if processed:
+                    continue  # قد تكون هناك مهام مستحقة أخرى، لا داعي للانتظار
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ [Renewal Queue] Unhandled error in worker loop: {e}", exc_info=True)
+            await asyncio.sleep(RENEWAL_QUEUE_POLL_INTERVAL)
+
+    async def process_due_jobs(self) -> int:
+        async with self.db_pool.acquire() as conn:
+            jobs = await claim_due_renewal_jobs(conn, limit=RENEWAL_QUEUE_BATCH_SIZE)
+
+        for job in jobs:
+            await self._process_job(job)
+        return len(jobs)
+
+    async def _process_job(self, job: dict):
+        job_id = job["id"]
+        attempt = job["attempts"]
+        payment_token = job["payment_token"]
+        logging.info(
+            f"🔄 [Renewal Queue] Job {job_id} attempt {attempt}/{job['max_attempts']} for token={payment_token}")
+
+        async with self.db_pool.acquire() as conn:
+            # نفس القفل الاستشاري الذي يأخذه process_subscription_renewal، فلا يجدد المستمع
+            # أو المطابقة الدفعة نفسها أثناء معالجتها هنا
+            async with conn.transaction():
+                await try_lock_renewal(conn, payment_token, wait=True)
+                await self._run_job(conn, job)
+
+    async def _run_job(self, conn, job: dict):
+        job_id = job["id"]
+        attempt = job["attempts"]
+        payment_token = job["payment_token"]
+        permanent = False
+        payment_data = None
+        try:
+            async with conn.transaction():
+                # منع التكرار: إذا اكتملت الدفعة بالفعل (مثلاً عبر مسار آخر) ننهي المهمة فورًا
+                payment_status = await conn.fetchval(
+                    "SELECT status FROM payments WHERE payment_token = $1", payment_token)
+                if payment_status == "completed":
+                    success, message = None, "Payment already completed."
+                else:
+                    try:
+                        payment_data = await self._build_payment_data(conn, job)
+                    except (KeyError, TypeError, ValueError, InvalidOperation):
+                        # بيانات المهمة نفسها غير صالحة: إعادة المحاولة لن تغير شيئًا
+                        payment_data, permanent = None, True
+                        raise
+                    message = await renewal_permanent_error(conn, payment_data)
+                    if message:
+                        success, permanent = False, True
+                    else:
+                        success, message = await _attempt_subscription_renewal(conn, self.bot, payment_data)
+        except Exception as e:
+            logging.error(f"❌ [Renewal Queue] Job {job_id} crashed: {e}", exc_info=True)
+            success, message = False, str(e) or type(e).__name__
+
+        if success is None:
+            await update_renewal_job(conn, job_id, "completed")
+            logging.info(f"ℹ️ [Renewal Queue] Job {job_id} skipped: payment already completed.")
+            return
+
+        if success:
+            await _finalize_renewal_payment(conn, self.bot, payment_data, True, message)
+            await update_renewal_job(conn, job_id, "completed")
+            logging.info(f"✅ [Renewal Queue] Job {job_id} completed on attempt {attempt}.")
+            return
+
+        if permanent or attempt >= job["max_attempts"]:
+            if payment_data:
+                await _finalize_renewal_payment(conn, self.bot, payment_data, False, message)
+            else:
+                await update_payment_status_to_manual_check(conn, payment_token, message)
+            await update_renewal_job(conn, job_id, "failed", last_error=message)
+            if permanent:
+                logging.error(f"🚫 [Renewal Queue] Job {job_id} failed permanently: {message}")
+            else:
+                logging.error(f"🚨 [Renewal Queue] Job {job_id} exhausted all {attempt} attempts: {message}")
+            return
+
+        delay = renewal_backoff_seconds(attempt)
+        await update_renewal_job(conn, job_id, "queued", last_error=message, delay_seconds=delay)
+        logging.warning(f"⏳ [Renewal Queue] Job {job_id} failed ({message}). Retrying in {delay}s.")
+
+    async def _build_payment_data(self, conn, job: dict) -> dict:
+        payment_data = dict(job["payload"])
+
+        # دفعات النجوم التي فشل تسجيلها أصلاً تُسجّل هنا أولاً
+        if payment_data.pop("pending_record", False):
+            payment_record = await record_payment(
+                conn=conn,
+                telegram_id=payment_data["telegram_id"],
+                subscription_plan_id=payment_data["plan_id"],
+                amount=Decimal(str(payment_data["amount"])),
+                payment_token=payment_data["payment_token"],
+                status='pending',
+                payment_method='Telegram Stars',
+                currency='Stars',
+                tx_hash=payment_data["payment_id"],
+                username=payment_data.get("username"),
+                full_name=payment_data.get("full_name")
+            )
+            if not payment_record:
+                raise Exception("Failed to record pending payment for Telegram Stars.")
+            payment_data = dict(payment_record)
+
+        if payment_data.get("amount_received") is not None:
+            payment_data["amount_received"] = Decimal(str(payment_data["amount_received"]))
+        return payment_data
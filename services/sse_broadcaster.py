@@ -3,38 +3,278 @@
 import asyncio
 import json
 import logging
+import time
+from collections import deque
+from typing import Optional
+
+SSE_REPLAY_BUFFER_SIZE = 100  # أقصى عدد أحداث محفوظة لكل مستخدم لإعادة الإرسال
+SSE_REPLAY_RETENTION_SECONDS = 300  # مدة الاحتفاظ بالمخزن بعد انقطاع آخر اتصال للمستخدم
+SSE_REPLAY_PRUNE_INTERVAL = 60
+SSE_QUEUE_SIZE = SSE_REPLAY_BUFFER_SIZE + 1
+SSE_WRITE_TIMEOUT = 10.0  # أقصى زمن لكتابة إطار واحد قبل اعتبار العميل متوقفًا
+SSE_SATURATION_EVICT_SECONDS = 30.0  # طرد الاتصال إذا بقي طابوره ممتلئًا طوال هذه المدة
+
+
+class _ReplayBuffer:
+    """مخزن دائري لآخر الأحداث المرسلة لمستخدم واحد: [(seq, body), ...]."""
+    __slots__ = ("events", "floor", "disconnected_at")
+
+    def __init__(self, floor: int):
+        self.events = deque(maxlen=SSE_REPLAY_BUFFER_SIZE)
+        # أي حدث seq <= floor لم يعد متاحًا في المخزن (قبل إنشائه أو أُزيح منه)
+        self.floor = floor
+        self.disconnected_at = None
+
+    def append(self, seq: int, body: str):
+        if len(self.events) == self.events.maxlen:
+            self.floor = self.events[0][0]
+        self.events.append((seq, body))
+
 
 class SSEBroadcaster:
     """
     هذه الفئة هي "الخادم".
     تدير اتصالات SSE النشطة والطوابير داخل خدمة SSE.
+    كل حدث يحمل معرّفًا (id) ويُحفظ في مخزن دائري لكل مستخدم، حتى يستعيد العميل
+    الأحداث الفائتة عند إعادة الاتصال عبر ترويسة Last-Event-ID بدلاً من إعادة الجلب من القاعدة.
     """
     def __init__(self):
         self._connections = {}
+        self._buffers = {}
+        self._totals = {"drops": 0, "evictions": 0, "write_timeouts": 0}
+        self._seq = 0
+        # يميّز معرفات هذه العملية عن معرفات عملية سابقة (بعد إعادة التشغيل تبدأ الأرقام من جديد)
+        self._epoch = format(int(time.time() * 1000), "x")
+        self._last_prune = time.monotonic()
         logging.info("✅ SSE Broadcaster (Server Mode) initialized.")
 
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def _format_event_id(self, seq: int) -> str:
+        return f"{self._epoch}-{seq}"
+
+    def _parse_event_id(self, event_id: Optional[str]) -> Optional[int]:
+        """إرجاع رقم التسلسل إذا كان المعرف صادرًا عن هذه العملية، وإلا None."""
+        if not event_id:
+            return None
+        epoch, _, seq = event_id.strip().rpartition("-")
+        if epoch != self._epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _deliver(self, telegram_id_str: str, body: str) -> int:
+        """
+        إضافة الحدث لمخزن المستخدم ثم دفعه لطوابير اتصالاته الحية.
+        المستخدم الذي انقطع مؤخرًا (ضمن مدة الاحتفاظ) يُحفظ له الحدث دون إرسال.
+        """
+        connections = self._connections.get(telegram_id_str)
+        buffer = self._buffers.get(telegram_id_str)
+        if not connections and buffer is None:
+            return 0
+
+        seq = self._next_seq()
+        if buffer is not None:
+            buffer.append(seq, body)
+
+        delivered = 0
+        if connections:
+            message = f"id: {self._format_event_id(seq)}\n{body}"
+            for queue_info in list(connections):
+                if self._offer(telegram_id_str, queue_info, message):
+                    delivered += 1
+        return delivered
+
+    def _offer(self, telegram_id_str: str, queue_info: dict, message: str) -> bool:
+        """
+        دفع رسالة لطابور اتصال واحد مع تحديث إحصائياته.
+        الطابور الممتلئ يُسقط الرسالة (العميل يستعيدها لاحقًا عبر Last-Event-ID)،
+        وإذا بقي ممتلئًا أكثر من SSE_SATURATION_EVICT_SECONDS يُطرد الاتصال.
+        """
+        queue = queue_info['queue']
+        stats = queue_info['stats']
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            now = time.monotonic()
+            stats['drops'] += 1
+            self._totals['drops'] += 1
+            if stats['saturated_since'] is None:
+                stats['saturated_since'] = now
+                logging.warning(f"SSE-SERVER: Queue full for user {telegram_id_str}, dropping messages.")
+            elif now - stats['saturated_since'] > SSE_SATURATION_EVICT_SECONDS:
+                self.evict(telegram_id_str, queue_info, "saturated")
+            return False
+
+        stats['saturated_since'] = None
+        depth = queue.qsize()
+        if depth > stats['high_water']:
+            stats['high_water'] = depth
+        return True
+
+    def record_write(self, connection_info: dict, latency: float):
+        """يُستدعى من معالج SSE بعد كل كتابة ناجحة على الـ socket."""
+        stats = connection_info['stats']
+        stats['writes'] += 1
+        stats['last_write_latency'] = latency
+        if latency > stats['max_write_latency']:
+            stats['max_write_latency'] = latency
+
+    def evict(self, telegram_id: str, connection_info: dict, reason: str):
+        """فصل اتصال بطيء: يتوقف استقباله للرسائل ويُغلق معالجه عند أول فحص."""
+        if connection_info.get('evicted'):
+            return
+        connection_info['evicted'] = reason
+        self._totals['evictions'] += 1
+        if reason == "write_timeout":
+            self._totals['write_timeouts'] += 1
+        stats = connection_info['stats']
+        logging.warning(
+            f"SSE-SERVER: Evicting connection for user {telegram_id} ({reason}): "
+            f"drops={stats['drops']}, high_water={stats['high_water']}, "
+            f"last_write_ms={stats['last_write_latency'] * 1000:.1f}")
+        self.unsubscribe(telegram_id, connection_info)
+
+    def stats(self, top: int = 20) -> dict:
+        """ملخص حالة الخادم لتحديد حجم طبقة SSE: العمق، الإسقاط، زمن الكتابة، وأبطأ الاتصالات."""
+        now = time.monotonic()
+        rows = []
+        for telegram_id_str, connections in self._connections.items():
+            for info in connections:
+                stats = info['stats']
+                rows.append({
+                    "telegram_id": telegram_id_str,
+                    "queue_depth": info['queue'].qsize(),
+                    "high_water": stats['high_water'],
+                    "drops": stats['drops'],
+                    "writes": stats['writes'],
+                    "last_write_ms": round(stats['last_write_latency'] * 1000, 2),
+                    "max_write_ms": round(stats['max_write_latency'] * 1000, 2),
+                    "saturated_for_s": round(now - stats['saturated_since'], 1) if stats['saturated_since'] else 0,
+                    "age_s": round(now - stats['connected_at'], 1),
+                })
+
+        def percentile(values, pct):
+            if not values:
+                return 0
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * pct))]
+
+        depths = [row["queue_depth"] for row in rows]
+        latencies = [row["last_write_ms"] for row in rows]
+        slowest = sorted(rows, key=lambda row: (row["queue_depth"], row["last_write_ms"]), reverse=True)[:top]
+        return {
+            "users_connected": len(self._connections),
+            "connections": len(rows),
+            "replay_buffers": len(self._buffers),
+            "queue_capacity": SSE_QUEUE_SIZE,
+            "queue_depth": {"p50": percentile(depths, 0.5), "p95": percentile(depths, 0.95),
+                            "max": max(depths, default=0)},
+            "high_water_max": max((row["high_water"] for row in rows), default=0),
+            "saturated_connections": sum(1 for row in rows if row["saturated_for_s"]),
+            "last_write_ms": {"p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+                              "max": max(latencies, default=0)},
+            "totals": dict(self._totals),
+            "slowest": slowest,
+        }
+
+    @staticmethod
+    def _format_body(message_type: str, data: dict) -> str:
+        return f"event: {message_type}\ndata: {json.dumps(data)}\n\n"
+
     async def publish(self, telegram_id: str, message_type: str, data: dict):
         telegram_id_str = str(telegram_id)
-        if telegram_id_str not in self._connections:
+        if telegram_id_str not in self._connections and telegram_id_str not in self._buffers:
             return
+        self._deliver(telegram_id_str, self._format_body(message_type, data))
 
-        formatted_message = f"event: {message_type}\ndata: {json.dumps(data)}\n\n"
-        for queue_info in self._connections[telegram_id_str]:
-            try:
-                queue_info['queue'].put_nowait(formatted_message)
-            except asyncio.QueueFull:
-                logging.warning(f"SSE-SERVER: Queue full for user {telegram_id_str}, message dropped.")
+    async def publish_many(self, telegram_ids, message_type: str, data: dict) -> int:
+        """
+        نشر نفس الرسالة لعدة مستخدمين مع تنسيقها مرة واحدة فقط.
+        التكلفة تتناسب مع عدد المستخدمين المتصلين فعليًا وليس مع طول القائمة.
+        """
+        targets = {str(tg_id) for tg_id in telegram_ids}
+        # المخازن تشمل كل المتصلين حاليًا + من انقطع مؤخرًا
+        if len(targets) > len(self._buffers):
+            reachable = [tg_id for tg_id in self._buffers if tg_id in targets]
+        else:
+            reachable = [tg_id for tg_id in targets if tg_id in self._buffers]
+        if not reachable:
+            return 0
+
+        body = self._format_body(message_type, data)
+        delivered = 0
+        for telegram_id_str in reachable:
+            delivered += self._deliver(telegram_id_str, body)
+        return delivered
 
-    def subscribe(self, telegram_id: str) -> dict:
+    async def publish_all(self, message_type: str, data: dict) -> int:
+        """نشر رسالة لكل المستخدمين المتصلين حاليًا (للإشعارات العامة)."""
+        return await self.publish_many(list(self._connections), message_type, data)
+
+    def subscribe(self, telegram_id: str, last_event_id: Optional[str] = None) -> dict:
+        """
+        تسجيل اتصال جديد. إذا أرسل العميل Last-Event-ID تُضاف الأحداث الفائتة فقط إلى طابوره،
+        وإذا تعذّر ذلك (مخزن منتهٍ أو ممتلئ أو إعادة تشغيل الخادم) يُرسل حدث resync ليعيد العميل الجلب.
+        """
         telegram_id_str = str(telegram_id)
-        queue = asyncio.Queue(maxsize=100)
-        connection_info = {'queue': queue}
+        self._prune_buffers()
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        connection_info = {
+            'queue': queue,
+            'evicted': None,
+            'stats': {
+                'connected_at': time.monotonic(),
+                'high_water': 0,
+                'drops': 0,
+                'writes': 0,
+                'last_write_latency': 0.0,
+                'max_write_latency': 0.0,
+                'saturated_since': None,
+            },
+        }
+
+        buffer = self._buffers.get(telegram_id_str)
+        if buffer is None:
+            buffer = self._buffers[telegram_id_str] = _ReplayBuffer(floor=self._seq)
+        buffer.disconnected_at = None
+
+        if last_event_id:
+            replayed = self._replay(buffer, last_event_id, queue)
+            logging.info(f"SSE-SERVER: Replayed {replayed} missed events for {telegram_id_str}.")
+
         if telegram_id_str not in self._connections:
             self._connections[telegram_id_str] = []
         self._connections[telegram_id_str].append(connection_info)
         logging.info(f"SSE-SERVER: New subscription for {telegram_id_str}.")
         return connection_info
 
+    def _replay(self, buffer: _ReplayBuffer, last_event_id: str, queue: asyncio.Queue):
+        last_seq = self._parse_event_id(last_event_id)
+        if last_seq is None or last_seq < buffer.floor:
+            queue.put_nowait(f"id: {self._format_event_id(self._seq)}\n"
+                             f"{self._format_body('resync', {'reason': 'replay_unavailable'})}")
+            return 0
+        replayed = 0
+        for seq, body in buffer.events:
+            if seq > last_seq:
+                queue.put_nowait(f"id: {self._format_event_id(seq)}\n{body}")
+                replayed += 1
+        return replayed
+
+    def _prune_buffers(self):
+        now = time.monotonic()
+        if now - self._last_prune < SSE_REPLAY_PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        expired = [
+            tg_id for tg_id, buffer in self._buffers.items()
+            if buffer.disconnected_at is not None and now - buffer.disconnected_at > SSE_REPLAY_RETENTION_SECONDS
+        ]
+        for tg_id in expired:
+            del self._buffers[tg_id]
+
     def unsubscribe(self, telegram_id: str, connection_info: dict):
         telegram_id_str = str(telegram_id)
         if telegram_id_str in self._connections:
@@ -42,6 +282,9 @@ class SSEBroadcaster:
                 self._connections[telegram_id_str].remove(connection_info)
                 if not self._connections[telegram_id_str]:
                     del self._connections[telegram_id_str]
+                    buffer = self._buffers.get(telegram_id_str)
+                    if buffer is not None:
+                        buffer.disconnected_at = time.monotonic()
                 logging.info(f"SSE-SERVER: Client unsubscribed for user {telegram_id_str}.")
             except ValueError:
                 pass
\ No newline at end of file
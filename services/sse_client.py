@@ -1,41 +1,116 @@
 # services/sse_client.py
 
 import os
+import asyncio
 import logging
 import aiohttp
 import json
 
 SSE_INTERNAL_URL = os.environ.get("SSE_INTERNAL_URL")
 INTERNAL_SECRET_KEY = os.environ.get("INTERNAL_SECRET_KEY")
+# نقطة النشر الجماعي (افتراضيًا: نفس عنوان النشر مع اللاحقة _batch)
+SSE_INTERNAL_BATCH_URL = os.environ.get("SSE_INTERNAL_BATCH_URL")
+
+SSE_BATCH_FLUSH_INTERVAL = 0.005  # نافذة التجميع بالثواني (5ms)
+SSE_BATCH_MAX_ITEMS = 500  # الحد الأقصى لعدد العناصر في طلب واحد
 
 
 class SseApiClient:
     """
     هذه الفئة هي "العميل".
     يستخدمها خادم API لإرسال طلبات النشر إلى خدمة SSE.
+    طلبات النشر تُجمّع خلال نافذة قصيرة وتُرسل كطلب واحد إلى /_internal/publish_batch
+    بدلاً من طلب HTTP لكل حدث.
     """
 
-    def __init__(self, session: aiohttp.ClientSession):
+    def __init__(self, session: aiohttp.ClientSession,
+                 flush_interval: float = SSE_BATCH_FLUSH_INTERVAL,
+                 max_batch_items: int = SSE_BATCH_MAX_ITEMS):
         if not all([SSE_INTERNAL_URL, INTERNAL_SECRET_KEY]):
             raise ValueError("SSE_INTERNAL_URL or INTERNAL_SECRET_KEY is not set in environment!")
 
         self.session = session
         self.url = SSE_INTERNAL_URL
+        self.batch_url = SSE_INTERNAL_BATCH_URL or f"{SSE_INTERNAL_URL.rstrip('/')}_batch"
         self.headers = {
             "Content-Type": "application/json",
             "X-Internal-Secret": INTERNAL_SECRET_KEY
         }
+        self.flush_interval = flush_interval
+        self.max_batch_items = max_batch_items
+
+        self._events = []
+        self._broadcasts = []
+        self._pending_items = 0
+        self._flush_handle = None
+        self._send_tasks = set()
         logging.info("✅ SSE API Client initialized.")
 
     async def publish(self, telegram_id: str, message_type: str, data: dict):
-        payload = {
+        """إضافة حدث لمستخدم واحد إلى الدفعة الحالية (لا ينتظر الإرسال الفعلي)."""
+        self._events.append({
             "telegram_id": str(telegram_id),
             "message_type": message_type,
             "payload": data
-        }
+        })
+        self._on_item_added(1)
+
+    async def publish_many(self, telegram_ids, message_type: str, data: dict):
+        """إضافة رسالة واحدة موجهة لقائمة مستخدمين (تُرسل الحمولة مرة واحدة فقط)."""
+        telegram_ids = [str(tg_id) for tg_id in telegram_ids]
+        if not telegram_ids:
+            return
+        self._broadcasts.append({
+            "message_type": message_type,
+            "payload": data,
+            "telegram_ids": telegram_ids
+        })
+        self._on_item_added(len(telegram_ids))
+
+    async def publish_all(self, message_type: str, data: dict):
+        """إضافة رسالة لكل المستخدمين المتصلين حاليًا بخدمة SSE (بدون قائمة مستخدمين)."""
+        self._broadcasts.append({
+            "message_type": message_type,
+            "payload": data,
+            "all_connected": True
+        })
+        self._on_item_added(1)
+
+    def _on_item_added(self, weight: int):
+        self._pending_items += weight
+        if self._pending_items >= self.max_batch_items:
+            self._schedule_send()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, self._schedule_send)
+
+    def _take_batch(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch = {"events": self._events, "broadcasts": self._broadcasts}
+        self._events, self._broadcasts, self._pending_items = [], [], 0
+        return batch
+
+    def _schedule_send(self):
+        batch = self._take_batch()
+        if not batch["events"] and not batch["broadcasts"]:
+            return
+        task = asyncio.create_task(self._send_batch(batch))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def flush(self):
+        """إرسال أي أحداث متبقية فورًا وانتظار اكتمال كل الطلبات الجارية."""
+        self._schedule_send()
+        if self._send_tasks:
+            await asyncio.gather(*list(self._send_tasks), return_exceptions=True)
+
+    async def _send_batch(self, batch: dict):
         try:
-            async with self.session.post(self.url, json=payload, headers=self.headers, timeout=5) as response:
+            async with self.session.post(self.batch_url, json=batch, headers=self.headers, timeout=10) as response:
                 if response.status != 200:
-                    logging.error(f"Failed to publish SSE event. Status: {response.status}")
+                    logging.error(f"Failed to publish SSE batch. Status: {response.status}")
         except Exception as e:
-            logging.error(f"Error publishing SSE event: {e}")
\ No newline at end of file
+            logging.error(f"Error publishing SSE batch "
+                          f"({len(batch['events'])} events, {len(batch['broadcasts'])} broadcasts): {e}")
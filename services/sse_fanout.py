@@ -0,0 +1,250 @@
+# services/sse_fanout.py
+"""
+ناقل توزيع (fan-out bus) بين عُقد خدمة SSE.
+
+خادم API ينشر الدفعة مرة واحدة إلى أي عقدة SSE، والعقدة تسلّمها لمشتركيها المحليين مباشرة
+ثم تنشرها على الناقل، فتستلمها باقي العقد (كل عقدة تتجاهل رسائلها) وتسلّمها لمشتركيها المحليين.
+
+الأنواع المدعومة (المتغير SSE_FANOUT_BACKEND):
+  - redis:    Redis pub/sub عبر server.redis_manager.RedisManager
+  - postgres: LISTEN/NOTIFY في Postgres (بديل عند عدم توفر Redis)
+  - local:    عقدة واحدة بدون ناقل خارجي (السلوك السابق)
+  - auto (الافتراضي): redis إن أمكن الاتصال، ثم postgres، ثم local.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Optional, Set
+
+SSE_FANOUT_BACKEND = os.environ.get("SSE_FANOUT_BACKEND", "auto").lower()
+SSE_FANOUT_CHANNEL = os.environ.get("SSE_FANOUT_CHANNEL", "sse_fanout")
+# حد حمولة NOTIFY في Postgres هو 8000 بايت، نترك هامشًا للأمان.
+# الدفعات الأكبر تُحفظ في جدول sse_fanout_payloads ويُرسل معرفها فقط.
+PG_NOTIFY_MAX_PAYLOAD = 7900
+PG_PAYLOAD_TTL_SECONDS = 300
+
+BatchHandler = Callable[[dict], Awaitable[None]]
+
+
+async def apply_batch(broadcaster, batch: dict) -> int:
+    """
+    تسليم دفعة {"events": [...], "broadcasts": [...]} للمشتركين المحليين في هذه العقدة.
+    يُفترض أن الدفعة تم التحقق منها مسبقًا في العقدة التي استقبلت الطلب.
+    """
+    delivered = 0
+    for event in batch.get("events") or []:
+        await broadcaster.publish(str(event["telegram_id"]), event["message_type"], event["payload"])
+        delivered += 1
+    for item in batch.get("broadcasts") or []:
+        if item.get("all_connected"):
+            await broadcaster.publish_all(item["message_type"], item["payload"])
+        else:
+            await broadcaster.publish_many(item.get("telegram_ids") or [], item["message_type"], item["payload"])
+        delivered += 1
+    return delivered
+
+
+class FanoutBus(ABC):
+    """
+    الواجهة المشتركة: start(handler) ثم publish(batch) ثم close().
+    publish يسلّم الدفعة محليًا أولًا ثم يرسلها للعقد الأخرى، فلا يعتمد التسليم المحلي على الناقل.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex[:12]
+        self._handler: Optional[BatchHandler] = None
+
+    async def start(self, handler: BatchHandler):
+        self._handler = handler
+
+    @abstractmethod
+    async def publish(self, batch: dict):
+        ...
+
+    async def close(self):
+        pass
+
+    def _envelope(self, batch: dict) -> str:
+        return json.dumps({"node": self.node_id, "batch": batch})
+
+    async def _resolve(self, message: dict) -> Optional[dict]:
+        return message.get("batch")
+
+    async def _dispatch(self, raw: str):
+        try:
+            message = json.loads(raw)
+            if message.get("node") == self.node_id:
+                return  # سُلّمت محليًا عند النشر
+            batch = await self._resolve(message)
+            if batch is not None:
+                await self._handler(batch)
+        except Exception as e:
+            logging.error(f"SSE-FANOUT[{self.name}]: Failed to dispatch message: {e}", exc_info=True)
+
+
+class LocalFanoutBus(FanoutBus):
+    """عقدة واحدة: التسليم مباشرة بدون أي ناقل خارجي."""
+
+    name = "local"
+
+    async def publish(self, batch: dict):
+        await self._handler(batch)
+
+
+class RedisFanoutBus(FanoutBus):
+    """Redis pub/sub: رسالة واحدة على القناة تصل لكل العقد المشتركة."""
+
+    name = "redis"
+
+    def __init__(self, redis_manager, channel: str = SSE_FANOUT_CHANNEL):
+        super().__init__()
+        self.redis_manager = redis_manager
+        self.channel = channel
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: BatchHandler):
+        await super().start(handler)
+        await self.redis_manager.connect()
+        self._pubsub = self.redis_manager.redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen())
+        logging.info(f"✅ SSE-FANOUT: Node {self.node_id} subscribed to Redis channel '{self.channel}'.")
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"SSE-FANOUT[redis]: Listener error, resubscribing in 1s: {e}")
+                await asyncio.sleep(1)
+                try:
+                    await self.redis_manager.connect()
+                    self._pubsub = self.redis_manager.redis.pubsub()
+                    await self._pubsub.subscribe(self.channel)
+                except Exception as re:
+                    logging.error(f"SSE-FANOUT[redis]: Resubscribe failed: {re}")
+
+    async def publish(self, batch: dict):
+        await self._handler(batch)
+        await self.redis_manager.redis.publish(self.channel, self._envelope(batch))
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._pubsub:
+            try:
+                await self._pubsub.unsubscribe(self.channel)
+                await self._pubsub.close()
+            except Exception:
+                pass
+
+
+class PostgresFanoutBus(FanoutBus):
+    """
+    LISTEN/NOTIFY في Postgres. حمولة NOTIFY محدودة بـ 8000 بايت، لذلك الدفعة الأكبر من الحد
+    تُحفظ في جدول sse_fanout_payloads ويُرسل معرفها فقط، وكل عقدة تقرأها من الجدول.
+    """
+
+    name = "postgres"
+
+    def __init__(self, db_config: dict, channel: str = SSE_FANOUT_CHANNEL):
+        super().__init__()
+        self.db_config = db_config
+        self.channel = channel
+        self._listen_conn = None
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+        # asyncio يحتفظ بمرجع ضعيف فقط للمهام، فنحفظ مهام التوزيع حتى لا تُجمع قبل انتهائها
+        self._dispatch_tasks: Set[asyncio.Task] = set()
+
+    async def start(self, handler: BatchHandler):
+        import asyncpg
+
+        await super().start(handler)
+        self._listen_conn = await asyncpg.connect(**self.db_config)
+        self._publish_conn = await asyncpg.connect(**self.db_config)
+        await self._listen_conn.add_listener(self.channel, self._on_notify)
+        logging.info(f"✅ SSE-FANOUT: Node {self.node_id} listening on Postgres channel '{self.channel}'.")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        task = asyncio.create_task(self._dispatch(payload))
+        self._dispatch_tasks.add(task)
+        task.add_done_callback(self._dispatch_tasks.discard)
+
+    async def _resolve(self, message: dict) -> Optional[dict]:
+        if "ref" not in message:
+            return message.get("batch")
+        async with self._publish_lock:
+            payload = await self._publish_conn.fetchval(
+                "SELECT payload FROM sse_fanout_payloads WHERE id = $1", message["ref"])
+        if payload is None:
+            logging.error(f"SSE-FANOUT[postgres]: Payload {message['ref']} not found (expired?).")
+            return None
+        return json.loads(payload)
+
+    async def publish(self, batch: dict):
+        await self._handler(batch)
+
+        payload = self._envelope(batch)
+        async with self._publish_lock:
+            if len(payload.encode("utf-8")) > PG_NOTIFY_MAX_PAYLOAD:
+                async with self._publish_conn.transaction():
+                    await self._publish_conn.execute(
+                        "DELETE FROM sse_fanout_payloads WHERE created_at < NOW() - ($1 * INTERVAL '1 second')",
+                        PG_PAYLOAD_TTL_SECONDS)
+                    ref = await self._publish_conn.fetchval(
+                        "INSERT INTO sse_fanout_payloads (payload) VALUES ($1) RETURNING id", json.dumps(batch))
+                    # الإشعار يصل بعد COMMIT، أي بعد أن يصبح السطر مرئيًا للعقد الأخرى
+                    await self._publish_conn.execute(
+                        "SELECT pg_notify($1, $2)", self.channel, json.dumps({"node": self.node_id, "ref": ref}))
+            else:
+                await self._publish_conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+
+    async def close(self):
+        for task in list(self._dispatch_tasks):
+            task.cancel()
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+
+
+async def create_fanout_bus(backend: str = SSE_FANOUT_BACKEND) -> FanoutBus:
+    """إنشاء الناقل المطلوب. في وضع auto يُجرب redis ثم postgres ثم local."""
+    if backend in ("redis", "auto"):
+        try:
+            from server.redis_manager import redis_manager
+            await redis_manager.connect()
+            return RedisFanoutBus(redis_manager)
+        except Exception as e:
+            if backend == "redis":
+                raise
+            logging.warning(f"⚠️ SSE-FANOUT: Redis unavailable, falling back to Postgres: {e}")
+
+    if backend in ("postgres", "auto"):
+        try:
+            import asyncpg
+            from config import DATABASE_CONFIG
+            conn = await asyncpg.connect(**DATABASE_CONFIG)
+            await conn.close()
+            return PostgresFanoutBus(DATABASE_CONFIG)
+        except Exception as e:
+            if backend == "postgres":
+                raise
+            logging.warning(f"⚠️ SSE-FANOUT: Postgres unavailable, running single-node: {e}")
+
+    return LocalFanoutBus()
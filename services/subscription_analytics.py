@@ -0,0 +1,329 @@
+# services/subscription_analytics.py
+"""
+تحليلات الاحتفاظ والتجديد للوحة التحكم:
+  - cohort retention: المستخدمون مجمعون حسب شهر أول تفعيل، ونسبة من بقي لديه اشتراك فعّال بعد 0..N شهر
+  - renewal rate per plan: نسبة المدفوعات المكتملة التي تبعها دفع آخر لنفس النوع قبل انتهاء المدة (+ مهلة)
+  - churn by source: الفترات المنتهية بدون تجديد خلال المهلة، مجمعة حسب مصدر الاشتراك
+
+البيانات تُسحب من subscription_history و payments عبر cursor على دفعات، كل دفعة تتحول إلى
+DataFrame بأعمدة مضغوطة (datetime64 / int64)، والحساب كله عمليات متجهة (NumPy / pandas) في thread
+منفصل حتى لا يتوقف event loop. النتائج تُخزن في الذاكرة لكل (مقياس، نطاق تاريخ، معاملات).
+"""
+
+import asyncio
+import logging
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from utils.export_stream import iter_record_chunks
+
+ANALYTICS_CHUNK_SIZE = 20000
+ANALYTICS_CACHE_TTL_SECONDS = 600
+ANALYTICS_CACHE_MAX_ENTRIES = 128
+DEFAULT_GRACE_DAYS = 7
+MAX_GRACE_DAYS = 90
+
+ACTIVATION_ACTIONS = ["NEW", "RENEWAL", "ADMIN_NEW", "ADMIN_RENEWAL"]
+
+_cache: Dict[tuple, tuple] = {}
+_cache_locks: Dict[tuple, asyncio.Lock] = {}
+
+
+# --- التحميل على دفعات ---
+
+async def _fetch_frame(pool, query: str, params: list, columns: List[str],
+                       datetime_columns=(), int_columns=()) -> pd.DataFrame:
+    """تحويل كل دفعة إلى DataFrame بأنواع مضغوطة ثم دمجها، بدل تجميع كل الصفوف كقائمة dicts."""
+    frames = []
+    async for chunk in iter_record_chunks(pool, query, params, chunk_size=ANALYTICS_CHUNK_SIZE):
+        frame = pd.DataFrame.from_records(chunk, columns=columns)
+        for col in datetime_columns:
+            frame[col] = _to_utc_naive(frame[col])
+        for col in int_columns:
+            frame[col] = frame[col].astype("int64")
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame({col: pd.Series(dtype="datetime64[ns]" if col in datetime_columns else "object")
+                             for col in columns})
+    return pd.concat(frames, ignore_index=True)
+
+
+def _to_utc_naive(series: pd.Series) -> pd.Series:
+    # timestamptz من history و timestamp (UTC) من payments => datetime64 بدون منطقة زمنية
+    converted = pd.to_datetime(series, utc=True)
+    return converted.dt.tz_localize(None)
+
+
+def _month_index(values) -> np.ndarray:
+    values = pd.DatetimeIndex(values)
+    return (values.year * 12 + values.month - 1).to_numpy(dtype="int64")
+
+
+def _month_label(index: int) -> str:
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def _utc_now() -> pd.Timestamp:
+    return pd.Timestamp(datetime.now(timezone.utc).replace(tzinfo=None))
+
+
+def _bounds(start_date: date, end_date: date):
+    # نطاق التواريخ شامل لليوم الأخير
+    return (datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc),
+            datetime.combine(end_date, datetime.min.time(), tzinfo=timezone.utc) + timedelta(days=1))
+
+
+# --- Cohort retention ---
+
+COHORT_EVENTS_QUERY = """
+    WITH cohort_users AS (
+        SELECT telegram_id
+        FROM subscription_history
+        WHERE action_type = ANY($1::text[]) AND telegram_id IS NOT NULL
+        GROUP BY telegram_id
+        HAVING MIN(changed_at) >= $2 AND MIN(changed_at) < $3
+    )
+    SELECT sh.telegram_id, sh.changed_at, COALESCE(sh.expiry_date, sh.changed_at) AS expiry_date
+    FROM subscription_history sh
+    JOIN cohort_users cu ON cu.telegram_id = sh.telegram_id
+    WHERE sh.action_type = ANY($1::text[]) AND sh.changed_at IS NOT NULL
+"""
+
+
+def compute_cohort_retention(events: pd.DataFrame, max_months: int, now: pd.Timestamp) -> List[dict]:
+    """
+    events: telegram_id, changed_at, expiry_date. كل فترة [changed_at, expiry_date] تغطي أشهرًا،
+    ويتم توسيعها إلى صفوف (مستخدم، شهر) دفعة واحدة عبر np.repeat بدل حلقة على المستخدمين.
+    """
+    if events.empty:
+        return []
+
+    current_month = _month_index([now])[0]
+    user_ids = events["telegram_id"].to_numpy(dtype="int64")
+    cohort = _month_index(events.groupby("telegram_id")["changed_at"].transform("min"))
+    start_month = _month_index(events["changed_at"])
+    # الاشتراك الممتد للمستقبل لا يُحتسب احتفاظًا في أشهر لم تأتِ بعد
+    end_month = np.minimum(_month_index(events["expiry_date"].fillna(events["changed_at"])), current_month)
+    end_month = np.maximum(end_month, start_month)
+
+    lengths = end_month - start_month + 1
+    total = int(lengths.sum())
+    offsets_within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    covered = pd.DataFrame({
+        "telegram_id": np.repeat(user_ids, lengths),
+        "cohort": np.repeat(cohort, lengths),
+        "offset": np.repeat(start_month, lengths) + offsets_within - np.repeat(cohort, lengths),
+    })
+    covered = covered[(covered["offset"] >= 0) & (covered["offset"] <= max_months)]
+    covered = covered.drop_duplicates(["telegram_id", "offset"])
+
+    retained = covered.groupby(["cohort", "offset"]).size().unstack(fill_value=0)
+    retained = retained.reindex(columns=range(max_months + 1), fill_value=0)
+    sizes = retained[0]
+    rates = retained.div(sizes, axis=0)
+
+    result = []
+    for cohort_month, counts in retained.iterrows():
+        observable = current_month - cohort_month  # الأشهر التي مرت فعلًا منذ بداية الـ cohort
+        result.append({
+            "cohort": _month_label(cohort_month),
+            "size": int(sizes[cohort_month]),
+            "retained": [int(v) if i <= observable else None for i, v in enumerate(counts)],
+            "retention": [round(float(r) * 100, 2) if i <= observable else None
+                          for i, r in enumerate(rates.loc[cohort_month])],
+        })
+    return result
+
+
+async def get_cohort_retention(pool, start_date: date, end_date: date, max_months: int = 12,
+                               refresh: bool = False) -> dict:
+    async def compute():
+        start_ts, end_ts = _bounds(start_date, end_date)
+        events = await _fetch_frame(pool, COHORT_EVENTS_QUERY, [ACTIVATION_ACTIONS, start_ts, end_ts],
+                                    ["telegram_id", "changed_at", "expiry_date"],
+                                    datetime_columns=("changed_at", "expiry_date"), int_columns=("telegram_id",))
+        cohorts = await asyncio.to_thread(compute_cohort_retention, events, max_months, _utc_now())
+        return {"months": max_months, "cohorts": cohorts}
+
+    return await _cached(("cohorts", start_date, end_date, max_months), compute, refresh)
+
+
+# --- Renewal rate per plan ---
+
+RENEWAL_PAYMENTS_QUERY = """
+    SELECT p.telegram_id, p.subscription_plan_id, sp.subscription_type_id, sp.duration_days, p.created_at
+    FROM payments p
+    JOIN subscription_plans sp ON sp.id = p.subscription_plan_id
+    WHERE p.status = 'completed' AND p.telegram_id IS NOT NULL
+      AND p.created_at >= ($1::timestamptz AT TIME ZONE 'UTC')
+"""
+
+
+def compute_renewal_rates(payments: pd.DataFrame, end_ts: pd.Timestamp, grace_days: int,
+                          now: pd.Timestamp) -> pd.DataFrame:
+    """
+    الدفعة "مجددة" إذا تبعها دفع مكتمل لنفس المستخدم ونفس نوع الاشتراك قبل نهاية مدتها + المهلة.
+    تُحتسب فقط الدفعات داخل النطاق التي انتهت مدتها + المهلة (وإلا لا نعرف النتيجة بعد).
+    """
+    columns = ["subscription_plan_id", "eligible", "renewed", "renewal_rate"]
+    if payments.empty:
+        return pd.DataFrame(columns=columns)
+
+    payments = payments.sort_values(["telegram_id", "subscription_type_id", "created_at"], kind="mergesort")
+    next_payment = payments.groupby(["telegram_id", "subscription_type_id"])["created_at"].shift(-1)
+    deadline = payments["created_at"] + pd.to_timedelta(payments["duration_days"] + grace_days, unit="D")
+
+    base = (payments["created_at"] < end_ts) & (deadline <= now)
+    renewed = base & next_payment.notna() & (next_payment <= deadline)
+
+    stats = pd.DataFrame({
+        "subscription_plan_id": payments["subscription_plan_id"],
+        "eligible": base.astype("int64"),
+        "renewed": renewed.astype("int64"),
+    }).groupby("subscription_plan_id", as_index=False).sum()
+    stats = stats[stats["eligible"] > 0]
+    stats["renewal_rate"] = (stats["renewed"] / stats["eligible"] * 100).round(2)
+    return stats[columns]
+
+
+async def get_renewal_rates(pool, start_date: date, end_date: date, grace_days: int = DEFAULT_GRACE_DAYS,
+                            refresh: bool = False) -> dict:
+    async def compute():
+        start_ts, end_ts = _bounds(start_date, end_date)
+        payments = await _fetch_frame(pool, RENEWAL_PAYMENTS_QUERY, [start_ts],
+                                      ["telegram_id", "subscription_plan_id", "subscription_type_id",
+                                       "duration_days", "created_at"],
+                                      datetime_columns=("created_at",),
+                                      int_columns=("telegram_id", "subscription_plan_id",
+                                                   "subscription_type_id", "duration_days"))
+        stats = await asyncio.to_thread(compute_renewal_rates, payments,
+                                        pd.Timestamp(end_ts.replace(tzinfo=None)), grace_days, _utc_now())
+        async with pool.acquire() as conn:
+            plans = await conn.fetch("""
+                SELECT sp.id, sp.name AS plan_name, sp.duration_days, st.name AS subscription_type_name
+                FROM subscription_plans sp
+                LEFT JOIN subscription_types st ON st.id = sp.subscription_type_id
+                WHERE sp.id = ANY($1::int[])
+            """, [int(plan_id) for plan_id in stats["subscription_plan_id"]])
+        plan_info = {row["id"]: dict(row) for row in plans}
+        return {
+            "grace_days": grace_days,
+            "plans": [{
+                "subscription_plan_id": int(row.subscription_plan_id),
+                "plan_name": plan_info.get(row.subscription_plan_id, {}).get("plan_name"),
+                "subscription_type_name": plan_info.get(row.subscription_plan_id, {}).get("subscription_type_name"),
+                "duration_days": plan_info.get(row.subscription_plan_id, {}).get("duration_days"),
+                "eligible": int(row.eligible),
+                "renewed": int(row.renewed),
+                "renewal_rate": float(row.renewal_rate),
+            } for row in stats.itertuples(index=False)],
+        }
+
+    return await _cached(("renewals", start_date, end_date, grace_days), compute, refresh)
+
+
+# --- Churn by source ---
+
+CHURN_TERMS_QUERY = """
+    SELECT sh.telegram_id,
+           COALESCE(s.subscription_type_id, 0) AS subscription_type_id,
+           COALESCE(NULLIF(sh.source, ''), NULLIF(sh.extra_data->>'source', ''), s.source, 'Unknown') AS source,
+           sh.changed_at,
+           sh.expiry_date
+    FROM subscription_history sh
+    JOIN subscriptions s ON s.id = sh.subscription_id
+    WHERE sh.action_type = ANY($1::text[])
+      AND sh.telegram_id IS NOT NULL AND sh.changed_at IS NOT NULL
+      AND sh.expiry_date >= $2
+"""
+
+
+def compute_churn_by_source(terms: pd.DataFrame, start_ts: pd.Timestamp, end_ts: pd.Timestamp,
+                            grace_days: int, now: pd.Timestamp) -> pd.DataFrame:
+    """
+    فترة منتهية = expiry_date داخل النطاق ومرت مهلتها. تعتبر churn إذا لم يتبعها تفعيل/تجديد
+    لنفس المستخدم ونفس النوع قبل expiry_date + المهلة (التجديد المبكر يُحتسب تجديدًا).
+    """
+    columns = ["source", "ended", "renewed", "churned", "churn_rate"]
+    if terms.empty:
+        return pd.DataFrame(columns=columns)
+
+    terms = terms.sort_values(["telegram_id", "subscription_type_id", "changed_at"], kind="mergesort")
+    next_start = terms.groupby(["telegram_id", "subscription_type_id"])["changed_at"].shift(-1)
+    deadline = terms["expiry_date"] + pd.Timedelta(days=grace_days)
+
+    ended = (terms["expiry_date"] >= start_ts) & (terms["expiry_date"] < end_ts) & (deadline <= now)
+    renewed = ended & next_start.notna() & (next_start <= deadline)
+
+    stats = pd.DataFrame({
+        "source": terms["source"],
+        "ended": ended.astype("int64"),
+        "renewed": renewed.astype("int64"),
+    }).groupby("source", as_index=False).sum()
+    stats = stats[stats["ended"] > 0]
+    stats["churned"] = stats["ended"] - stats["renewed"]
+    stats["churn_rate"] = (stats["churned"] / stats["ended"] * 100).round(2)
+    return stats.sort_values("ended", ascending=False)[columns]
+
+
+async def get_churn_by_source(pool, start_date: date, end_date: date, grace_days: int = DEFAULT_GRACE_DAYS,
+                              refresh: bool = False) -> dict:
+    async def compute():
+        start_ts, end_ts = _bounds(start_date, end_date)
+        terms = await _fetch_frame(pool, CHURN_TERMS_QUERY, [ACTIVATION_ACTIONS, start_ts],
+                                   ["telegram_id", "subscription_type_id", "source", "changed_at", "expiry_date"],
+                                   datetime_columns=("changed_at", "expiry_date"),
+                                   int_columns=("telegram_id", "subscription_type_id"))
+        stats = await asyncio.to_thread(compute_churn_by_source, terms,
+                                        pd.Timestamp(start_ts.replace(tzinfo=None)),
+                                        pd.Timestamp(end_ts.replace(tzinfo=None)), grace_days, _utc_now())
+        return {
+            "grace_days": grace_days,
+            "sources": [{
+                "source": row.source,
+                "ended": int(row.ended),
+                "renewed": int(row.renewed),
+                "churned": int(row.churned),
+                "churn_rate": float(row.churn_rate),
+            } for row in stats.itertuples(index=False)],
+        }
+
+    return await _cached(("churn", start_date, end_date, grace_days), compute, refresh)
+
+
+# --- الكاش ---
+
+async def _cached(key: tuple, compute, refresh: bool = False) -> dict:
+    """
+    كاش في الذاكرة لكل نطاق تاريخ مع TTL. قفل لكل مفتاح حتى لا تحسب الطلبات المتزامنة نفس النتيجة مرتين.
+    """
+    entry = _cache.get(key)
+    if entry and not refresh and entry[0] > time.monotonic():
+        return entry[1]
+
+    lock = _cache_locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            entry = _cache.get(key)
+            if entry and not refresh and entry[0] > time.monotonic():
+                return entry[1]
+
+            started = time.monotonic()
+            result = await compute()
+            result["generated_at"] = datetime.now(timezone.utc).isoformat()
+            logging.info(f"📊 [Analytics] Computed {key[0]} for {key[1]}..{key[2]} in {time.monotonic() - started:.2f}s")
+
+            if len(_cache) >= ANALYTICS_CACHE_MAX_ENTRIES:
+                oldest_key = min(_cache, key=lambda k: _cache[k][0])
+                _cache.pop(oldest_key, None)
+            _cache[key] = (time.monotonic() + ANALYTICS_CACHE_TTL_SECONDS, result)
+            return result
+    finally:
+        # القفل يُحذف عند آخر مستخدم له (حتى عند فشل compute)، فلا تتراكم أقفال لكل نطاق طُلب مرة
+        if not lock.locked() and _cache_locks.get(key) is lock:
+            _cache_locks.pop(key, None)
+
@@ -6,7 +6,8 @@ import logging
 import json
 from aiohttp import web
 from dotenv import load_dotenv # ✅ استيراد جديد
-from services.sse_broadcaster import SSEBroadcaster # ✅ استخدم الـ Broadcaster الأصلي
+from services.sse_broadcaster import SSEBroadcaster, SSE_WRITE_TIMEOUT # ✅ استخدم الـ Broadcaster الأصلي
+from services.sse_fanout import apply_batch, create_fanout_bus
 
 load_dotenv() # ✅ قم بتحميل المتغيرات من ملف .env
 
@@ -20,6 +21,8 @@ if not INTERNAL_SECRET:
 
 # ✅ هذا صحيح الآن، لأن SSEBroadcaster الأصلي لا يحتاج إلى session
 broadcaster = SSEBroadcaster()
+# ناقل التوزيع بين عقد SSE (يُنشأ عند بدء التشغيل)
+fanout_bus = None
 
 
 # --- معالجات الطلبات (Request Handlers) ---
@@ -32,8 +35,12 @@ async def sse_handler(request: web.Request):
     if not telegram_id or not telegram_id.isdigit():
         return web.Response(text="telegram_id is required and must be a digit.", status=400)
 
-    logging.info(f"SSE-SERVER: Client connected for user {telegram_id}.")
-    connection_info = broadcaster.subscribe(telegram_id)
+    # EventSource يرسل Last-Event-ID تلقائيًا عند إعادة الاتصال؛ نقبله أيضًا كمعامل للعملاء الآخرين
+    last_event_id = request.headers.get("Last-Event-ID") or request.query.get("last_event_id")
+
+    logging.info(f"SSE-SERVER: Client connected for user {telegram_id}"
+                 f"{f' (resuming after {last_event_id})' if last_event_id else ''}.")
+    connection_info = broadcaster.subscribe(telegram_id, last_event_id=last_event_id)
     queue = connection_info['queue']
 
     response = web.StreamResponse(
@@ -47,14 +54,28 @@ async def sse_handler(request: web.Request):
     )
     await response.prepare(request)
 
+    async def write(chunk: bytes):
+        # مهلة لكل كتابة: عميل TCP متوقف لا يحجز الذاكرة والمعالج إلى ما لا نهاية
+        started = loop.time()
+        try:
+            await asyncio.wait_for(response.write(chunk), timeout=SSE_WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            broadcaster.evict(telegram_id, connection_info, "write_timeout")
+            raise ConnectionResetError("SSE write timed out")
+        broadcaster.record_write(connection_info, loop.time() - started)
+
+    loop = asyncio.get_running_loop()
     try:
-        await response.write(b"event: connection_established\ndata: {\"status\": \"connected\"}\n\n")
-        while True:
+        await write(b"event: connection_established\ndata: {\"status\": \"connected\"}\n\n")
+        while not connection_info['evicted']:
             try:
                 data = await asyncio.wait_for(queue.get(), timeout=15.0)  # استخدام فاصل 15 ثانية
-                await response.write(data.encode('utf-8'))
             except asyncio.TimeoutError:
-                await response.write(b"event: heartbeat\ndata: \n\n")
+                await write(b"event: heartbeat\ndata: \n\n")
+                continue
+            await write(data.encode('utf-8'))
+        logging.info(f"SSE-SERVER: Closing evicted connection for user {telegram_id} "
+                     f"({connection_info['evicted']}).")
     except (asyncio.CancelledError, ConnectionResetError):
         logging.info(f"SSE-SERVER: Client for user {telegram_id} disconnected.")
     finally:
@@ -81,12 +102,81 @@ async def internal_publish_handler(request: web.Request):
     except json.JSONDecodeError:
         return web.json_response({"error": "Invalid JSON"}, status=400)
 
-    # 3. النشر باستخدام الـ broadcaster
+    # 3. النشر مرة واحدة على الناقل، وكل عقدة تسلّم لمشتركيها المحليين
     logging.info(f"SSE-SERVER: Received internal publish for user {telegram_id}, type: {message_type}")
-    await broadcaster.publish(str(telegram_id), message_type, payload)
+    try:
+        await fanout_bus.publish({"events": [
+            {"telegram_id": str(telegram_id), "message_type": message_type, "payload": payload}
+        ]})
+    except Exception as e:
+        # التسليم المحلي يتم قبل الإرسال على الناقل، فالفشل هنا يخص العقد الأخرى فقط
+        logging.error(f"SSE-SERVER: Fan-out publish failed for user {telegram_id}: {e}", exc_info=True)
+        return web.json_response({"error": "Fan-out to other nodes failed"}, status=502)
 
     return web.json_response({"status": "published"}, status=200)
 
+async def internal_publish_batch_handler(request: web.Request):
+    """
+    معالج النشر الجماعي. يقبل في طلب واحد:
+      - "events": قائمة أحداث فردية [{telegram_id, message_type, payload}, ...]
+      - "broadcasts": قائمة رسائل موحدة [{message_type, payload, telegram_ids: [...]}, ...]
+        أو {message_type, payload, all_connected: true} لكل المستخدمين المتصلين
+    تُنشر الدفعة مرة واحدة على ناقل التوزيع فتصل لكل عقد SSE بنفس الترتيب.
+    """
+    if request.headers.get("X-Internal-Secret") != INTERNAL_SECRET:
+        logging.warning("SSE-SERVER: Received unauthorized internal batch publish request.")
+        return web.Response(status=403)
+
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+    events = data.get("events") or []
+    broadcasts = data.get("broadcasts") or []
+    if not isinstance(events, list) or not isinstance(broadcasts, list):
+        return web.json_response({"error": "events and broadcasts must be lists"}, status=400)
+
+    valid_events = [
+        event for event in events
+        if event.get("telegram_id") and event.get("message_type") and event.get("payload") is not None
+    ]
+    valid_broadcasts = [
+        item for item in broadcasts
+        if item.get("message_type") and item.get("payload") is not None
+    ]
+    accepted = len(valid_events) + len(valid_broadcasts)
+    skipped = len(events) + len(broadcasts) - accepted
+
+    if accepted:
+        try:
+            await fanout_bus.publish({"events": valid_events, "broadcasts": valid_broadcasts})
+        except Exception as e:
+            logging.error(f"SSE-SERVER: Fan-out batch publish failed: {e}", exc_info=True)
+            return web.json_response({"error": "Fan-out to other nodes failed", "accepted": accepted,
+                                      "skipped": skipped}, status=502)
+
+    logging.info(
+        f"SSE-SERVER: Batch publish processed {len(events)} events and {len(broadcasts)} broadcasts "
+        f"(skipped {skipped}).")
+    return web.json_response({"status": "published", "accepted": accepted, "skipped": skipped}, status=200)
+
+async def internal_stats_handler(request: web.Request):
+    """إحصائيات الاتصالات في هذه العقدة (العمق، الإسقاط، زمن الكتابة، الطرد) لتحديد حجم طبقة SSE."""
+    if request.headers.get("X-Internal-Secret") != INTERNAL_SECRET:
+        logging.warning("SSE-SERVER: Received unauthorized internal stats request.")
+        return web.Response(status=403)
+
+    try:
+        top = min(int(request.query.get("top", 20)), 200)
+    except ValueError:
+        return web.json_response({"error": "top must be an integer"}, status=400)
+
+    stats = broadcaster.stats(top=top)
+    stats["node_id"] = fanout_bus.node_id if fanout_bus else None
+    stats["fanout_backend"] = fanout_bus.name if fanout_bus else None
+    return web.json_response(stats, status=200)
+
 # ====================================================================
 # ✅ تعديل 1: إضافة معالج لفحص الحالة الصحية (Health Check)
 # هذا المعالج سيستجيب لطلبات Render على المسار الرئيسي "/"
@@ -103,12 +193,28 @@ async def health_check_handler(request: web.Request):
     )
 
 
+async def start_fanout_bus(app: web.Application):
+    global fanout_bus
+    fanout_bus = await create_fanout_bus()
+    await fanout_bus.start(lambda batch: apply_batch(broadcaster, batch))
+    logging.info(f"SSE-SERVER: Fan-out bus '{fanout_bus.name}' started (node {fanout_bus.node_id}).")
+
+
+async def close_fanout_bus(app: web.Application):
+    if fanout_bus is not None:
+        await fanout_bus.close()
+
+
 # --- نقطة الدخول لتشغيل الخادم ---
 if __name__ == "__main__":
     app = web.Application()
+    app.on_startup.append(start_fanout_bus)
+    app.on_cleanup.append(close_fanout_bus)
     app.router.add_get("/", health_check_handler)
     app.router.add_get("/notifications/stream", sse_handler)
     app.router.add_post("/_internal/publish", internal_publish_handler)
+    app.router.add_post("/_internal/publish_batch", internal_publish_batch_handler)
+    app.router.add_get("/_internal/stats", internal_stats_handler)
 
     port = int(os.environ.get("PORT2", 5002))
     logging.info(f"🚀 Starting standalone SSE server on port {port}...")
@@ -13,8 +13,9 @@ from dotenv import load_dotenv
 from quart import Blueprint, current_app, request, jsonify
 from database.db_queries import get_subscription, upsert_user, get_user_db_id_by_telegram_id, \
     get_active_subscription_types, get_subscription_type_details_by_id, add_subscription_for_legacy, \
-    add_pending_subscription,  record_telegram_stars_payment, record_payment
-from routes.subscriptions import process_subscription_renewal
+    add_pending_subscription,  record_telegram_stars_payment, record_payment, enqueue_renewal_job
+from routes.subscriptions import process_subscription_renewal, renewal_backoff_seconds, \
+    SUBSCRIPTION_RENEWAL_MAX_ATTEMPTS
 import asyncpg
 from aiogram.enums import ChatMemberStatus
 from functools import partial
@@ -465,62 +466,65 @@ async def handle_join_request(join_request: ChatJoinRequest):
 async def process_stars_payment_and_renew(bot: Bot, payment_details: dict):
     """
     تتولى هذه الدالة تسجيل دفعة النجوم ثم استدعاء محرك التجديد الموحد.
-    تحتوي على آلية إعادة المحاولة الخاصة بها لضمان الموثوقية.
+    لا توجد إعادة محاولة بالنوم هنا: أي فشل يُحال إلى طابور التجديد الدائم (renewal_jobs)
+    مع مفتاح منع التكرار (معرف دفعة تليجرام)، ويتولى العامل الخلفي إعادة المحاولة.
     """
     telegram_id = payment_details['telegram_id']
     payment_token = payment_details['payment_token']
-    max_retries = 3
 
-    for attempt in range(1, max_retries + 1):
-        try:
-            logging.info(
-                f"🔄 [Stars] Attempt {attempt}/{max_retries} to process payment for user={telegram_id}, token={payment_token}")
-
-            async with current_app.db_pool.acquire() as connection:
-                async with connection.transaction():
-                    payment_record = await record_payment(
-                        conn=connection,
-                        telegram_id=telegram_id,
-                        subscription_plan_id=payment_details['plan_id'],
-                        amount=Decimal(payment_details['amount']),
-                        payment_token=payment_token,
-                        status='pending',
-                        payment_method='Telegram Stars',
-                        currency='Stars',
-                        tx_hash=payment_details['payment_id'],
-                        username=payment_details['username'],
-                        full_name=payment_details['full_name']
-                    )
+    try:
+        logging.info(f"🔄 [Stars] Processing payment for user={telegram_id}, token={payment_token}")
 
-                    if not payment_record:
-                        raise Exception("Failed to record initial pending payment for Telegram Stars.")
+        async with current_app.db_pool.acquire() as connection:
+            payment_record = await record_payment(
+                conn=connection,
+                telegram_id=telegram_id,
+                subscription_plan_id=payment_details['plan_id'],
+                amount=Decimal(payment_details['amount']),
+                payment_token=payment_token,
+                status='pending',
+                payment_method='Telegram Stars',
+                currency='Stars',
+                tx_hash=payment_details['payment_id'],
+                username=payment_details['username'],
+                full_name=payment_details['full_name']
+            )
 
-                    payment_data_for_renewal = {
-                        **payment_record,
-                        "tx_hash": payment_record['tx_hash'],
-                        "amount_received": payment_record['amount_received']
-                    }
+            if not payment_record:
+                # فشل التسجيل نفسه (غالبًا خطأ مؤقت في قاعدة البيانات): نحيل الدفعة كاملة للطابور
+                job_id = await enqueue_renewal_job(
+                    connection,
+                    idempotency_key=f"tx:{payment_details['payment_id']}",
+                    payment_token=payment_token,
+                    payload={**payment_details, "pending_record": True},
+                    source="Telegram Stars",
+                    delay_seconds=renewal_backoff_seconds(1),
+                    max_attempts=SUBSCRIPTION_RENEWAL_MAX_ATTEMPTS,
+                    last_error="Failed to record initial pending payment for Telegram Stars."
+                )
+                logging.warning(f"⏳ [Stars] Payment recording failed for user={telegram_id}. Queued as job {job_id}.")
+                return
 
-                    await process_subscription_renewal(
-                        connection=connection,
-                        bot=bot,
-                        payment_data=payment_data_for_renewal
-                    )
+            payment_data_for_renewal = {
+                **payment_record,
+                "tx_hash": payment_record['tx_hash'],
+                "amount_received": payment_record['amount_received']
+            }
 
-            logging.info(f"✅ [Stars] Successfully handed over payment for user={telegram_id} to renewal system.")
-            return
+            # process_subscription_renewal تتولى الإحالة للطابور عند الفشل
+            await process_subscription_renewal(
+                connection=connection,
+                bot=bot,
+                payment_data=payment_data_for_renewal
+            )
 
-        except Exception as e:
-            logging.error(f"❌ [Stars] Error in attempt {attempt}/{max_retries} for user={telegram_id}: {e}",
-                          exc_info=True)
-            if attempt < max_retries:
-                wait_time = 2 ** attempt
-                logging.info(f"⏳ [Stars] Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
+        logging.info(f"✅ [Stars] Successfully handed over payment for user={telegram_id} to renewal system.")
+        return
 
-    # --- فشلت كل المحاولات ---
-    logging.critical(
-        f"🚨 [Stars] All attempts failed for user={telegram_id}, token={payment_token}. Manual check required.")
+    except Exception as e:
+        logging.critical(
+            f"🚨 [Stars] Failed to process or queue payment for user={telegram_id}, token={payment_token}: {e}",
+            exc_info=True)
 
     # ===> بداية التعديل: إرسال إشعار حرج للمطورين والإدارة
     await send_system_notification(
@@ -530,7 +534,7 @@ async def process_stars_payment_and_renew(bot: Bot, payment_details: dict):
         audience="all",  # هذا خطأ يتطلب انتباه الجميع
         title="فشل حرج في معالجة دفعة نجوم تليجرام",
         details={
-            "المشكلة": "فشلت جميع المحاولات لمعالجة دفعة نجوم وتجديد الاشتراك.",
+            "المشكلة": "تعذرت معالجة دفعة النجوم ولم يتم إدراجها في طابور إعادة المحاولة.",
             "معرف المستخدم": str(telegram_id),
             "اسم المستخدم": payment_details.get('username', 'N/A'),
             "رمز الدفعة (Token)": payment_token,
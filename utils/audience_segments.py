@@ -0,0 +1,439 @@
+# utils/audience_segments.py
+"""
+شرائح الجمهور للرسائل الجماعية (/messaging/target-groups و /messaging/preview-users والبث).
+
+كل شريحة محفوظة في الذاكرة كمصفوفة numpy مرتبة وبدون تكرار من telegram_id:
+  all_users، subscribed (لديه أي اشتراك)، active (اشتراك نشط لم ينتهِ)،
+  expired (لديه اشتراك واحد على الأقل expiry_date <= NOW()، حتى لو كان لديه اشتراك نشط آخر)،
+  ولكل نوع اشتراك: type_active[id] و type_expired[id].
+والشريحة no_subscription = all_users - subscribed.
+
+التحديث تدريجي:
+- trigger على users / subscriptions يرسل معرفات المستخدمين المتأثرين عبر pg_notify على AUDIENCE_CHANNEL،
+  ويُعاد حساب عضوية هؤلاء المستخدمين فقط عند القراءة التالية.
+- الاشتراكات التي تنتهي بمرور الوقت تُلتقط عند القراءة بعد أقرب expiry_date قادم.
+- بناء كامل عند أول استخدام، وعند وصول إشعار بدون معرفات (عملية كبيرة)، وكل FULL_REBUILD_SECONDS.
+  البناء يُقرأ عبر cursor على دفعات حتى لا تُحمّل كل الصفوف كسجلات asyncpg في الذاكرة مرة واحدة.
+- عند انقطاع اتصال LISTEN يُعاد الاتصال في الخلفية بتأخير متزايد، مع بناء كامل بعد النجاح.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import asyncpg
+import numpy as np
+
+from utils.user_search import user_search_condition
+
+AUDIENCE_CHANNEL = "audience_changed"
+FULL_REBUILD_SECONDS = 6 * 3600
+# يُستخدم فقط عند انقطاع اتصال LISTEN (نفس سلوك settings_cache)
+FALLBACK_TTL_SECONDS = 60
+LISTEN_RETRY_MAX_SECONDS = 60
+MEMBERSHIP_BATCH_SIZE = 10_000
+# الشرائح الأصغر من هذا الحد تُرسل كمصفوفة للمعاينة؛ الأكبر تُقرأ من users بالأحدث أولًا وتُصفّى بالعضوية
+PREVIEW_ARRAY_MAX = 5_000
+PREVIEW_BATCH_SIZE = 1_000
+
+TARGET_GROUPS = (
+    "all_users",
+    "no_subscription",
+    "active_subscribers",
+    "expired_subscribers",
+    "subscription_type_active",
+    "subscription_type_expired",
+)
+
+# شرط اختيار الاشتراك المعروض (subscription_name / expiry_date) لكل مستخدم في الشريحة
+_SUBSCRIPTION_FILTERS = {
+    "all_users": None,
+    "no_subscription": None,
+    "active_subscribers": "s.is_active = true AND s.expiry_date > NOW()",
+    "expired_subscribers": "s.expiry_date <= NOW()",
+    "subscription_type_active": "s.subscription_type_id = $2 AND s.is_active = true AND s.expiry_date > NOW()",
+    "subscription_type_expired": "s.subscription_type_id = $2 AND s.expiry_date <= NOW()",
+}
+
+_EMPTY = np.empty(0, dtype=np.int64)
+
+# صف لكل (مستخدم، نوع اشتراك)؛ المستخدم بدون اشتراكات له صف واحد has_sub = false
+_MEMBERSHIP_SQL = """
+    SELECT u.telegram_id,
+           COALESCE(s.subscription_type_id, 0) AS subscription_type_id,
+           COUNT(s.id) > 0 AS has_sub,
+           COALESCE(bool_or(s.is_active = true AND s.expiry_date > NOW()), false) AS active,
+           COALESCE(bool_or(s.expiry_date <= NOW()), false) AS expired
+    FROM users u
+    LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id
+    WHERE u.telegram_id IS NOT NULL {filter}
+    GROUP BY u.telegram_id, COALESCE(s.subscription_type_id, 0)
+"""
+
+
+@dataclass
+class SegmentIndex:
+    all_users: np.ndarray
+    subscribed: np.ndarray
+    active: np.ndarray
+    expired: np.ndarray
+    type_active: Dict[int, np.ndarray] = field(default_factory=dict)
+    type_expired: Dict[int, np.ndarray] = field(default_factory=dict)
+    checked_at: Optional[datetime] = None  # NOW() في قاعدة البيانات عند آخر تحديث
+    next_expiry: Optional[datetime] = None  # أقرب expiry_date قادم (تتغير عنده الشرائح بدون أي كتابة)
+    built_at: float = 0.0
+
+    def resolve(self, target_group: str, subscription_type_id: Optional[int] = None) -> np.ndarray:
+        """معرفات telegram للشريحة (مرتبة تصاعديًا)."""
+        if target_group == "all_users":
+            return self.all_users
+        if target_group == "no_subscription":
+            return np.setdiff1d(self.all_users, self.subscribed, assume_unique=True)
+        if target_group == "active_subscribers":
+            return self.active
+        if target_group == "expired_subscribers":
+            return self.expired
+        if target_group == "subscription_type_active" and subscription_type_id:
+            return self.type_active.get(int(subscription_type_id), _EMPTY)
+        if target_group == "subscription_type_expired" and subscription_type_id:
+            return self.type_expired.get(int(subscription_type_id), _EMPTY)
+        raise ValueError(f"Invalid target group or missing parameters: {target_group}")
+
+    def general_stats(self) -> dict:
+        return {
+            "all_users": len(self.all_users),
+            "no_subscription": len(self.all_users) - len(self.subscribed),
+            "active_subscribers": len(self.active),
+            "expired_subscribers": len(self.expired),
+        }
+
+
+def _membership_columns(rows: List[asyncpg.Record]) -> tuple:
+    count = len(rows)
+    return (
+        np.fromiter((r["telegram_id"] for r in rows), dtype=np.int64, count=count),
+        np.fromiter((r["subscription_type_id"] for r in rows), dtype=np.int64, count=count),
+        np.fromiter((r["has_sub"] for r in rows), dtype=bool, count=count),
+        np.fromiter((r["active"] for r in rows), dtype=bool, count=count),
+        np.fromiter((r["expired"] for r in rows), dtype=bool, count=count),
+    )
+
+
+async def _fetch_index(conn: asyncpg.Connection, filter_sql: str = "", *args) -> SegmentIndex:
+    """قراءة _MEMBERSHIP_SQL عبر cursor (داخل المعاملة الحالية) دفعةً دفعة إلى مصفوفات numpy."""
+    chunks = []
+    cursor = await conn.cursor(_MEMBERSHIP_SQL.format(filter=filter_sql), *args)
+    while True:
+        rows = await cursor.fetch(MEMBERSHIP_BATCH_SIZE)
+        if not rows:
+            break
+        chunks.append(_membership_columns(rows))
+    if not chunks:
+        chunks.append(_membership_columns([]))
+    return _build_index(*(np.concatenate(column) for column in zip(*chunks)))
+
+
+def _build_index(telegram_ids: np.ndarray, type_ids: np.ndarray, has_sub: np.ndarray,
+                 active: np.ndarray, expired: np.ndarray) -> SegmentIndex:
+
+    type_active, type_expired = {}, {}
+    for type_id in np.unique(type_ids[has_sub]):
+        of_type = type_ids == type_id
+        if (of_type & active).any():
+            type_active[int(type_id)] = np.unique(telegram_ids[of_type & active])
+        if (of_type & expired).any():
+            type_expired[int(type_id)] = np.unique(telegram_ids[of_type & expired])
+
+    return SegmentIndex(
+        all_users=np.unique(telegram_ids),
+        subscribed=np.unique(telegram_ids[has_sub]),
+        active=np.unique(telegram_ids[active]),
+        expired=np.unique(telegram_ids[expired]),
+        type_active=type_active,
+        type_expired=type_expired,
+    )
+
+
+def _patch(old: np.ndarray, dirty: np.ndarray, fresh: np.ndarray) -> np.ndarray:
+    return np.union1d(np.setdiff1d(old, dirty, assume_unique=True), fresh)
+
+
+def _patch_index(index: SegmentIndex, dirty: np.ndarray, fresh: SegmentIndex) -> SegmentIndex:
+    """استبدال عضوية المستخدمين dirty فقط بقيمها الجديدة (fresh مبني من صفوفهم فقط)."""
+    def patch_map(old_map: Dict[int, np.ndarray], fresh_map: Dict[int, np.ndarray]) -> Dict[int, np.ndarray]:
+        patched = {}
+        for type_id in old_map.keys() | fresh_map.keys():
+            ids = _patch(old_map.get(type_id, _EMPTY), dirty, fresh_map.get(type_id, _EMPTY))
+            if len(ids):
+                patched[type_id] = ids
+        return patched
+
+    return SegmentIndex(
+        all_users=_patch(index.all_users, dirty, fresh.all_users),
+        subscribed=_patch(index.subscribed, dirty, fresh.subscribed),
+        active=_patch(index.active, dirty, fresh.active),
+        expired=_patch(index.expired, dirty, fresh.expired),
+        type_active=patch_map(index.type_active, fresh.type_active),
+        type_expired=patch_map(index.type_expired, fresh.type_expired),
+        built_at=index.built_at,
+    )
+
+
+class AudienceSegments:
+    """
+    فهرس الشرائح في الذاكرة مع اتصال LISTEN واحد لاستقبال المستخدمين المتأثرين بأي تغيير.
+    """
+
+    def __init__(self):
+        self.db_pool: Optional[asyncpg.Pool] = None
+        self._index: Optional[SegmentIndex] = None
+        self._dirty: set = set()
+        self._needs_rebuild = True
+        self._lock = asyncio.Lock()
+        self._listen_conn: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def is_listening(self) -> bool:
+        return self._listen_conn is not None and not self._listen_conn.is_closed()
+
+    async def start(self, db_pool: asyncpg.Pool):
+        self.db_pool = db_pool
+        self._closed = False
+        if not await self._listen():
+            self._schedule_reconnect()
+
+    async def _listen(self) -> bool:
+        try:
+            self._listen_conn = await self.db_pool.acquire()
+            await self._listen_conn.add_listener(AUDIENCE_CHANNEL, self._on_notify)
+            self._listen_conn.add_termination_listener(self._on_listener_lost)
+            logging.info(f"✅ Audience segments listening on '{AUDIENCE_CHANNEL}'.")
+            return True
+        except Exception as e:
+            logging.error(f"❌ Audience segments could not LISTEN, falling back to {FALLBACK_TTL_SECONDS}s TTL: {e}")
+            await self._release_listener()
+            return False
+
+    async def close(self):
+        self._closed = True
+        if self._reconnect_task is not None and not self._reconnect_task.done():
+            self._reconnect_task.cancel()
+        await self._release_listener()
+        self.invalidate()
+
+    async def _release_listener(self):
+        if self._listen_conn is not None and self.db_pool is not None:
+            try:
+                await self._listen_conn.remove_listener(AUDIENCE_CHANNEL, self._on_notify)
+                await self.db_pool.release(self._listen_conn)
+            except Exception:
+                pass
+        self._listen_conn = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        if not payload:
+            self.invalidate()
+            return
+        try:
+            self._dirty.update(int(telegram_id) for telegram_id in payload.split(","))
+        except ValueError:
+            logging.warning(f"⚠️ Unexpected audience notification payload: {payload[:100]}")
+            self.invalidate()
+
+    def _on_listener_lost(self, connection):
+        logging.warning("⚠️ Audience segments LISTEN connection lost; rebuilding on next use and reconnecting.")
+        lost, self._listen_conn = self._listen_conn, None
+        self.invalidate()
+        self._schedule_reconnect(lost)
+
+    def _schedule_reconnect(self, lost: Optional[asyncpg.Connection] = None):
+        if self._closed or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        self._reconnect_task = asyncio.create_task(self._reconnect(lost))
+
+    async def _reconnect(self, lost: Optional[asyncpg.Connection]):
+        if lost is not None:
+            try:
+                await self.db_pool.release(lost)
+            except Exception:
+                pass
+        delay = 1
+        while not self._closed and not self.is_listening:
+            await asyncio.sleep(delay)
+            if await self._listen():
+                # أي إشعار فات أثناء الانقطاع لم يُطبق على الفهرس
+                self.invalidate()
+                return
+            delay = min(delay * 2, LISTEN_RETRY_MAX_SECONDS)
+
+    def invalidate(self):
+        """إعادة البناء الكامل عند القراءة التالية."""
+        self._needs_rebuild = True
+        self._dirty.clear()
+
+    def _is_fresh(self) -> bool:
+        index = self._index
+        if index is None or self._needs_rebuild or self._dirty:
+            return False
+        if index.next_expiry is not None and datetime.now(timezone.utc) >= index.next_expiry:
+            return False
+        age = time.monotonic() - index.built_at
+        return age < (FULL_REBUILD_SECONDS if self.is_listening else FALLBACK_TTL_SECONDS)
+
+    async def get(self, connection: Optional[asyncpg.Connection] = None) -> SegmentIndex:
+        """الفهرس الحالي، بعد تطبيق أي تغييرات معلقة."""
+        if self._is_fresh():
+            return self._index
+        async with self._lock:
+            if self._is_fresh():
+                return self._index
+            if connection is not None:
+                await self._refresh(connection)
+            else:
+                async with self.db_pool.acquire() as conn:
+                    await self._refresh(conn)
+            return self._index
+
+    async def _refresh(self, conn: asyncpg.Connection):
+        index = self._index
+        rebuild = (index is None or self._needs_rebuild
+                   or time.monotonic() - index.built_at >= (FULL_REBUILD_SECONDS if self.is_listening
+                                                            else FALLBACK_TTL_SECONDS))
+        # تبديل المجموعة قبل بدء اللقطة: أي إشعار يصل أثناء التحديث يبقى للقراءة التالية
+        dirty, self._dirty = self._dirty, set()
+        self._needs_rebuild = False
+
+        try:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                checked_at = await conn.fetchval("SELECT NOW()")
+                if rebuild:
+                    started = time.perf_counter()
+                    new_index = await _fetch_index(conn)
+                    new_index.built_at = time.monotonic()
+                    logging.info(f"🎯 Audience segments rebuilt: {len(new_index.all_users)} users "
+                                 f"in {time.perf_counter() - started:.2f}s.")
+                else:
+                    if index.next_expiry is not None and checked_at >= index.next_expiry:
+                        expired_ids = await conn.fetchval("""
+                            SELECT array_agg(DISTINCT telegram_id) FROM subscriptions
+                            WHERE expiry_date > $1 AND expiry_date <= $2 AND telegram_id IS NOT NULL
+                        """, index.checked_at, checked_at)
+                        dirty.update(expired_ids or ())
+                    new_index = index
+                    if dirty:
+                        dirty_ids = np.unique(np.fromiter(dirty, dtype=np.int64, count=len(dirty)))
+                        fresh = await _fetch_index(conn, "AND u.telegram_id = ANY($1::bigint[])", dirty_ids.tolist())
+                        new_index = _patch_index(index, dirty_ids, fresh)
+                new_index.checked_at = checked_at
+                new_index.next_expiry = await conn.fetchval(
+                    "SELECT MIN(expiry_date) FROM subscriptions WHERE expiry_date > $1", checked_at)
+        except Exception:
+            # لم يُطبق شيء: إعادة المستخدمين المتأثرين للمحاولة التالية
+            self._dirty.update(dirty)
+            self._needs_rebuild = self._needs_rebuild or rebuild
+            raise
+        self._index = new_index
+
+
+_NEWEST_FIRST = "u.created_at DESC NULLS LAST, u.id DESC"
+
+
+async def fetch_segment_users(connection, target_group: str, telegram_ids: List[int],
+                              subscription_type_id: Optional[int] = None) -> List[asyncpg.Record]:
+    """
+    بيانات المستخدمين (telegram_id, full_name, username, subscription_name, expiry_date) لمعرفات الشريحة،
+    بنفس ترتيب telegram_ids.
+    """
+    condition = _SUBSCRIPTION_FILTERS[target_group]
+    params: list = [list(telegram_ids)]
+    if condition is None:
+        subscription_sql = "NULL AS subscription_name, NULL::timestamptz AS expiry_date"
+        lateral_sql = ""
+    else:
+        if "$2" in condition:
+            params.append(int(subscription_type_id))
+        subscription_sql = "sub.subscription_name, sub.expiry_date"
+        lateral_sql = f"""
+            LEFT JOIN LATERAL (
+                SELECT st.name AS subscription_name, s.expiry_date
+                FROM subscriptions s
+                JOIN subscription_types st ON s.subscription_type_id = st.id
+                WHERE s.telegram_id = u.telegram_id AND {condition}
+                ORDER BY s.expiry_date DESC
+                LIMIT 1
+            ) sub ON TRUE
+        """
+
+    return await connection.fetch(f"""
+        SELECT u.telegram_id, u.full_name, u.username, {subscription_sql}
+        FROM unnest($1::bigint[]) WITH ORDINALITY AS ids(telegram_id, ord)
+        JOIN users u ON u.telegram_id = ids.telegram_id
+        {lateral_sql}
+        ORDER BY ids.ord
+    """, *params)
+
+
+def _is_member(members: np.ndarray, telegram_ids: np.ndarray) -> np.ndarray:
+    """عضوية telegram_ids في مصفوفة مرتبة (searchsorted بدل isin حتى لا تُرتب الشريحة مع كل دفعة)."""
+    if not len(members):
+        return np.zeros(len(telegram_ids), dtype=bool)
+    positions = np.minimum(np.searchsorted(members, telegram_ids), len(members) - 1)
+    return members[positions] == telegram_ids
+
+
+async def preview_segment_users(connection, target_group: str, members: np.ndarray,
+                                subscription_type_id: Optional[int] = None,
+                                search_term: str = "", limit: int = 10) -> tuple[List[asyncpg.Record], int]:
+    """
+    معاينة الشريحة: أحدث المستخدمين تسجيلًا (حتى limit) وعدد المطابقين للبحث.
+    لا تُرسل الشريحة كاملة إلى قاعدة البيانات: all_users تُقرأ من users مباشرة، والشرائح الكبيرة
+    تُقرأ من users بالأحدث أولًا (idx_users_created_at) عبر cursor وتُصفّى بالعضوية في الذاكرة.
+    """
+    params: list = []
+    search_sql = user_search_condition(search_term, params)
+    where_sql = "u.telegram_id IS NOT NULL" + (f" AND {search_sql}" if search_sql else "")
+
+    if target_group == "all_users" or len(members) <= PREVIEW_ARRAY_MAX:
+        if target_group != "all_users":
+            params.append(members.tolist())
+            where_sql += f" AND u.telegram_id = ANY(${len(params)}::bigint[])"
+        if search_sql:
+            total_count = await connection.fetchval(f"SELECT COUNT(*) FROM users u WHERE {where_sql}", *params)
+        else:
+            total_count = len(members)
+        params.append(limit)
+        page_ids = [r["telegram_id"] for r in await connection.fetch(f"""
+            SELECT u.telegram_id FROM users u
+            WHERE {where_sql}
+            ORDER BY {_NEWEST_FIRST}
+            LIMIT ${len(params)}
+        """, *params)]
+    else:
+        page_ids, total_count = [], 0
+        async with connection.transaction(readonly=True):
+            cursor = await connection.cursor(
+                f"SELECT u.telegram_id FROM users u WHERE {where_sql} ORDER BY {_NEWEST_FIRST}", *params)
+            while True:
+                rows = await cursor.fetch(PREVIEW_BATCH_SIZE)
+                if not rows:
+                    break
+                batch = np.fromiter((r["telegram_id"] for r in rows), dtype=np.int64, count=len(rows))
+                matched = batch[_is_member(members, batch)]
+                total_count += len(matched)
+                page_ids.extend(matched[:limit - len(page_ids)].tolist())
+                # بدون بحث العدد معروف مسبقًا، فيكفي الوصول إلى limit
+                if not search_sql and len(page_ids) >= limit:
+                    break
+        if not search_sql:
+            total_count = len(members)
+
+    users = await fetch_segment_users(connection, target_group, page_ids, subscription_type_id) if page_ids else []
+    return users, total_count
+
+
+audience_segments = AudienceSegments()
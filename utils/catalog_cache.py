@@ -0,0 +1,381 @@
+# utils/catalog_cache.py
+"""
+لقطة (snapshot) مشتركة لكتالوج الاشتراكات العام: المجموعات، الأنواع، الخطط بأسعارها بعد الخصومات،
+والبنية المتداخلة لـ /subscriptions/all.
+
+- تُبنى مرة واحدة وتُسلسل إلى JSON مرة واحدة، وتُحفظ في settings_cache تحت المفتاح "catalog".
+- تُبطل عبر pg_notify على SETTINGS_CHANNEL: triggers على subscription_groups / subscription_types /
+  subscription_plans / discounts، و notify_settings_changed عند تغيير discount_tiers.
+  كذلك تنتهي صلاحيتها تلقائيًا عند أقرب start_date / end_date لخصم نشط.
+- version مشتق من محتوى اللقطة، فيكون ETag نفسه في كل العمليات (workers) لنفس الكتالوج.
+- السعر المثبت للمستخدم (user_discounts) يُطبق فوق اللقطة المشتركة باستعلام واحد خفيف.
+"""
+
+import copy
+import hashlib
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from quart import Response, current_app, request
+
+from utils.discount_utils import calculate_discounted_price
+
+CATALOG_KEY = "catalog"
+LOCKED_PRICE_DETAILS = {"discount_name": "Your Locked-in Price", "lock_in_price": True}
+
+
+@dataclass
+class CatalogSnapshot:
+    version: str
+    groups: List[dict]
+    types: List[dict]
+    plans: List[dict]
+    # plan_id -> (السعر الأساسي، أفضل سعر مشترك بعد الخصومات)
+    plan_prices: Dict[int, Tuple[Decimal, Decimal]]
+    all_subscriptions: List[dict]
+    expires_at: Optional[float] = None  # time.monotonic() لأقرب بداية/نهاية خصم
+    _bodies: Dict[str, bytes] = field(default_factory=dict)
+
+    def body(self, variant: str, build: Callable[[], Any]) -> bytes:
+        """
+        JSON المُسلسل مسبقًا للـ variant (مثل types-3) عند بناء اللقطة.
+        المعرفات غير الموجودة في اللقطة تأتي من طلبات عامة بقيم عشوائية، فتُسلسل عند الطلب دون تخزين.
+        """
+        cached = self._bodies.get(variant)
+        if cached is not None:
+            return cached
+        return dumps_json(build())
+
+    def etag(self, variant: str, overlay: Optional[Dict[int, Decimal]] = None) -> str:
+        tag = f"{self.version}-{variant}"
+        if overlay:
+            # السعر المثبت جزء من الاستجابة، فيدخل في ETag
+            locked = ",".join(f"{plan_id}:{price}" for plan_id, price in sorted(overlay.items()))
+            tag += "-" + hashlib.sha1(locked.encode()).hexdigest()[:12]
+        return tag
+
+
+def dumps_json(value) -> bytes:
+    # نفس مُسلسل jsonify حتى تبقى صيغة التواريخ و Decimal كما هي (bytes مباشرة مع OrjsonProvider)
+    dumps_bytes = getattr(current_app.json, "dumps_bytes", None)
+    if dumps_bytes is not None:
+        return dumps_bytes(value)
+    return current_app.json.dumps(value).encode("utf-8")
+
+
+def _load_json_list(value):
+    if isinstance(value, str):
+        return json.loads(value) if value else []
+    return value if value is not None else []
+
+
+# --- الاستعلامات ---
+
+GROUPS_QUERY = """
+    SELECT id, name, description, image_url, color, icon, is_active, sort_order, created_at, updated_at
+    FROM subscription_groups
+    WHERE is_active = true
+    ORDER BY sort_order ASC, name ASC
+"""
+
+TYPES_QUERY = """
+    SELECT st.id, st.name, st.channel_id, st.description, st.image_url, st.features, st.usp,
+           st.is_active, st.is_recommended, st.terms_and_conditions, st.group_id, st.sort_order, st.created_at
+    FROM subscription_types st
+    WHERE st.is_active = true
+    ORDER BY st.sort_order ASC, st.created_at DESC
+"""
+
+PLANS_QUERY = "SELECT * FROM subscription_plans WHERE is_active = true ORDER BY price ASC"
+
+DISCOUNTS_QUERY = """
+    SELECT id, name, discount_type, discount_value, lock_in_price,
+           is_tiered, price_lock_duration_months,
+           applicable_to_subscription_plan_id, applicable_to_subscription_type_id
+    FROM discounts
+    WHERE (applicable_to_subscription_plan_id = ANY($1::int[]) OR applicable_to_subscription_type_id = ANY($2::int[]))
+      AND is_active = true AND target_audience = 'all_new'
+      AND (start_date IS NULL OR start_date <= NOW())
+      AND (end_date IS NULL OR end_date >= NOW())
+"""
+
+# أقرب لحظة يتغير فيها الخصم المطبق بدون كتابة في قاعدة البيانات
+NEXT_DISCOUNT_CHANGE_QUERY = """
+    SELECT MIN(boundary) FROM (
+        SELECT start_date AS boundary FROM discounts WHERE is_active = true AND start_date > NOW()
+        UNION ALL
+        SELECT end_date FROM discounts WHERE is_active = true AND end_date >= NOW()
+    ) AS boundaries
+"""
+
+ALL_SUBSCRIPTIONS_QUERY = """
+    WITH plans_with_discounts AS (
+        -- الخطوة 1: حساب الأسعار النهائية لجميع الخطط مع مراعاة الخصومات العامة
+        SELECT
+            p.id, p.subscription_type_id, p.name, p.duration_days, p.price, p.is_active,
+            CASE WHEN d.id IS NOT NULL THEN p.price ELSE NULL END AS original_price,
+            COALESCE(
+                CASE
+                    WHEN d.discount_type = 'percentage' THEN p.price * (1 - (d.discount_value / 100))
+                    WHEN d.discount_type = 'fixed_amount' THEN p.price - d.discount_value
+                END,
+                p.price
+            ) AS final_price
+        FROM subscription_plans p
+        LEFT JOIN LATERAL (
+            SELECT * FROM discounts
+            WHERE
+                (discounts.applicable_to_subscription_plan_id = p.id OR discounts.applicable_to_subscription_type_id = p.subscription_type_id)
+                AND discounts.is_active = TRUE AND discounts.target_audience = 'all_new'
+                AND (discounts.start_date IS NULL OR discounts.start_date <= NOW())
+                AND (discounts.end_date IS NULL OR discounts.end_date >= NOW())
+            ORDER BY
+                CASE WHEN discounts.applicable_to_subscription_plan_id IS NOT NULL THEN 0 ELSE 1 END,
+                discounts.created_at DESC
+            LIMIT 1
+        ) d ON TRUE
+        WHERE p.is_active = TRUE
+    )
+    -- الخطوة 2: تجميع الخطط داخل الأنواع، والأنواع داخل المجموعات
+    SELECT
+        g.id, g.name, g.description, g.image_url, g.color, g.icon, g.sort_order,
+        COALESCE(json_agg(
+            json_build_object(
+                'id', st.id,
+                'name', st.name,
+                'channel_id', st.channel_id,
+                'description', st.description,
+                'image_url', st.image_url,
+                'features', COALESCE(st.features, '[]'::jsonb),
+                'usp', st.usp,
+                'is_recommended', st.is_recommended,
+                'terms_and_conditions', COALESCE(st.terms_and_conditions, '[]'::jsonb),
+                'sort_order', st.sort_order,
+                'subscription_plans', st.plans
+            ) ORDER BY st.sort_order ASC, st.created_at DESC
+        ) FILTER (WHERE st.id IS NOT NULL), '[]'::json) AS subscription_types
+    FROM subscription_groups g
+    LEFT JOIN (
+        SELECT
+            st_inner.id, st_inner.group_id, st_inner.name, st_inner.channel_id, st_inner.description,
+            st_inner.image_url, st_inner.features, st_inner.usp, st_inner.is_recommended,
+            st_inner.terms_and_conditions, st_inner.sort_order, st_inner.created_at,
+            COALESCE(json_agg(
+                json_build_object(
+                    'id', p.id,
+                    'name', p.name,
+                    'duration_days', p.duration_days,
+                    'price', TO_CHAR(p.final_price, 'FM999999999.00'),
+                    'original_price', CASE WHEN p.original_price IS NOT NULL THEN TO_CHAR(p.original_price, 'FM999999999.00') ELSE NULL END
+                ) ORDER BY p.final_price ASC
+            ) FILTER (WHERE p.id IS NOT NULL), '[]'::json) AS plans
+        FROM subscription_types st_inner
+        LEFT JOIN plans_with_discounts p ON p.subscription_type_id = st_inner.id
+        WHERE st_inner.is_active = TRUE
+        GROUP BY st_inner.id
+    ) st ON st.group_id = g.id
+    WHERE g.is_active = TRUE
+    GROUP BY g.id
+    ORDER BY g.sort_order ASC, g.name ASC
+"""
+
+
+# --- بناء الخطط (نفس منطق /subscription-plans بدون السعر المثبت) ---
+
+def _tiered_price_option(offer, tiers_for_offer, base_price: Decimal) -> Optional[dict]:
+    active_tier = next((t for t in tiers_for_offer if t['is_active'] and t['used_slots'] < t['max_slots']), None)
+    if not active_tier:
+        return None
+
+    discounted_price = calculate_discounted_price(base_price, "percentage", active_tier['discount_value'])
+    next_tier = next((t for t in tiers_for_offer if t['tier_order'] > active_tier['tier_order']), None)
+
+    # ⭐ منطق عرض المقاعد (الحقيقي أو الوهمي)
+    real_remaining = active_tier['max_slots'] - active_tier['used_slots']
+    display_slots = real_remaining
+    if active_tier.get('display_fake_count') and active_tier.get('fake_count_value') is not None:
+        display_slots = min(real_remaining, active_tier['fake_count_value'])
+
+    tier_info = {
+        "is_tiered": True,
+        "remaining_slots": max(0, display_slots),
+        "has_limited_slots": True,
+        "next_tier_info": None
+    }
+    if next_tier:
+        next_price = calculate_discounted_price(base_price, "percentage", next_tier['discount_value'])
+        tier_info['next_tier_info'] = {
+            "message": f"بعد انتهاء هذه المقاعد سيزيد السعر ليصبح ${next_price:.2f}"
+        }
+
+    discount_details = {
+        "discount_id": offer['id'],
+        "discount_name": offer['name'],
+        "lock_in_price": offer['lock_in_price'],
+        "price_lock_duration_months": offer['price_lock_duration_months'],
+        **tier_info
+    }
+    return {'price': discounted_price, 'original_price': base_price, 'discount_details': discount_details}
+
+
+async def _load_plans(conn):
+    base_plans = await conn.fetch(PLANS_QUERY)
+    if not base_plans:
+        return [], {}
+
+    plan_ids = [p['id'] for p in base_plans]
+    type_ids = list(set(p['subscription_type_id'] for p in base_plans))
+    all_discounts = await conn.fetch(DISCOUNTS_QUERY, plan_ids, type_ids)
+
+    tiered_discount_ids = [d['id'] for d in all_discounts if d['is_tiered']]
+    all_tiers: Dict[int, List[dict]] = {}
+    if tiered_discount_ids:
+        tier_records = await conn.fetch(
+            "SELECT * FROM discount_tiers WHERE discount_id = ANY($1::int[]) ORDER BY discount_id, tier_order ASC",
+            tiered_discount_ids)
+        for tier in tier_records:
+            all_tiers.setdefault(tier['discount_id'], []).append(dict(tier))
+
+    processed_plans = []
+    plan_prices = {}
+    for plan in base_plans:
+        base_price = Decimal(plan['price'])
+        possible_prices = [{'price': base_price, 'original_price': None, 'discount_details': {}}]
+
+        for offer in all_discounts:
+            if not (offer['applicable_to_subscription_plan_id'] == plan['id'] or
+                    offer['applicable_to_subscription_type_id'] == plan['subscription_type_id']):
+                continue
+            if offer['is_tiered']:
+                option = _tiered_price_option(offer, all_tiers.get(offer['id'], []), base_price)
+                if option:
+                    possible_prices.append(option)
+            else:
+                discounted_price = calculate_discounted_price(base_price, offer['discount_type'],
+                                                              offer['discount_value'])
+                if discounted_price < base_price:
+                    possible_prices.append({'price': discounted_price, 'original_price': base_price,
+                                            'discount_details': {
+                                                "discount_id": offer['id'],
+                                                "discount_name": offer['name'],
+                                                "lock_in_price": offer['lock_in_price'],
+                                                "is_tiered": False
+                                            }})
+
+        best_price_option = min(possible_prices, key=lambda x: x['price'])
+        final_plan_data = dict(plan)
+        final_plan_data['price'] = f"{best_price_option['price']:.2f}"
+        final_plan_data['original_price'] = f"{best_price_option['original_price']:.2f}" \
+            if best_price_option['original_price'] else None
+        final_plan_data['discount_details'] = best_price_option['discount_details']
+        processed_plans.append(final_plan_data)
+        plan_prices[plan['id']] = (base_price, best_price_option['price'])
+
+    return processed_plans, plan_prices
+
+
+async def load_catalog_snapshot(conn) -> CatalogSnapshot:
+    """loader لـ settings_cache: بناء اللقطة كاملة في معاملة واحدة (قراءة متسقة)."""
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        groups = [dict(row) for row in await conn.fetch(GROUPS_QUERY)]
+
+        types = []
+        for row in await conn.fetch(TYPES_QUERY):
+            row_dict = dict(row)
+            row_dict["features"] = _load_json_list(row_dict.get("features"))
+            row_dict["terms_and_conditions"] = _load_json_list(row_dict.get("terms_and_conditions"))
+            types.append(row_dict)
+
+        plans, plan_prices = await _load_plans(conn)
+
+        all_subscriptions = [
+            {**row, "subscription_types": json.loads(row["subscription_types"])}
+            for row in await conn.fetch(ALL_SUBSCRIPTIONS_QUERY)
+        ]
+        next_change = await conn.fetchval(NEXT_DISCOUNT_CHANGE_QUERY)
+
+    bodies = {
+        "groups": dumps_json(groups),
+        "types": dumps_json(types),
+        "plans": dumps_json(plans),
+        "all": dumps_json(all_subscriptions),
+    }
+    version = hashlib.sha256(b"\n".join(bodies[k] for k in sorted(bodies))).hexdigest()[:16]
+
+    # variants الفلترة لكل مجموعة / نوع موجود في اللقطة (?group_id= و ?subscription_type_id=)
+    for group_id in {g["id"] for g in groups} | {t["group_id"] for t in types if t["group_id"] is not None}:
+        bodies[f"types-{group_id}"] = dumps_json([t for t in types if t["group_id"] == group_id])
+    for type_id in {t["id"] for t in types} | {p["subscription_type_id"] for p in plans}:
+        bodies[f"plans-{type_id}"] = dumps_json([p for p in plans if p["subscription_type_id"] == type_id])
+
+    expires_at = None
+    if next_change is not None:
+        delay = (next_change - datetime.now(timezone.utc)).total_seconds()
+        expires_at = time.monotonic() + max(delay, 0)
+
+    return CatalogSnapshot(version=version, groups=groups, types=types, plans=plans, plan_prices=plan_prices,
+                           all_subscriptions=all_subscriptions, expires_at=expires_at, _bodies=bodies)
+
+
+# --- السعر المثبت للمستخدم ---
+
+async def fetch_locked_prices(conn, telegram_id: int, plan_ids: List[int]) -> Dict[int, Decimal]:
+    if not telegram_id or not plan_ids:
+        return {}
+    rows = await conn.fetch("""
+        SELECT ud.subscription_plan_id, ud.locked_price FROM user_discounts ud
+        JOIN users u ON u.id = ud.user_id
+        WHERE u.telegram_id = $1 AND ud.is_active = true AND ud.subscription_plan_id = ANY($2::int[])
+          AND (ud.expires_at IS NULL OR ud.expires_at > NOW())
+    """, telegram_id, plan_ids)
+    return {r['subscription_plan_id']: Decimal(r['locked_price']) for r in rows if r['locked_price'] is not None}
+
+
+def overlay_plans(snapshot: CatalogSnapshot, plans: List[dict], locked_prices: Dict[int, Decimal]) -> List[dict]:
+    """/subscription-plans: السعر المثبت يفوز إذا كان أقل من السعر الأساسي ولا يزيد عن أفضل خصم."""
+    result = []
+    for plan in plans:
+        locked = locked_prices.get(plan['id'])
+        base_price, best_price = snapshot.plan_prices[plan['id']]
+        if locked is not None and locked < base_price and locked <= best_price:
+            plan = {**plan, 'price': f"{locked:.2f}", 'original_price': f"{base_price:.2f}",
+                    'discount_details': dict(LOCKED_PRICE_DETAILS)}
+        result.append(plan)
+    return result
+
+
+def overlay_all_subscriptions(snapshot: CatalogSnapshot, locked_prices: Dict[int, Decimal]) -> List[dict]:
+    """/subscriptions/all: السعر المثبت يحل محل الخصم العام، ثم يعاد ترتيب خطط النوع حسب السعر."""
+    structure = copy.deepcopy(snapshot.all_subscriptions)
+    for group in structure:
+        for sub_type in group["subscription_types"]:
+            plans = sub_type.get("subscription_plans") or []
+            for plan in plans:
+                locked = locked_prices.get(plan["id"])
+                if locked is not None:
+                    plan["price"] = f"{locked:.2f}"
+                    plan["original_price"] = f"{snapshot.plan_prices[plan['id']][0]:.2f}"
+            plans.sort(key=lambda p: Decimal(p["price"]))
+    return structure
+
+
+# --- الاستجابة ---
+
+def catalog_response(etag: str, body: Callable[[], bytes], cache_control: str) -> Response:
+    """
+    استجابة JSON مع ETag، أو 304 بدون جسم إذا طابق If-None-Match.
+    الـ ETag ضعيف (W/) لأن الجسم نفسه قد يُرسل مضغوطًا أو غير مضغوط (utils/compression.py)
+    حسب Accept-Encoding، ولهذا أيضًا Vary: Accept-Encoding حتى على 304.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(b"", status=304)
+    else:
+        response = Response(body(), status=200, content_type="application/json; charset=utf-8")
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,92 @@
+# utils/compression.py
+"""
+ضغط الاستجابات (brotli أو gzip حسب Accept-Encoding) للاستجابات النصية الأكبر من حد معين.
+
+- brotli اختياري: إذا لم يكن مثبتًا يُستخدم gzip فقط.
+- الاستجابات المبثوثة (تصدير CSV/XLSX، NDJSON، SSE) والملفات لا تُضغط هنا، فقط الاستجابات
+  التي جسمها في الذاكرة (jsonify ومثيلاتها).
+- الضغط للأجسام الكبيرة يتم في thread حتى لا يتوقف event loop.
+"""
+
+import asyncio
+import gzip
+import logging
+import os
+from typing import Optional
+
+from quart import request
+from quart.wrappers.response import DataBody
+
+try:
+    import brotli
+except ImportError:  # brotli اختياري
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_THREAD_SIZE = 256 * 1024  # فوق هذا الحجم يتم الضغط خارج event loop
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # توازن بين الحجم وزمن المعالج للاستجابات الديناميكية
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+
+
+def _is_compressible(mimetype: str) -> bool:
+    return bool(mimetype) and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def choose_encoding(accept_encodings) -> Optional[str]:
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def register_compression(app, min_size: int = COMPRESSION_MIN_SIZE):
+    """تسجيل after_request يضغط الاستجابات المؤهلة."""
+
+    @app.after_request
+    async def compress_response(response):
+        if (
+            request.method == "HEAD"
+            or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or not isinstance(response.response, DataBody)
+            or not _is_compressible(response.mimetype)
+        ):
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        data = response.response.data
+        if encoding is None or len(data) < min_size:
+            return response
+
+        try:
+            if len(data) >= COMPRESSION_THREAD_SIZE:
+                compressed = await asyncio.to_thread(compress_body, data, encoding)
+            else:
+                compressed = compress_body(data, encoding)
+        except Exception as e:
+            logging.error(f"❌ Response compression ({encoding}) failed: {e}", exc_info=True)
+            return response
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    logging.info(f"✅ Response compression enabled (min_size={min_size}, "
+                 f"encodings={'br, gzip' if brotli is not None else 'gzip'}).")
+    return compress_response
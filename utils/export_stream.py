@@ -0,0 +1,251 @@
+# utils/export_stream.py
+"""
+تصدير البيانات (CSV / XLSX) بالبث بدل تحميل كل الصفوف في الذاكرة.
+
+الصفوف تُسحب من قاعدة البيانات عبر asyncpg cursor على دفعات (يتطلب transaction)،
+وتُحوّل كل قيمة إلى خلية مباشرة بدون pandas:
+  - CSV: كل دفعة تُكتب وتُرسل للعميل فورًا (مع BOM ليفتحها Excel بالعربية بشكل صحيح).
+  - XLSX: xlsxwriter في وضع constant_memory يكتب الصفوف إلى ملف مؤقت على القرص،
+    ثم يُرسل الملف على أجزاء. الذاكرة ثابتة تقريبًا مهما كان عدد الصفوف.
+"""
+
+import asyncio
+import csv
+import io
+import logging
+import os
+import tempfile
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import AsyncIterator, Dict, List, Optional
+
+from quart import Response
+
+EXPORT_CHUNK_SIZE = 2000
+FILE_READ_CHUNK_SIZE = 64 * 1024
+MAX_COLUMN_WIDTH = 60
+
+EXPORT_MIMETYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def parse_export_format(data: dict):
+    """
+    قراءة format (xlsx افتراضيًا أو csv) و stream من جسم الطلب. ترجع (export_format, stream).
+    CSV يُبث دائمًا، و XLSX يُبث فقط مع stream=true (وإلا يبقى المسار القديم عبر pandas).
+    """
+    export_format = str(data.get("format", "xlsx")).strip().lower()
+    if export_format not in EXPORT_MIMETYPES:
+        raise ValueError("Invalid export format. Use 'xlsx' or 'csv'.")
+    return export_format, export_format == "csv" or bool(data.get("stream"))
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Excel لا يدعم المناطق الزمنية: نحول إلى UTC ثم نحذف tzinfo (كما كان يفعل tz_localize(None))
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def csv_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return _naive_utc(value).strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def xlsx_cell(value):
+    """القيمة كما تُكتب في xlsxwriter: أرقام ومنطقيات وتواريخ كما هي، والباقي نص."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, datetime):
+        return _naive_utc(value)
+    if isinstance(value, date):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+async def iter_record_chunks(pool, query: str, params: list,
+                             chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[list]:
+    """سحب نتائج الاستعلام عبر cursor على دفعات من chunk_size صف."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            chunk = []
+            async for record in conn.cursor(query, *params, prefetch=chunk_size):
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+
+async def csv_byte_chunks(chunks: AsyncIterator[list], headers: Dict[str, str]) -> AsyncIterator[bytes]:
+    """
+    تحويل دفعات الصفوف إلى أجزاء CSV. headers: {alias العمود في الاستعلام: عنوان العمود في الملف}.
+    إذا فشل الاستعلام بعد بدء الإرسال يُعاد رفع الخطأ عمدًا: الخادم يقطع الاتصال بدون الجزء الأخير
+    (chunked)، فيرى العميل تنزيلًا غير مكتمل بدل ملف CSV يبدو سليمًا وهو مقطوع.
+    """
+    columns = list(headers)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers.values())
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    rows_sent = 0
+    try:
+        async for chunk in chunks:
+            buffer.seek(0)
+            buffer.truncate()
+            for record in chunk:
+                writer.writerow([csv_cell(record[col]) for col in columns])
+            yield buffer.getvalue().encode("utf-8")
+            rows_sent += len(chunk)
+    except Exception as e:
+        logging.error(f"❌ CSV export stream failed after {rows_sent} rows; aborting the response: {e}",
+                      exc_info=True)
+        raise
+
+
+async def write_csv_file(path: str, chunks: AsyncIterator[list], headers: Dict[str, str], on_chunk=None) -> int:
+    """كتابة دفعات الصفوف إلى ملف CSV. ترجع عدد الصفوف، و on_chunk(rows_written) اختياري لتقارير التقدم."""
+    rows_written = 0
+
+    async def counted_chunks():
+        nonlocal rows_written
+        async for chunk in chunks:
+            yield chunk
+            rows_written += len(chunk)
+            if on_chunk:
+                await on_chunk(rows_written)
+
+    with open(path, "wb") as f:
+        async for data in csv_byte_chunks(counted_chunks(), headers):
+            await asyncio.to_thread(f.write, data)
+    return rows_written
+
+
+async def write_xlsx_file(path: str, chunks: AsyncIterator[list], headers: Dict[str, str],
+                          sheet_name: str, on_chunk=None) -> int:
+    """
+    كتابة دفعات الصفوف إلى ملف XLSX بذاكرة ثابتة. ترجع عدد الصفوف المكتوبة.
+    on_chunk(rows_written) اختياري لتقارير التقدم.
+    """
+    import xlsxwriter
+
+    columns = list(headers)
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "tmpdir": os.path.dirname(path) or None})
+    try:
+        worksheet = workbook.add_worksheet(sheet_name)
+        header_format = workbook.add_format({
+            'bold': True, 'text_wrap': True, 'valign': 'top',
+            'fg_color': '#D7E4BC', 'border': 1, 'align': 'center'
+        })
+        datetime_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+
+        widths = [len(str(title)) for title in headers.values()]
+        for col_num, title in enumerate(headers.values()):
+            worksheet.write(0, col_num, title, header_format)
+
+        row_num = 0
+        async for chunk in chunks:
+            # كتابة الخلايا عمل CPU متزامن (وإلى ملف مؤقت على القرص)، فتُنفذ خارج event loop
+            row_num = await asyncio.to_thread(
+                _write_xlsx_rows, worksheet, chunk, columns, widths, row_num, datetime_format, date_format)
+            if on_chunk:
+                await on_chunk(row_num)
+
+        # عرض الأعمدة يُحفظ ويُكتب عند إغلاق الملف، لذا يمكن تحديده بعد كتابة الصفوف
+        for col_num, width in enumerate(widths):
+            worksheet.set_column(col_num, col_num, min((width + 2) * 1.2, MAX_COLUMN_WIDTH))
+    finally:
+        await asyncio.to_thread(workbook.close)
+    return row_num
+
+
+def _write_xlsx_rows(worksheet, chunk: list, columns: List[str], widths: List[int], row_num: int,
+                     datetime_format, date_format) -> int:
+    """كتابة دفعة صفوف بعد الصف row_num وتحديث widths. ترجع رقم آخر صف مكتوب."""
+    for record in chunk:
+        row_num += 1
+        for col_num, col in enumerate(columns):
+            value = xlsx_cell(record[col])
+            if isinstance(value, datetime):
+                worksheet.write_datetime(row_num, col_num, value, datetime_format)
+                width = 19
+            elif isinstance(value, date):
+                worksheet.write_datetime(row_num, col_num, value, date_format)
+                width = 10
+            else:
+                worksheet.write(row_num, col_num, value)
+                width = len(str(value)) if value is not None else 0
+            if width > widths[col_num]:
+                widths[col_num] = width
+    return row_num
+
+
+async def _xlsx_byte_chunks(chunks: AsyncIterator[list], headers: Dict[str, str],
+                            sheet_name: str) -> AsyncIterator[bytes]:
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".xlsx")
+    os.close(fd)
+    try:
+        await write_xlsx_file(path, chunks, headers, sheet_name)
+        with open(path, "rb") as f:
+            while True:
+                data = await asyncio.to_thread(f.read, FILE_READ_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+    finally:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"⚠️ Could not remove temporary export file {path}: {e}")
+
+
+async def ndjson_byte_chunks(chunks: AsyncIterator[list], dumps) -> AsyncIterator[bytes]:
+    """
+    صف JSON واحد في كل سطر (NDJSON). dumps هو مُسلسل JSON للتطبيق (current_app.json.dumps)
+    لتبقى صيغة القيم (التواريخ، Decimal...) مطابقة لـ jsonify.
+    إذا فشل الاستعلام بعد بدء الإرسال يُضاف سطر {"error": ...} أخير بدل قطع الاستجابة بصمت.
+    """
+    try:
+        async for chunk in chunks:
+            yield "".join(dumps(dict(record)) + "\n" for record in chunk).encode("utf-8")
+    except Exception as e:
+        logging.error(f"❌ NDJSON export stream failed: {e}", exc_info=True)
+        yield (dumps({"error": "Export stream failed"}) + "\n").encode("utf-8")
+
+
+def streaming_ndjson_response(pool, query: str, params: List, dumps) -> Response:
+    """استجابة مجزأة تبث نتيجة الاستعلام كـ application/x-ndjson بذاكرة ثابتة."""
+    response = Response(ndjson_byte_chunks(iter_record_chunks(pool, query, params), dumps),
+                        mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
+
+def streaming_export_response(pool, query: str, params: List, headers: Dict[str, str],
+                              export_format: str, filename_prefix: str,
+                              sheet_name: Optional[str] = None) -> Response:
+    """استجابة مجزأة (chunked) تبث نتيجة الاستعلام كملف CSV أو XLSX."""
+    chunks = iter_record_chunks(pool, query, params)
+    if export_format == "csv":
+        body = csv_byte_chunks(chunks, headers)
+    else:
+        body = _xlsx_byte_chunks(chunks, headers, sheet_name or "Data")
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    response = Response(body, mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename_prefix}_{timestamp}.{export_format}"'
+    # التصدير الكبير قد يتجاوز مهلة الاستجابة الافتراضية في Quart
+    response.timeout = None
+    return response
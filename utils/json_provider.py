@@ -0,0 +1,104 @@
+# utils/json_provider.py
+"""
+مزود JSON سريع للتطبيق مبني على orjson، مع الرجوع التلقائي لمزود Quart الافتراضي.
+
+- نفس صيغة المخرجات التي يعتمد عليها الفرونت: datetime / date بصيغة HTTP date (كما في jsonify)،
+  Decimal و UUID كنص، وسجلات asyncpg (Record) كقاموس.
+- النصوص العربية تُكتب UTF-8 مباشرة بدل \\uXXXX (أصغر وأسرع، وهي JSON مكافئ).
+- أي قيمة لا يدعمها orjson (مثل عدد صحيح أكبر من 64 بت) يُعاد تسلسلها بالمزود الافتراضي.
+
+الاختيار عبر متغير البيئة JSON_PROVIDER: "orjson" (الافتراضي إذا كان مثبتًا) أو "std".
+"""
+
+import logging
+import os
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from asyncpg import Record
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson اختياري
+    orjson = None
+
+
+_WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def _http_date(value: date) -> str:
+    """نفس مخرجات werkzeug.http.http_date (المستخدمة في jsonify) لكن بدون email.utils (أسرع بكثير)."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return (f"{_WEEKDAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} "
+                f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+    return f"{_WEEKDAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} {value.year:04d} 00:00:00 GMT"
+
+
+def _json_default(value):
+    if isinstance(value, date):  # datetime فرع من date
+        return _http_date(value)
+    if isinstance(value, (Decimal, UUID)):
+        return str(value)
+    if isinstance(value, Record):
+        return dict(value)
+    if isinstance(value, time):
+        return value.isoformat()
+    if hasattr(value, "__html__"):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """DefaultJSONProvider بنفس الواجهة، لكن dumps / loads / response عبر orjson."""
+
+    # يُستخدم أيضًا في مسار الرجوع إلى json حتى تبقى الأنواع المدعومة نفسها
+    default = staticmethod(_json_default)
+
+    def _options(self) -> int:
+        # التواريخ تمر عبر default حتى تبقى بصيغة HTTP date مثل المزود الافتراضي
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps_bytes(self, obj) -> bytes:
+        try:
+            return orjson.dumps(obj, default=_json_default, option=self._options())
+        except TypeError as e:
+            # orjson.JSONEncodeError فرع من TypeError (أعداد كبيرة، مفاتيح غير قابلة للترتيب...)
+            logging.debug(f"orjson could not serialize payload, falling back to json: {e}")
+            return super().dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            # خيارات json.dumps (indent, separators...) لا يدعمها orjson
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(obj)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
+def configure_json_provider(app):
+    """تفعيل مزود JSON حسب JSON_PROVIDER. يُستدعى مرة واحدة بعد إنشاء التطبيق."""
+    choice = os.getenv("JSON_PROVIDER", "orjson").strip().lower()
+    if choice == "orjson" and orjson is not None:
+        app.json = OrjsonProvider(app)
+        logging.info("✅ JSON provider: orjson")
+    else:
+        if choice == "orjson":
+            logging.warning("⚠️ orjson is not installed; using the default JSON provider.")
+        logging.info("JSON provider: default (json)")
@@ -4,7 +4,7 @@ import json
 import logging
 from datetime import datetime, timezone
 from quart import current_app
-from database.db_queries import get_unread_notifications_count
+from database.db_queries import get_unread_notifications_counts
 
 
 async def create_notification(
@@ -24,7 +24,7 @@ async def create_notification(
     :param title: عنوان الإشعار.
     :param message: نص الرسالة.
     :param extra_data: بيانات إضافية (JSON).
-    :param is_public: إذا كان الإشعار عامًا.
+    :param is_public: إذا كان الإشعار عامًا (يُخزن كصف واحد ويُدمج عند القراءة، بدون نسخة لكل مستخدم).
     :param telegram_ids: قائمة بمعرفات تليجرام المستهدفة.
     :return: معرف الإشعار المُنشأ.
     """
@@ -55,36 +55,38 @@ async def create_notification(
         "read_status": False
     }
 
-    target_user_ids = []
-    if not is_public:
-        if not telegram_ids:
-            raise ValueError("telegram_ids is required for private notifications")
-        target_user_ids = [telegram_ids] if not isinstance(telegram_ids, list) else telegram_ids
-        
-        insert_query = "INSERT INTO user_notifications (telegram_id, notification_id) VALUES ($1, $2)"
-        for tg_id in target_user_ids:
-            await connection.execute(insert_query, tg_id, notification_id)
-    else:
-        # للإشعارات العامة، أدرجها لجميع المستخدمين
-        insert_query = "INSERT INTO user_notifications (telegram_id, notification_id) SELECT telegram_id, $1 FROM users"
-        await connection.execute(insert_query, notification_id)
-        
-        # واحصل على قائمة بجميع المستخدمين لإرسال الإشعار لهم
-        users = await connection.fetch("SELECT telegram_id FROM users")
-        target_user_ids = [user['telegram_id'] for user in users]
-
-    # ✨ التغيير هنا: البث باستخدام SSE
     broadcaster = current_app.sse_client
-    for tg_id in target_user_ids:
+    if is_public:
+        # الإشعار العام لا يُنسخ لكل مستخدم: /notifications يدمجه عند القراءة مع
+        # العلامة المائية لكل مستخدم، والبث يصل فقط للعملاء المتصلين حاليًا.
+        # العدّاد يتحدث عند العميل من new_notification (is_public) أو عبر /notifications/unread-count.
+        notification_obj["is_public"] = True
         try:
-            # 1. بث الإشعار الجديد نفسه
-            await broadcaster.publish(tg_id, 'new_notification', notification_obj)
-            
-            # 2. جلب العدد المحدث وبثه
-            unread_count = await get_unread_notifications_count(connection, tg_id)
+            await broadcaster.publish_all('new_notification', notification_obj)
+        except Exception as e:
+            logging.error(f"Error publishing SSE events for public notification {notification_id}: {e}")
+        return notification_id
+
+    if not telegram_ids:
+        raise ValueError("telegram_ids is required for private notifications")
+    target_user_ids = [telegram_ids] if not isinstance(telegram_ids, list) else telegram_ids
+
+    # إدراج واحد لكل المستهدفين حتى يُحدّث trigger العدادات مرة واحدة لكل عبارة
+    await connection.execute(
+        "INSERT INTO user_notifications (telegram_id, notification_id) SELECT unnest($1::bigint[]), $2",
+        [int(tg_id) for tg_id in target_user_ids], notification_id
+    )
+
+    # ✨ البث باستخدام SSE: حمولة الإشعار تُرسل مرة واحدة لكل المستهدفين،
+    # والعدادات تُجلب باستعلام واحد ثم تُجمّع في طلب نشر جماعي عبر SseApiClient
+    try:
+        await broadcaster.publish_many(target_user_ids, 'new_notification', notification_obj)
+
+        unread_counts = await get_unread_notifications_counts(connection, target_user_ids)
+        for tg_id, unread_count in unread_counts.items():
             await broadcaster.publish(tg_id, 'unread_update', {"count": unread_count})
 
-        except Exception as e:
-            logging.error(f"Error publishing SSE event to {tg_id}: {e}")
+    except Exception as e:
+        logging.error(f"Error publishing SSE events for notification {notification_id}: {e}")
 
     return notification_id
\ No newline at end of file
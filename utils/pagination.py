@@ -0,0 +1,144 @@
+# utils/pagination.py
+"""
+ترقيم الصفحات بنمط keyset (after=<cursor>) لنقاط النهاية الإدارية.
+
+بدلاً من OFFSET الذي يزداد بطؤه مع عمق الصفحة، يحمل المؤشر قيمة عمود الترتيب
+ومعرف آخر صف في الصفحة السابقة، وتبدأ الصفحة التالية بعده مباشرة عبر الفهرس.
+يُستخدم فقط لأعمدة جداول أساسية مفهرسة؛ الترتيب بقيم محسوبة (مثل days_remaining) يبقى على OFFSET.
+المؤشر نص opaque (base64) لا يعتمد عليه العميل إلا بإعادته كما هو.
+"""
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional
+
+CURSOR_SORT_ALIAS = "_cursor_sort"
+CURSOR_ID_ALIAS = "_cursor_id"
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"t": "dt", "v": value.isoformat()}
+    if isinstance(value, date):
+        return {"t": "d", "v": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"t": "dec", "v": str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        kind, raw = value.get("t"), value.get("v")
+        if kind == "dt":
+            return datetime.fromisoformat(raw)
+        if kind == "d":
+            return date.fromisoformat(raw)
+        if kind == "dec":
+            return Decimal(raw)
+        raise ValueError("Unknown cursor value type")
+    return value
+
+
+def encode_cursor(sort_value, row_id, sort_key: str) -> str:
+    payload = json.dumps([sort_key, _encode_value(sort_value), _encode_value(row_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str, sort_key: str):
+    """إرجاع (sort_value, row_id). يرفع ValueError إذا كان المؤشر تالفًا أو صادرًا لترتيب مختلف."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        cursor_sort_key, sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Invalid pagination cursor")
+    if cursor_sort_key != sort_key:
+        raise ValueError("Pagination cursor does not match the requested sort order")
+    return _decode_value(sort_value), _decode_value(row_id)
+
+
+class KeysetPage:
+    """
+    يبني أجزاء SQL لوضع المؤشر: أعمدة المؤشر في SELECT، وشرط WHERE، وجملة ORDER BY،
+    ثم يستخرج المؤشر التالي من الصفوف المرجعة.
+
+    sort_expr / id_expr: أعمدة جدول أساسي عليها فهرس (sort_expr, id_expr)؛ id_expr لكسر التعادل،
+    أو None إذا كان عمود الترتيب نفسه فريدًا (مثل u.id).
+    sort_type / id_type: نوع Postgres لتحويل معاملات المؤشر بشكل صريح.
+    nullable: عمود الترتيب يقبل NULL. الصفوف ذات القيم تُعرض أولًا بشرط مقارنة صفوف بسيط
+    (نطاق فهرس)، ثم صفوف NULL كمرحلة منفصلة مرتبة بالمعرف. الصفحة الأخيرة من المرحلة الأولى
+    قد تكون أقصر من page_size مع مؤشر تالٍ يبدأ مرحلة NULL.
+    """
+
+    def __init__(self, after: Optional[str], sort_key: str, sort_expr: str, sort_type: str,
+                 id_expr: Optional[str] = None, id_type: str = "integer", sort_order: str = "desc",
+                 nullable: bool = False):
+        self.sort_key = f"{sort_key}:{sort_order}"
+        self.sort_expr = sort_expr
+        self.sort_type = sort_type
+        self.id_expr = id_expr
+        self.id_type = id_type
+        self.nullable = nullable and id_expr is not None
+        self.descending = sort_order.lower() != "asc"
+        self.after = decode_cursor(after, self.sort_key) if after else None
+
+    @property
+    def is_first_page(self) -> bool:
+        return self.after is None
+
+    @property
+    def in_null_phase(self) -> bool:
+        return self.nullable and self.after is not None and self.after[0] is None
+
+    def select_sql(self) -> str:
+        id_expr = self.id_expr if self.id_expr is not None else "NULL"
+        return f"{self.sort_expr} AS {CURSOR_SORT_ALIAS}, {id_expr} AS {CURSOR_ID_ALIAS}"
+
+    def where_sql(self, query_params: List) -> Optional[str]:
+        """شرط الصفحة (يضيف معاملاته إلى query_params)، أو None إذا لم يلزم شرط."""
+        op = "<" if self.descending else ">"
+        if self.after is None:
+            return f"{self.sort_expr} IS NOT NULL" if self.nullable else None
+
+        sort_value, row_id = self.after
+        if self.in_null_phase:
+            if row_id is None:
+                return f"{self.sort_expr} IS NULL"
+            query_params.append(row_id)
+            return f"{self.sort_expr} IS NULL AND {self.id_expr} {op} ${len(query_params)}::{self.id_type}"
+
+        query_params.append(sort_value)
+        sort_param = f"${len(query_params)}::{self.sort_type}"
+        if self.id_expr is None:
+            return f"{self.sort_expr} {op} {sort_param}"
+        query_params.append(row_id)
+        id_param = f"${len(query_params)}::{self.id_type}"
+        return f"({self.sort_expr}, {self.id_expr}) {op} ({sort_param}, {id_param})"
+
+    def order_by_sql(self) -> str:
+        direction = "DESC" if self.descending else "ASC"
+        if self.id_expr is None:
+            return f"ORDER BY {self.sort_expr} {direction}"
+        if self.in_null_phase:
+            return f"ORDER BY {self.id_expr} {direction}"
+        return f"ORDER BY {self.sort_expr} {direction}, {self.id_expr} {direction}"
+
+    def next_cursor(self, rows: List[dict], page_size: int) -> Optional[str]:
+        """المؤشر التالي من آخر صف (يحذف أعمدة المؤشر من الصفوف)، أو None عند انتهاء النتائج."""
+        cursor = None
+        if rows and len(rows) >= page_size:
+            last = rows[-1]
+            cursor = encode_cursor(last[CURSOR_SORT_ALIAS], last[CURSOR_ID_ALIAS], self.sort_key)
+        elif self.nullable and not self.in_null_phase:
+            # انتهت الصفوف ذات القيم: الصفحة التالية تبدأ مرحلة NULL
+            cursor = encode_cursor(None, None, self.sort_key)
+        for row in rows:
+            row.pop(CURSOR_SORT_ALIAS, None)
+            row.pop(CURSOR_ID_ALIAS, None)
+        return cursor
+
+
+def keyset_requested(args) -> bool:
+    """وضع المؤشر اختياري: يُفعّل بوجود المعامل after (فارغًا للصفحة الأولى)."""
+    return "after" in args
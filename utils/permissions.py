@@ -4,26 +4,27 @@ from quart import request, jsonify, current_app
 import jwt
 from config import SECRET_KEY
 import json
+from utils.settings_cache import settings_cache, notify_settings_changed, PERMISSIONS_KEY
 
 
 async def get_user_permissions(email):
-    """جلب صلاحيات المستخدم من قاعدة البيانات"""
-    async with current_app.db_pool.acquire() as connection:
-        result = await connection.fetch("""
-            SELECT DISTINCT p.name
-            FROM panel_users u
-            JOIN roles r ON u.role_id = r.id
-            JOIN role_permissions rp ON r.id = rp.role_id
-            JOIN permissions p ON rp.permission_id = p.id
-            WHERE u.email = $1
-        """, email)
-        return [row['name'] for row in result]
+    """جلب صلاحيات المستخدم (من كاش الصلاحيات، انظر settings_cache.get_panel_permissions)"""
+    permissions = await settings_cache.get_panel_permissions()
+    return sorted(permissions.for_email(email))
 
 
 async def has_permission(email, permission):
-    """فحص صلاحية محددة للمستخدم"""
-    permissions = await get_user_permissions(email)
-    return permission in permissions
+    """فحص صلاحية محددة للمستخدم (فحص عضوية في الذاكرة)"""
+    permissions = await settings_cache.get_panel_permissions()
+    return permission in permissions.for_email(email)
+
+
+async def invalidate_permissions(connection):
+    """
+    إبطال كاش الصلاحيات في كل العمليات بعد تعديل الأدوار أو صلاحياتها أو مستخدمي اللوحة.
+    داخل معاملة يصل الإشعار للعمليات الأخرى بعد COMMIT.
+    """
+    await notify_settings_changed(connection, PERMISSIONS_KEY)
 
 
 async def log_action(user_email, action, resource=None, resource_id=None, details=None,
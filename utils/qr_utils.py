@@ -0,0 +1,55 @@
+# utils/qr_utils.py
+import asyncio
+import base64
+import io
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import qrcode
+
+QR_CACHE_MAX_ENTRIES = 32
+
+# منفذ مخصص حتى لا يزاحم توليد الصور مهام المنفذ الافتراضي
+_qr_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="qr-render")
+_qr_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+
+def _render_qr_png(data: str) -> bytes:
+    """توليد صورة QR بصيغة PNG (عملية CPU تُنفذ داخل المنفذ وليس على حلقة الأحداث)."""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill="black", back_color="white")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+async def get_qr_png(address: str, cache: bool = True) -> bytes:
+    """
+    إرجاع صورة QR للعنوان. التوليد الفعلي يتم في ThreadPoolExecutor لتجنب حجب حلقة الأحداث.
+    cache: تخزين LRU بمفتاح العنوان، مفيد للعناوين المشتركة بين الدفعات (محفظة البوت)؛
+    العناوين الفريدة لكل دفعة تُمرر cache=False حتى لا تُزيح الإدخالات المفيدة.
+    """
+    if cache:
+        cached = _qr_cache.get(address)
+        if cached is not None:
+            _qr_cache.move_to_end(address)
+            return cached
+
+    loop = asyncio.get_running_loop()
+    png_bytes = await loop.run_in_executor(_qr_executor, _render_qr_png, address)
+    if not cache:
+        return png_bytes
+
+    _qr_cache[address] = png_bytes
+    _qr_cache.move_to_end(address)
+    while len(_qr_cache) > QR_CACHE_MAX_ENTRIES:
+        _qr_cache.popitem(last=False)
+    logging.debug(f"🧾 QR rendered for {address} (cache size: {len(_qr_cache)})")
+    return png_bytes
+
+
+async def get_qr_data_uri(address: str, cache: bool = True) -> str:
+    png_bytes = await get_qr_png(address, cache=cache)
+    return f"data:image/png;base64,{base64.b64encode(png_bytes).decode('utf-8')}"
@@ -16,6 +16,7 @@ from database.db_queries import (
     find_active_user_discounts_by_original_discount,
     get_all_channel_ids_for_type
 )
+from utils.settings_cache import settings_cache
 import json
 
 # إنشاء مثيل للجدولة
@@ -319,17 +320,15 @@ async def handle_reminder_task(bot: Bot, connection, telegram_id: int, task_type
             """, telegram_id, channel_id)
             return
 
-        # 🔹 جلب إعدادات الرسائل من قاعدة البيانات
-        reminder_settings = await connection.fetchrow(
-            "SELECT first_reminder_message, second_reminder_message FROM reminder_settings LIMIT 1"
-        )
+        # 🔹 جلب إعدادات الرسائل من كاش الإعدادات المشترك
+        reminder_settings = await settings_cache.get_reminder_settings(connection)
         # ... (نفس منطق تحديد الرسالة)
         if not reminder_settings:
             first_reminder_message = "📢 تنبيه: اشتراكك سينتهي في {expiry_date} بتوقيت الرياض. يرجى التجديد."
             second_reminder_message = "⏳ تبقى {remaining_hours} ساعة على انتهاء اشتراكك. لا تنسَ التجديد!"
         else:
-            first_reminder_message = reminder_settings["first_reminder_message"]
-            second_reminder_message = reminder_settings["second_reminder_message"]
+            first_reminder_message = reminder_settings.first_reminder_message
+            second_reminder_message = reminder_settings.second_reminder_message
 
         # 🔹 تجهيز رسالة التذكير
         if task_type == "first_reminder":
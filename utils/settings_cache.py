@@ -0,0 +1,262 @@
+# =============== utils/settings_cache.py ===============
+"""
+كاش مشترك للإعدادات شبه الثابتة (المحفظة، إعدادات التذكير، الشروط والأحكام،
+صلاحيات مستخدمي لوحة التحكم، ولقطة كتالوج الاشتراكات العام - انظر utils/catalog_cache.py).
+
+القراءة تتم من الذاكرة، ويتم الإبطال فورًا عبر pg_notify على القناة SETTINGS_CHANNEL
+عند أي كتابة من لوحة التحكم، بحيث تُبطل كل العمليات (workers) نسختها في نفس اللحظة.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional
+
+import asyncpg
+
+from utils.catalog_cache import CATALOG_KEY, CatalogSnapshot, load_catalog_snapshot
+
+SETTINGS_CHANNEL = "settings_changed"
+PERMISSIONS_KEY = "panel_permissions"
+# صلاحية لقطة الصلاحيات حتى مع LISTEN (تغطي أي تعديل مباشر على قاعدة البيانات)
+PERMISSIONS_TTL_SECONDS = 300
+# يُستخدم فقط عند انقطاع اتصال LISTEN، حتى لا تبقى القيم قديمة إلى ما لا نهاية
+FALLBACK_TTL_SECONDS = 60
+LISTEN_RETRY_MAX_SECONDS = 60
+
+
+# --- الأنواع (Typed Settings) ---
+
+@dataclass
+class WalletSettings:
+    wallet_address: str
+    api_key: Optional[str] = None
+
+
+@dataclass
+class ReminderSettings:
+    first_reminder: int
+    second_reminder: int
+    first_reminder_message: Optional[str] = None
+    second_reminder_message: Optional[str] = None
+
+
+@dataclass
+class TermsConditions:
+    id: Optional[int]
+    terms_array: List[Any] = field(default_factory=list)
+    updated_at: Optional[datetime] = None
+
+
+@dataclass
+class PanelPermissions:
+    by_email: Dict[str, FrozenSet[str]]
+    expires_at: float
+
+    def for_email(self, email: Optional[str]) -> FrozenSet[str]:
+        return self.by_email.get(email, frozenset())
+
+
+def _load_json(value):
+    return json.loads(value) if isinstance(value, str) else (value or [])
+
+
+async def _load_wallet(conn) -> Optional[WalletSettings]:
+    row = await conn.fetchrow("SELECT wallet_address, api_key FROM wallet ORDER BY id DESC LIMIT 1")
+    return WalletSettings(**dict(row)) if row else None
+
+
+async def _load_reminder_settings(conn) -> Optional[ReminderSettings]:
+    row = await conn.fetchrow("""
+        SELECT first_reminder, second_reminder, first_reminder_message, second_reminder_message
+        FROM reminder_settings ORDER BY id LIMIT 1
+    """)
+    return ReminderSettings(**dict(row)) if row else None
+
+
+async def _load_terms_conditions(conn) -> Optional[TermsConditions]:
+    row = await conn.fetchrow("""
+        SELECT id, terms_array, updated_at FROM terms_conditions
+        ORDER BY updated_at DESC LIMIT 1
+    """)
+    if not row:
+        return None
+    return TermsConditions(id=row["id"], terms_array=_load_json(row["terms_array"]), updated_at=row["updated_at"])
+
+
+async def _load_panel_permissions(conn) -> PanelPermissions:
+    # مستخدمو اللوحة قليلون: لقطة واحدة لكل الإيميلات بدل join لكل طلب
+    rows = await conn.fetch("""
+        SELECT u.email, array_agg(DISTINCT p.name) FILTER (WHERE p.name IS NOT NULL) AS permissions
+        FROM panel_users u
+        JOIN roles r ON u.role_id = r.id
+        LEFT JOIN role_permissions rp ON r.id = rp.role_id
+        LEFT JOIN permissions p ON rp.permission_id = p.id
+        GROUP BY u.email
+    """)
+    return PanelPermissions(
+        by_email={row["email"]: frozenset(row["permissions"] or ()) for row in rows},
+        expires_at=time.monotonic() + PERMISSIONS_TTL_SECONDS,
+    )
+
+
+class SettingsCache:
+    """
+    كاش عام للإعدادات: مفتاح -> دالة تحميل. يحتفظ باتصال LISTEN واحد لاستقبال الإبطال.
+    """
+
+    LOADERS: Dict[str, Callable[[Any], Awaitable[Any]]] = {
+        "wallet": _load_wallet,
+        "reminder_settings": _load_reminder_settings,
+        "terms_conditions": _load_terms_conditions,
+        PERMISSIONS_KEY: _load_panel_permissions,
+        CATALOG_KEY: load_catalog_snapshot,
+    }
+
+    def __init__(self):
+        self.db_pool: Optional[asyncpg.Pool] = None
+        self._values: Dict[str, Any] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._listen_conn: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def is_listening(self) -> bool:
+        return self._listen_conn is not None and not self._listen_conn.is_closed()
+
+    async def start(self, db_pool: asyncpg.Pool):
+        """ربط الكاش بالـ pool وبدء الاستماع لإشعارات الإبطال."""
+        self.db_pool = db_pool
+        self._closed = False
+        if not await self._listen():
+            self._schedule_reconnect()
+
+    async def _listen(self) -> bool:
+        try:
+            self._listen_conn = await self.db_pool.acquire()
+            await self._listen_conn.add_listener(SETTINGS_CHANNEL, self._on_notify)
+            self._listen_conn.add_termination_listener(self._on_listener_lost)
+            logging.info(f"✅ Settings cache listening on '{SETTINGS_CHANNEL}'.")
+            return True
+        except Exception as e:
+            logging.error(f"❌ Settings cache could not LISTEN, falling back to {FALLBACK_TTL_SECONDS}s TTL: {e}")
+            await self._release_listener()
+            return False
+
+    async def close(self):
+        self._closed = True
+        if self._reconnect_task is not None and not self._reconnect_task.done():
+            self._reconnect_task.cancel()
+        await self._release_listener()
+        self.invalidate()
+
+    async def _release_listener(self):
+        if self._listen_conn is not None and self.db_pool is not None:
+            try:
+                await self._listen_conn.remove_listener(SETTINGS_CHANNEL, self._on_notify)
+                await self.db_pool.release(self._listen_conn)
+            except Exception:
+                pass
+        self._listen_conn = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        logging.info(f"🔔 Settings invalidated via NOTIFY: {payload or 'all'}")
+        self.invalidate(payload or None)
+
+    def _on_listener_lost(self, connection):
+        logging.warning("⚠️ Settings cache LISTEN connection lost; clearing cache, using TTL fallback and reconnecting.")
+        lost, self._listen_conn = self._listen_conn, None
+        self.invalidate()
+        self._schedule_reconnect(lost)
+
+    def _schedule_reconnect(self, lost: Optional[asyncpg.Connection] = None):
+        if self._closed or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        self._reconnect_task = asyncio.create_task(self._reconnect(lost))
+
+    async def _reconnect(self, lost: Optional[asyncpg.Connection]):
+        if lost is not None:
+            try:
+                await self.db_pool.release(lost)
+            except Exception:
+                pass
+        delay = 1
+        while not self._closed and not self.is_listening:
+            await asyncio.sleep(delay)
+            if await self._listen():
+                # أي إبطال أُرسل أثناء الانقطاع لم يصل، فالقيم المحملة خلاله قد تكون قديمة
+                self.invalidate()
+                return
+            delay = min(delay * 2, LISTEN_RETRY_MAX_SECONDS)
+
+    def invalidate(self, key: Optional[str] = None):
+        if key is None:
+            self._values.clear()
+            self._loaded_at.clear()
+        else:
+            self._values.pop(key, None)
+            self._loaded_at.pop(key, None)
+
+    def _is_fresh(self, key: str) -> bool:
+        if key not in self._values:
+            return False
+        # قيم لها صلاحية زمنية خاصة بها (مثل الكتالوج عند بداية/نهاية خصم)
+        expires_at = getattr(self._values[key], "expires_at", None)
+        if expires_at is not None and time.monotonic() >= expires_at:
+            return False
+        if self.is_listening:
+            return True
+        return time.monotonic() - self._loaded_at.get(key, 0) < FALLBACK_TTL_SECONDS
+
+    async def get(self, key: str, connection: Optional[asyncpg.Connection] = None):
+        """
+        إرجاع قيمة الإعداد من الذاكرة، أو تحميلها من قاعدة البيانات عند أول طلب/بعد الإبطال.
+        يمكن تمرير connection قائم لتجنب حجز اتصال إضافي من الـ pool.
+        """
+        if self._is_fresh(key):
+            return self._values[key]
+
+        loader = self.LOADERS[key]
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if self._is_fresh(key):
+                return self._values[key]
+            if connection is not None:
+                value = await loader(connection)
+            else:
+                async with self.db_pool.acquire() as conn:
+                    value = await loader(conn)
+            self._values[key] = value
+            self._loaded_at[key] = time.monotonic()
+            return value
+
+    async def get_wallet(self, connection=None) -> Optional[WalletSettings]:
+        return await self.get("wallet", connection)
+
+    async def get_reminder_settings(self, connection=None) -> Optional[ReminderSettings]:
+        return await self.get("reminder_settings", connection)
+
+    async def get_terms_conditions(self, connection=None) -> Optional[TermsConditions]:
+        return await self.get("terms_conditions", connection)
+
+    async def get_panel_permissions(self, connection=None) -> PanelPermissions:
+        return await self.get(PERMISSIONS_KEY, connection)
+
+    async def get_catalog(self) -> CatalogSnapshot:
+        return await self.get(CATALOG_KEY)
+
+
+async def notify_settings_changed(connection, key: str):
+    """
+    إبطال الإعداد في كل العمليات. داخل معاملة يصل الإشعار بعد COMMIT فقط.
+    """
+    settings_cache.invalidate(key)
+    await connection.execute("SELECT pg_notify($1, $2)", SETTINGS_CHANNEL, key)
+
+
+settings_cache = SettingsCache()
@@ -0,0 +1,69 @@
+# utils/user_search.py
+"""
+بحث المستخدمين المشترك للوحة التحكم (/users و /subscriptions و /users/export و /messaging/preview-users).
+
+- رقم فقط (معرف تليجرام، أرقام ASCII ضمن نطاق bigint): مطابقة تامة على telegram_id عبر الفهرس الفريد.
+  الأرقام الأكبر أو غير ASCII تُعامل كبحث عام.
+- يبدأ بـ @: بحث ببادئة اسم المستخدم عبر فهرس lower(username) text_pattern_ops.
+- غير ذلك: ILIKE '%x%' على الاسم الكامل واسم المستخدم عبر فهارس gin_trgm_ops.
+
+على جداول أخرى (مثل subscriptions المنضمة مع users) يُستخدم users_lookup: تُحل معرفات المستخدمين
+المطابقين أولًا من users (InitPlan واحد عبر نفس الفهارس) ويُطابق عليها telegram_id_col، حتى لا يتحول
+OR بين أعمدة جداول مختلفة إلى فلترة صفًا صفًا بعد الانضمام.
+"""
+
+from typing import List, Optional, Sequence
+
+_BIGINT_MAX = 2 ** 63 - 1
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def user_search_condition(
+        search_term: str,
+        query_params: List,
+        *,
+        telegram_id_col: str = "u.telegram_id",
+        full_name_col: str = "u.full_name",
+        username_col: str = "u.username",
+        extra_cols: Sequence[str] = (),
+        extra_predicates: Sequence[str] = (),
+        users_lookup: bool = False,
+) -> Optional[str]:
+    """
+    إرجاع شرط SQL للبحث (مع إضافة معاملاته إلى query_params)، أو None إذا كان البحث فارغًا.
+    extra_cols: أعمدة نصية إضافية تُطابق بـ ILIKE في وضع البحث العام فقط.
+    extra_predicates: شروط إضافية للبحث العام فيها {param} مكان نمط ILIKE.
+    users_lookup: مطابقة الاسم واسم المستخدم عبر users بدل full_name_col / username_col.
+    """
+    term = (search_term or "").strip()
+    if not term:
+        return None
+
+    # isdigit() يقبل أرقامًا غير ASCII (مثل ٣ أو ²)، والقيمة يجب أن تتسع في bigint وإلا فشل الاستعلام
+    if term.isascii() and term.isdigit() and len(term) <= 19 and int(term) <= _BIGINT_MAX:
+        query_params.append(int(term))
+        return f"{telegram_id_col} = ${len(query_params)}"
+
+    if term.startswith("@") and len(term) > 1:
+        query_params.append(f"{_escape_like(term[1:].lower())}%")
+        if users_lookup:
+            return _users_lookup(telegram_id_col, f"lower(username) LIKE ${len(query_params)}")
+        return f"lower({username_col}) LIKE ${len(query_params)}"
+
+    query_params.append(f"%{_escape_like(term)}%")
+    param = f"${len(query_params)}"
+    if users_lookup:
+        predicates = [_users_lookup(telegram_id_col, f"full_name ILIKE {param} OR username ILIKE {param}")]
+    else:
+        predicates = [f"{full_name_col} ILIKE {param}", f"{username_col} ILIKE {param}"]
+    predicates += [f"{col} ILIKE {param}" for col in extra_cols]
+    predicates += [predicate.format(param=param) for predicate in extra_predicates]
+    return "(" + " OR ".join(predicates) + ")"
+
+
+def _users_lookup(telegram_id_col: str, users_condition: str) -> str:
+    # = ANY(ARRAY(...)) يُحسب مرة واحدة ويبقى شرطًا قابلًا للفهرسة على telegram_id_col
+    return f"{telegram_id_col} = ANY(ARRAY(SELECT telegram_id FROM users WHERE {users_condition}))"